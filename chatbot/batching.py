@@ -0,0 +1,287 @@
+import time
+import queue
+import logging
+import threading
+from typing import Callable, List, Optional
+
+import torch
+from transformers import LogitsProcessor
+
+from .chatbot import CancellationToken
+from .kvcache import PastKeyValues, past_length
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# called with the ids of each newly sampled token, returns True once the sequence should stop
+TokenCallback = Callable[[List[int]], bool]
+
+
+class BatchRequest(object):
+    """One sequence to generate in a `BatchScheduler` batch.
+
+    `past` holds the keys/values of the first `cached` prompt ids, if any. Once the request is done,
+    `generated` holds the sampled ids and `past` the keys/values of the prompt plus all but the last of
+    them, ready to be cached for the next turn. `exhausted` tells whether it stopped because it reached
+    `max_new_tokens` or its `deadline` (a `time.monotonic()` time).
+    """
+
+    def __init__(
+        self,
+        prompt_ids: List[int],
+        on_tokens: TokenCallback,
+        temperature: float = 1.0,
+        top_p: Optional[float] = None,
+        top_k: Optional[int] = None,
+        repetition_penalty: float = 1.0,
+        max_new_tokens: int = 256,
+        cached: int = 0,
+        past: Optional[PastKeyValues] = None,
+        cancel: Optional[CancellationToken] = None,
+        deadline: Optional[float] = None,
+    ):
+        self.prompt_ids = prompt_ids
+        self.on_tokens = on_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.max_new_tokens = max_new_tokens
+        self.cached = cached
+        self.past = past
+        self.cancel = cancel
+        self.deadline = deadline
+
+        self.generated: List[int] = []
+        self.finished = False
+        self.exhausted = False
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+    def accept(self, token: int, eos_token_id: Optional[int]) -> bool:
+        self.generated.append(token)
+        stop = self.on_tokens([token])
+        self.exhausted = len(self.generated) >= self.max_new_tokens or (self.deadline is not None and time.monotonic() >= self.deadline)
+        self.finished = stop or token == eos_token_id or self.exhausted or self.cancelled()
+        return self.finished
+
+    def cancelled(self) -> bool:
+        return self.cancel is not None and self.cancel.cancelled
+
+
+def _legacy(past) -> PastKeyValues:
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return tuple((key, value) for key, value in past)
+
+
+def _pad_left(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    missing = length - tensor.shape[dim]
+    if missing == 0:
+        return tensor
+
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class BatchScheduler(object):
+    """Generates for many requests at once in a single decode loop.
+
+    Requests are admitted between decode steps: each is prefilled on its own (starting from its cached
+    prefix) and then joined to the running batch, left-padded to the batch's length with an attention
+    mask hiding the padding. Every step samples one token per sequence with that sequence's own sampling
+    settings, and sequences that hit their stop condition are retired immediately, freeing their slot.
+    `logits_processor`, if given, runs on every step's logits after the repetition penalty, like the custom
+    processors passed to `generate`, with each row's previous token as its `input_ids`.
+    """
+
+    def __init__(self, model, eos_token_id: Optional[int], max_batch_size: int = 8, logits_processor: Optional[LogitsProcessor] = None):
+        self.model = model
+        self.eos_token_id = eos_token_id
+        self.max_batch_size = max_batch_size
+        self.logits_processor = logits_processor
+        self.device = next(model.parameters()).device
+
+        self.pending: queue.Queue = queue.Queue()
+        self.rows: List[BatchRequest] = []
+        self.past: Optional[PastKeyValues] = None
+        self.mask: Optional[torch.Tensor] = None
+        self.seen: Optional[torch.Tensor] = None
+
+        self.steps = 0
+        self.tokens = 0
+        self.closing = False
+
+        self.thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self.thread.start()
+
+    def submit(self, request: BatchRequest) -> BatchRequest:
+        """Queues `request` and blocks until it has finished generating."""
+        self.pending.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+        return request
+
+    def close(self):
+        """Stops the decode loop once the requests already submitted have finished."""
+        self.pending.put(None)
+
+    def _run(self):
+        while True:
+            if not self.rows:
+                if self.closing:
+                    return
+                self._admit(self.pending.get())
+
+            while len(self.rows) < self.max_batch_size:
+                try:
+                    self._admit(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            if not self.rows:
+                continue
+
+            try:
+                with torch.no_grad(), metrics.span("decode_step"):
+                    self._step()
+            except Exception as exc:
+                logger.exception(exc)
+                for row in self.rows:
+                    row.error = exc
+                    row.done.set()
+                self.rows, self.past, self.mask, self.seen = [], None, None, None
+
+    def _admit(self, request: Optional[BatchRequest]):
+        if request is None:
+            self.closing = True
+            return
+
+        if request.cancelled():
+            request.done.set()
+            return
+
+        try:
+            with torch.no_grad(), metrics.span("prefill"):
+                past, logits = self._prefill(request)
+                seen = torch.zeros(1, logits.shape[-1], dtype=torch.bool, device=self.device)
+                seen[0, request.prompt_ids] = True
+                token = self._sample(logits, [request], seen)[0]
+        except Exception as exc:
+            logger.exception(exc)
+            request.error = exc
+            request.done.set()
+            return
+
+        seen[0, token] = True
+        if request.accept(token, self.eos_token_id):
+            request.past = past
+            request.done.set()
+            return
+
+        mask = torch.ones(1, past_length(past), dtype=torch.long, device=self.device)
+        if not self.rows:
+            self.rows, self.past, self.mask, self.seen = [request], past, mask, seen
+            return
+
+        length = max(past_length(self.past), past_length(past))
+        self.past = tuple(
+            (
+                torch.cat([_pad_left(key, length, -2), _pad_left(new_key, length, -2)]),
+                torch.cat([_pad_left(value, length, -2), _pad_left(new_value, length, -2)]),
+            )
+            for (key, value), (new_key, new_value) in zip(self.past, past)
+        )
+        self.mask = torch.cat([_pad_left(self.mask, length, -1), _pad_left(mask, length, -1)])
+        self.seen = torch.cat([self.seen, seen])
+        self.rows.append(request)
+
+    def _prefill(self, request: BatchRequest):
+        ids = request.prompt_ids
+        input_ids = torch.tensor([ids[request.cached :]], device=self.device)
+        position_ids = torch.arange(request.cached, len(ids), device=self.device).unsqueeze(0)
+
+        kwargs = {}
+        if request.past is not None:
+            kwargs["past_key_values"] = request.past
+
+        outputs = self.model(input_ids, position_ids=position_ids, use_cache=True, **kwargs)
+        return _legacy(outputs.past_key_values), outputs.logits[:, -1, :]
+
+    def _step(self):
+        input_ids = torch.tensor([[row.generated[-1]] for row in self.rows], device=self.device)
+        mask = torch.cat([self.mask, self.mask.new_ones(len(self.rows), 1)], dim=-1)
+        position_ids = mask.sum(dim=-1, keepdim=True) - 1
+
+        outputs = self.model(input_ids, past_key_values=self.past, attention_mask=mask, position_ids=position_ids, use_cache=True)
+        self.past = _legacy(outputs.past_key_values)
+        self.mask = mask
+
+        tokens = self._sample(outputs.logits[:, -1, :], self.rows, self.seen)
+        self.seen[torch.arange(len(tokens), device=self.device), tokens] = True
+        self.steps += 1
+        self.tokens += len(tokens)
+
+        finished = [row.accept(token, self.eos_token_id) for row, token in zip(self.rows, tokens)]
+        if any(finished):
+            self._retire(finished)
+
+    def _retire(self, finished: List[bool]):
+        total = self.mask.shape[-1]
+        lengths = self.mask.sum(dim=-1).tolist()
+        for i, row in enumerate(self.rows):
+            if finished[i]:
+                start = total - lengths[i]
+                row.past = tuple((key[i : i + 1, :, start:].clone(), value[i : i + 1, :, start:].clone()) for key, value in self.past)
+                row.done.set()
+
+        keep = [i for i in range(len(self.rows)) if not finished[i]]
+        self.rows = [self.rows[i] for i in keep]
+        if not self.rows:
+            self.past, self.mask, self.seen = None, None, None
+            return
+
+        # drop the padding columns no remaining row needs
+        index = torch.tensor(keep, device=self.device)
+        start = total - max(lengths[i] for i in keep)
+        self.past = tuple((key[index, :, start:], value[index, :, start:]) for key, value in self.past)
+        self.mask = self.mask[index, start:]
+        self.seen = self.seen[index]
+
+    def _sample(self, logits: torch.Tensor, rows: List[BatchRequest], seen: torch.Tensor) -> List[int]:
+        """Samples one token per row from `_process`ed logits."""
+        choice = torch.multinomial(torch.softmax(self._process(logits, rows, seen), dim=-1), num_samples=1)
+        return choice.squeeze(-1).tolist()
+
+    def _process(self, logits: torch.Tensor, rows: List[BatchRequest], seen: torch.Tensor) -> torch.Tensor:
+        """Applies repetition penalty, `logits_processor`, temperature, top-k and top-p to each row's logits in
+        the same order as `transformers` does, filtered out tokens ending up at -inf. A None setting is off,
+        callers resolve the model's defaults (see `Transformer.sampling`)."""
+        logits = logits.float()
+
+        def column(values: List[float]) -> torch.Tensor:
+            return torch.tensor(values, dtype=logits.dtype, device=logits.device).unsqueeze(-1)
+
+        penalty = column([row.repetition_penalty or 1.0 for row in rows])
+        penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+        logits = torch.where(seen, penalized, logits)
+
+        if self.logits_processor is not None:
+            previous = torch.tensor([[row.generated[-1] if row.generated else row.prompt_ids[-1]] for row in rows], device=logits.device)
+            logits = self.logits_processor(previous, logits)
+
+        logits = logits / column([row.temperature or 1.0 for row in rows])
+
+        sorted_logits, sorted_ids = torch.sort(logits, descending=True, dim=-1)
+        ranks = torch.arange(logits.shape[-1], device=logits.device).unsqueeze(0)
+        remove = ranks >= column([row.top_k or logits.shape[-1] for row in rows])
+
+        probs = torch.softmax(sorted_logits.masked_fill(remove, -float("inf")), dim=-1)
+        # always keeps the most likely token, since its preceding mass is 0
+        remove |= (torch.cumsum(probs, dim=-1) - probs) >= column([row.top_p or 1.0 for row in rows])
+
+        sorted_logits = sorted_logits.masked_fill(remove, -float("inf"))
+        return torch.full_like(logits, -float("inf")).scatter(-1, sorted_ids, sorted_logits)
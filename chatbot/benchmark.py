@@ -0,0 +1,757 @@
+import os
+import re
+import time
+import codecs
+import json
+import random
+import asyncio
+import argparse
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import multiprocessing
+from typing import Callable, Dict, List, Optional
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from .chatbot import Chatbot, ChatbotMessage, Conversation
+from .batching import BatchRequest, BatchScheduler
+from .filter import WordMatcher
+from .kvcache import KVCacheStore
+from .chatlog import ChatLogWriter
+from .store import ConversationStore
+from .metrics import metrics
+from .memory import rss_bytes
+from .prompt import PromptRenderer
+from .pool import ReplicaPool
+from .service import Dropped, InferenceService, Priority, QueueFull
+from .stoptokens import StopTokens
+from .transformer import IncrementalDetokenizer, StopSequenceCriteria, Transformer, TransformerSettings, gpt2, gpt2XLSpeculative, gptDistil, gptNeoSmall, preamble
+
+sample_reply = "I am sus and you are sus, but only one of us vented in electrical. Defeat that stupid Ultimate Sus! "
+stop_pattern = re.compile(r"\n\[|\n.*\[.+\]<.*>|\n-+|\n\\[A-Za-z]+{|\n<|\n.*\\")
+
+
+def _time_per_token(step: Callable[[List[int]], None], ids: List[int], prompt_length: int) -> float:
+    start = time.perf_counter()
+    for i in range(prompt_length + 1, len(ids) + 1):
+        step(ids[:i])
+    return (time.perf_counter() - start) / (len(ids) - prompt_length)
+
+
+def bench_stop(tokenizer_name: str = "gpt2", contexts: List[int] = [256, 1024, 4096], outlen: int = 256):
+    """Per-token cost of stop-sequence detection as the context grows: full re-decode versus incremental."""
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+    context_ids = tokenizer.encode(preamble, add_special_tokens=False)
+    reply_ids = tokenizer.encode(sample_reply, add_special_tokens=False)
+
+    print(f"{'context':>8} {'full decode (us/token)':>24} {'incremental (us/token)':>24}")
+    for context in contexts:
+        prompt_ids = (context_ids * (context // len(context_ids) + 1))[:context]
+        ids = prompt_ids + (reply_ids * (outlen // len(reply_ids) + 1))[:outlen]
+        offset = len(tokenizer.decode(prompt_ids[1:]))
+
+        def full_decode(ids: List[int]):
+            # what StopSequenceCriteria used to do on every generated token
+            text = tokenizer.decode(ids[1:])[offset:]
+            re.search(stop_pattern, text)
+            re.split(stop_pattern, text)
+
+        criteria = StopSequenceCriteria(stop_pattern, context, tokenizer, lambda text: None)
+        criteria.detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids)
+
+        def incremental(ids: List[int]):
+            criteria.feed(criteria.detokenizer.feed(ids[-1:]))
+
+        full = _time_per_token(full_decode, ids, context)
+        inc = _time_per_token(incremental, ids, context)
+        print(f"{context:>8} {full * 1e6:>24.1f} {inc * 1e6:>24.1f}")
+
+
+def bench_kvcache(settings: TransformerSettings = gptDistil, turns: int = 8, seed: int = 0):
+    """Generates a multi-turn conversation with and without the KV cache from the same seeds, checking that
+    reusing the cached prefix gives the same replies as a cold prefill and timing both."""
+    model = Transformer(name="AMOGUS", preamble=preamble, settings=settings._replace(max_outlen=32))
+    warm_cache = model.kv_cache
+    convo = Conversation("bench")
+
+    print(f"{'turn':>4} {'prompt':>7} {'reused':>7} {'cold (s)':>9} {'warm (s)':>9} match")
+    matches = 0
+    for turn in range(turns):
+        convo.add_message(ChatbotMessage("user", f"{sample_reply} Who is the impostor in round {turn}?"))
+
+        cold_response = []
+        model.kv_cache = KVCacheStore(0)
+        torch.manual_seed(seed + turn)
+        start = time.perf_counter()
+        model._generate(convo, cold_response.append)
+        cold = time.perf_counter() - start
+
+        model.kv_cache = warm_cache
+        reused = warm_cache.reused_tokens
+        torch.manual_seed(seed + turn)
+        start = time.perf_counter()
+        warm_response = model.generate_response(convo, lambda response: None)
+        warm = time.perf_counter() - start
+
+        prompt = len(model.tokenizer.encode(model._generate_model_input(convo)))
+        match = (cold_response or [""])[-1] == warm_response
+        matches += match
+        print(f"{turn:>4} {prompt:>7} {warm_cache.reused_tokens - reused:>7} {cold:>9.3f} {warm:>9.3f} {match}")
+
+    print(f"{matches}/{turns} replies matched the cold prefill")
+
+
+def bench_window(tokenizer_name: str = "gpt2", histories: List[int] = [100, 1000, 10000, 100000], budget: int = 1024, turns: int = 100):
+    """Per-turn cost of fitting a conversation into the token budget and building its prompt, for
+    conversations with increasingly long histories."""
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+    def render(message: ChatbotMessage) -> str:
+        return f"[{message.timestamp}]<{message.sender}>{message.message}\n"
+
+    def count(message: ChatbotMessage) -> int:
+        return len(tokenizer.encode(render(message), add_special_tokens=False))
+
+    print(f"{'history':>8} {'window':>7} {'per turn (ms)':>14}")
+    for history in histories:
+        convo = Conversation("bench")
+        for i in range(history):
+            convo.add_message(ChatbotMessage(f"user{i % 7}", sample_reply, timestamp=i))
+        convo.fit_window(budget, count, trim_to=0.75)
+
+        start = time.perf_counter()
+        for i in range(turns):
+            convo.add_message(ChatbotMessage(f"user{i % 7}", sample_reply, timestamp=history + i))
+            convo.fit_window(budget, count, trim_to=0.75)
+            "".join(render(message) for message in convo.queue)
+        per_turn = (time.perf_counter() - start) / turns
+
+        print(f"{history:>8} {len(convo.queue):>7} {per_turn * 1e3:>14.3f}")
+
+
+def bench_prompt(tokenizer_name: str = "gpt2", windows: List[int] = [10, 100, 1000], turns: int = 50):
+    """Per-turn cost of building a prompt from a conversation window: rendering and tokenizing the whole
+    prompt with humanized times (what Transformer used to do) versus PromptRenderer's cached message ids."""
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    preamble_ids = tokenizer.encode(preamble + "\n")
+
+    def encode(text: str) -> List[int]:
+        return tokenizer.encode(text, add_special_tokens=False)
+
+    humanized = PromptRenderer(encode, preamble, preamble_ids, "AMOGUS", "humanize")
+
+    def rebuild(convo: Conversation) -> List[int]:
+        return preamble_ids + encode(humanized.text(convo)[len(preamble) + 1 :])
+
+    print(f"{'window':>7} {'rebuild (ms)':>13} {'cached (ms)':>12}")
+    for window in windows:
+        results = []
+        for build in (rebuild, PromptRenderer(encode, preamble, preamble_ids, "AMOGUS", "clock").render):
+            # a message a minute up to now
+            start = time.time() - (window + turns) * 60
+            convo = Conversation("bench")
+            for i in range(window):
+                convo.add_message(ChatbotMessage(f"user{i % 7}", sample_reply, timestamp=start + i * 60))
+            build(convo)
+
+            elapsed = 0.0
+            for turn in range(window, window + turns):
+                convo.add_message(ChatbotMessage(f"user{turn % 7}", sample_reply, timestamp=start + turn * 60))
+                convo.dequeue()
+                begin = time.perf_counter()
+                build(convo)
+                elapsed += time.perf_counter() - begin
+            results.append(elapsed / turns)
+
+        print(f"{window:>7} {results[0] * 1e3:>13.3f} {results[1] * 1e3:>12.3f}")
+
+
+def bench_batching(settings: TransformerSettings = gptDistil, conversations: List[int] = [1, 2, 4, 8], outlen: int = 64):
+    """Aggregate tokens/sec when several conversations generate at once: one `generate` call after another
+    versus all of them sharing a `BatchScheduler` decode loop."""
+    tokenizer = AutoTokenizer.from_pretrained(settings.model_name)
+    model = AutoModelForCausalLM.from_pretrained(settings.model_name)
+    model.eval()
+
+    prompts = [tokenizer.encode(f"{preamble}\n[just now]<user{i}>{sample_reply * (i % 3 + 1)}\n[just now]<AMOGUS>") for i in range(max(conversations))]
+    sampling = dict(temperature=settings.temperature, top_p=settings.top_p, top_k=settings.top_k, repetition_penalty=settings.repetition_penalty)
+    model.generate(torch.tensor([prompts[0]]), max_new_tokens=1, pad_token_id=tokenizer.eos_token_id)
+
+    print(f"{'convos':>6} {'sequential (tok/s)':>19} {'batched (tok/s)':>16} {'speedup':>8}")
+    for n in conversations:
+        start = time.perf_counter()
+        for ids in prompts[:n]:
+            model.generate(
+                torch.tensor([ids]),
+                do_sample=True,
+                max_new_tokens=outlen,
+                min_new_tokens=outlen,
+                pad_token_id=tokenizer.eos_token_id,
+                **sampling,
+            )
+        sequential = n * outlen / (time.perf_counter() - start)
+
+        scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=n)
+        requests = [BatchRequest(ids, lambda new_ids: False, max_new_tokens=outlen, **sampling) for ids in prompts[:n]]
+        threads = [threading.Thread(target=scheduler.submit, args=(request,)) for request in requests]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batched = sum(len(request.generated) for request in requests) / (time.perf_counter() - start)
+
+        print(f"{n:>6} {sequential:>19.1f} {batched:>16.1f} {batched / sequential:>7.2f}x")
+
+
+def bench_filter(lengths: List[int] = [500, 2000, 4000], word_counts: List[int] = [0, 1000], chunk: int = 4):
+    """Cost of checking a streamed response for slurs: re-running the alternation regex over the whole
+    response after every update versus feeding only the new characters to a `WordMatcher`."""
+    with open(os.path.join(os.path.dirname(__file__), "slurs-encoded.txt"), "r") as f:
+        patterns = [codecs.decode(line, "rot13").lower() for line in f.read().splitlines()]
+
+    rng = random.Random(0)
+    vocabulary = sample_reply.lower().replace(",", "").replace(".", "").replace("!", "").split()
+
+    print(f"{'words':>6} {'length':>7} {'regex (ms)':>11} {'automaton (ms)':>15}")
+    for word_count in word_counts:
+        # extra made-up words, long enough that they never show up in the generated text by accident
+        words = patterns + ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(12)) for _ in range(word_count)]
+        regex = re.compile("|".join(words))
+        matcher = WordMatcher(words)
+
+        for length in lengths:
+            text = ""
+            while len(text) < length:
+                text += rng.choice(vocabulary) + " "
+            updates = [text[:i] for i in range(chunk, len(text) + 1, chunk)]
+
+            start = time.perf_counter()
+            for response in updates:
+                regex.search(response.lower())
+            regex_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            stream = matcher.stream()
+            checked = 0
+            for response in updates:
+                stream.feed(response[checked:])
+                checked = len(response)
+            automaton_time = time.perf_counter() - start
+
+            print(f"{len(words):>6} {length:>7} {regex_time * 1e3:>11.2f} {automaton_time * 1e3:>15.2f}")
+
+
+def _quantization_run(settings: TransformerSettings, outlen: int) -> dict:
+    rss = rss_bytes()
+    start = time.perf_counter()
+    model = Transformer(name="AMOGUS", preamble=preamble, settings=settings, force_cpu=True)
+    load = time.perf_counter() - start
+    memory = rss_bytes() - rss
+
+    ids = torch.tensor([model._encode_continuation(f"[just now]<user>{sample_reply}\n[just now]<AMOGUS>")])
+    start = time.perf_counter()
+    model.model.generate(ids, do_sample=False, max_new_tokens=outlen, min_new_tokens=outlen, pad_token_id=model.tokenizer.eos_token_id)
+    tokens_per_second = outlen / (time.perf_counter() - start)
+
+    return {"load": load, "memory": memory, "tokens_per_second": tokens_per_second}
+
+
+def bench_quantization(presets: List[TransformerSettings] = [gpt2, gptDistil, gptNeoSmall], modes: List[str] = ["fp32", "bf16", "int8"], outlen: int = 64):
+    """Load time, resident memory and tokens/sec of each CPU quantization mode. Every run loads the model in
+    a fresh process so the memory numbers don't include earlier runs."""
+    context = multiprocessing.get_context("spawn")
+
+    print(f"{'model':<24} {'mode':>5} {'load (s)':>9} {'memory (MiB)':>13} {'tokens/s':>9}")
+    for settings in presets:
+        for mode in modes:
+            with context.Pool(1) as pool:
+                result = pool.apply(_quantization_run, (settings._replace(quantization=mode), outlen))
+            print(f"{settings.model_name:<24} {mode:>5} {result['load']:>9.2f} {result['memory'] / 2**20:>13.1f} {result['tokens_per_second']:>9.1f}")
+
+
+def bench_speculative(settings: TransformerSettings = gpt2XLSpeculative, runs: int = 5, outlen: int = 64):
+    """End-to-end speedup of speculative decoding with `settings.draft_model` over the target model alone,
+    with the preset's sampling settings."""
+    results = {}
+    for draft_model in (None, settings.draft_model):
+        model = Transformer(name="AMOGUS", preamble=preamble, settings=settings._replace(draft_model=draft_model, max_outlen=outlen))
+
+        generated, elapsed = 0, 0.0
+        for run in range(runs):
+            convo = Conversation(f"bench_{run}")
+            convo.add_message(ChatbotMessage("user", f"{sample_reply} Who is the impostor in round {run}?"))
+
+            torch.manual_seed(run)
+            start = time.perf_counter()
+            response = model.generate_response(convo, lambda response: None)
+            elapsed += time.perf_counter() - start
+            generated += len(model.tokenizer.encode(response, add_special_tokens=False))
+
+        results[draft_model] = generated / elapsed
+        stats = f", {model.speculative_stats}" if model.speculative_stats is not None else ""
+        print(f"{draft_model or 'no draft':<24} {generated / elapsed:>8.1f} tokens/s{stats}")
+
+    print(f"speedup: {results[settings.draft_model] / results[None]:.2f}x")
+
+
+_startup_script = """
+import sys, json
+from chatbot.startup import startup
+with startup.phase("imports"):
+    from chatbot.transformer import Transformer
+from chatbot.presets import TransformerSettings
+
+settings = TransformerSettings(*json.loads(sys.argv[1]))._replace(max_outlen=16)
+model = Transformer(name="AMOGUS", preamble=sys.argv[2], settings=settings, force_cpu=sys.argv[3] == "cpu")
+model.warmup()
+print(json.dumps({"total": startup.elapsed(), "phases": startup.phases}))
+"""
+
+
+def bench_startup(settings: TransformerSettings = gptDistil, runs: int = 3, device: str = "cpu"):
+    """Time from a fresh process to a warmed up model, phase by phase."""
+    phases = {}
+    totals = []
+    for run in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", _startup_script, json.dumps(settings), preamble, device],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        totals.append(time.perf_counter() - start)
+
+        result = json.loads(output.splitlines()[-1])
+        for name, seconds in result["phases"]:
+            phases.setdefault(name, []).append(seconds)
+        print(f"run {run}: {totals[-1]:.2f}s wall, {result['total']:.2f}s after interpreter start")
+
+    for name, times in phases.items():
+        print(f"{name:<16} {sum(times) / len(times):>8.2f}s")
+    print(f"{'total':<16} {sum(totals) / len(totals):>8.2f}s")
+
+
+def _conversations_run(store: bool, channels: int, messages: int, max_resident: int) -> dict:
+    logdir = tempfile.mkdtemp()
+    writer = ChatLogWriter()
+    rng = random.Random(0)
+    # a few busy channels and a long tail of quiet ones
+    weights = [1 / (rank + 1) for rank in range(channels)]
+    picks = rng.choices(range(channels), weights, k=messages)
+
+    rss = rss_bytes()
+    convos = ConversationStore(logdir, max_conversations=max_resident, writer=writer) if store else {}
+    start = time.perf_counter()
+    for i, channel in enumerate(picks):
+        if channel not in convos:
+            convos[channel] = Conversation(f"channel_{channel}", logdir=logdir, writer=writer)
+        convos[channel].add_message(ChatbotMessage(f"user{i % 97}", sample_reply[: rng.randint(8, len(sample_reply))]))
+    elapsed = time.perf_counter() - start
+    memory = rss_bytes() - rss
+
+    writer.flush()
+    shutil.rmtree(logdir)
+    return {"memory": memory, "us_per_message": elapsed / messages * 1e6, "loads": convos.loads if store else 0}
+
+
+def bench_conversations(channels: int = 10000, messages: int = 200000, max_resident: int = 1000):
+    """Memory held by every channel's conversation, an unbounded dict versus a `ConversationStore` that drops
+    idle channels and reloads them from their logs. Each run is in a fresh process."""
+    context = multiprocessing.get_context("spawn")
+
+    print(f"{'':<6} {'memory (MiB)':>13} {'us/message':>11} {'reloads':>8}")
+    for store in (False, True):
+        with context.Pool(1) as pool:
+            result = pool.apply(_conversations_run, (store, channels, messages, max_resident))
+        print(f"{'store' if store else 'dict':<6} {result['memory'] / 2**20:>13.1f} {result['us_per_message']:>11.1f} {result['loads']:>8}")
+
+
+def bench_metrics(settings: TransformerSettings = gptDistil, runs: int = 10, outlen: int = 32, spans: int = 1000000):
+    """Cost of a metrics span disabled and enabled, reply latency with metrics off versus on, and where the
+    time of an instrumented reply goes."""
+    for enabled in (False, True):
+        metrics.enabled = enabled
+        start = time.perf_counter()
+        for _ in range(spans):
+            with metrics.span("bench"):
+                pass
+        print(f"span {'enabled' if enabled else 'disabled'}: {(time.perf_counter() - start) / spans * 1e9:.0f} ns")
+
+    model = Transformer(name="AMOGUS", preamble=preamble, settings=settings._replace(max_outlen=outlen))
+    model.model.generation_config.min_new_tokens = outlen
+    model.warmup()
+
+    print(f"{'metrics':>8} {'ms/reply':>9}")
+    for enabled in (False, True, False, True):
+        metrics.enabled = enabled
+        elapsed = 0.0
+        for run in range(runs):
+            torch.manual_seed(run)
+            convo = Conversation(f"bench{run}")
+            convo.add_message(ChatbotMessage("user", sample_reply))
+            start = time.perf_counter()
+            model.generate_response(convo, lambda response: None)
+            elapsed += time.perf_counter() - start
+        print(f"{'on' if enabled else 'off':>8} {elapsed / runs * 1e3:>9.1f}")
+
+    print(f"{'span':<14} {'count':>6} {'mean (ms)':>10}")
+    for name, span in sorted(metrics.snapshot()["spans"].items()):
+        if name != "bench":
+            print(f"{name:<14} {span['count']:>6} {span['mean_ms']:>10.3f}")
+
+
+def bench_memory(settings: TransformerSettings = gptDistil, requests: int = 2000, channels: int = 64, outlen: int = 8):
+    """Steady-state latency and memory over many requests, collecting after every request (what `_generate`
+    used to do) versus only under memory pressure."""
+    print(f"{'policy':<9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'collections':>12} {'RSS start (MiB)':>16} {'RSS end (MiB)':>14}")
+    for policy in ("always", "pressure"):
+        model = Transformer(name="AMOGUS", preamble=preamble, settings=settings._replace(max_outlen=outlen))
+        model.warmup()
+        if policy == "always":
+            model.memory.under_pressure = lambda: True
+
+        convos = [Conversation(f"bench{channel}") for channel in range(channels)]
+        latencies = []
+        rss = []
+        for request in range(requests):
+            torch.manual_seed(request)
+            convo = convos[request % channels]
+            convo.add_message(ChatbotMessage("user", f"{sample_reply} Who is the impostor in round {request}?"))
+            start = time.perf_counter()
+            model.generate_response(convo, lambda response: None)
+            latencies.append(time.perf_counter() - start)
+            rss.append(rss_bytes())
+
+        # the first requests fill the caches and windows, only the rest is steady state
+        steady = sorted(latencies[requests // 10 :])
+        collections = model.memory.collections["pressure"]
+        model.unload()
+        p50, p95 = steady[len(steady) // 2], steady[int(len(steady) * 0.95)]
+        print(f"{policy:<9} {p50 * 1e3:>9.1f} {p95 * 1e3:>9.1f} {collections:>12} {rss[requests // 10] / 2**20:>16.1f} {rss[-1] / 2**20:>14.1f}")
+
+
+def bench_replicas(model_name: str = gptDistil.model_name, replicas: List[int] = [1, 2, 4], conversations: int = 8, turns: int = 4, threads: int = 1, outlen: int = 32):
+    """Reply throughput of a `ReplicaPool` as replicas are added, with `conversations` channels waiting on
+    replies at once, and how busy each replica was."""
+    print(f"{'replicas':>8} {'replies/s':>10} {'speedup':>8} utilization")
+    baseline = None
+    for n in replicas:
+        pool = ReplicaPool(name="AMOGUS", preamble=preamble, replicas=n, threads=threads, server_args=["--model", model_name, "--max-new-tokens", str(outlen)])
+        convos = [Conversation(f"bench{i}") for i in range(conversations)]
+        # warm up every replica before timing
+        for convo in convos[:n]:
+            convo.add_message(ChatbotMessage("user", sample_reply))
+            pool.generate_response(convo, lambda response: None)
+
+        def chat(convo: Conversation):
+            for turn in range(turns):
+                convo.add_message(ChatbotMessage("user", f"{sample_reply} Who is the impostor in round {turn}?"))
+                pool.generate_response(convo, lambda response: None)
+
+        workers = [threading.Thread(target=chat, args=(convo,)) for convo in convos]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        throughput = conversations * turns / (time.perf_counter() - start)
+
+        stats = pool.stats()
+        pool.unload()
+        baseline = baseline or throughput
+        print(f"{n:>8} {throughput:>10.2f} {throughput / baseline:>7.2f}x " + " ".join(f"{replica['utilization']:.0%}" for replica in stats))
+
+
+def bench_budget(settings: TransformerSettings = gptDistil, requests: int = 32, rate: float = 4.0, outlen: int = 64, concurrency: int = 2):
+    """Latency of replies that would run to `outlen` tokens, arriving faster than they can be generated:
+    fixed budgets versus budgets scaled down with the queue depth."""
+
+    async def run(service: InferenceService, model: Transformer) -> List[tuple]:
+        async def request(i: int) -> tuple:
+            convo = Conversation(f"bench{i}")
+            convo.add_message(ChatbotMessage("user", f"{sample_reply} Who is the impostor in round {i}?"))
+            start = time.perf_counter()
+            response = await service.generate(convo.id, convo, lambda response: None)
+            return time.perf_counter() - start, len(model.tokenizer.encode(response))
+
+        rng = random.Random(0)
+        tasks = []
+        for i in range(requests):
+            tasks.append(asyncio.create_task(request(i)))
+            await asyncio.sleep(rng.expovariate(rate))
+        return await asyncio.gather(*tasks)
+
+    model = Transformer(name="AMOGUS", preamble=preamble, settings=settings._replace(max_outlen=outlen), max_batch_size=concurrency)
+    # runaway replies: nothing stops them before the budget does
+    model.model.generation_config.min_new_tokens = outlen
+    model.warmup()
+
+    print(f"{'budget':<9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'max (ms)':>9} {'tokens/reply':>13}")
+    for adaptive in (False, True):
+        service = InferenceService(model, max_concurrency=concurrency, max_queue=requests, adaptive_budget=adaptive)
+        results = asyncio.run(run(service, model))
+        service.shutdown()
+        latencies = sorted(latency for latency, _ in results)
+        tokens = sum(tokens for _, tokens in results) / len(results)
+        p50, p95 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+        print(f"{'adaptive' if adaptive else 'fixed':<9} {p50 * 1e3:>9.1f} {p95 * 1e3:>9.1f} {latencies[-1] * 1e3:>9.1f} {tokens:>13.1f}")
+
+
+# replies running on into what stop_pattern cuts off, after the reply header
+stop_samples = [
+    "sus\n[18:47 UTC]<crewmate>no u",
+    "I saw red vent.\n<crewmate> where",
+    "vote red\n-----",
+    "trust me\n\\begin{document}",
+    "it's in C:\\amogus\nno it isn't",
+    "two lines\nof reply\n[18:48 UTC]<AMOGUS>again",
+]
+
+
+def bench_stoptokens(tokenizers: List[str] = ["gpt2", "EleutherAI/gpt-neo-125M", "meta-llama/Llama-2-7b-hf"], settings: TransformerSettings = gptDistil, replies: int = 50, outlen: int = 64):
+    """Checks each tokenizer's `StopTokens` against `stop_pattern`: a token they stop at must be where the
+    pattern matches, and counts the sample stops they catch at the token that starts them. Then measures the
+    tokens generated per reply that don't end up in it, stopping with the pattern alone versus the tokens."""
+    print(f"{'tokenizer':<28} {'build (s)':>9} {'stop tokens':>12} {'false stops':>12} {'caught':>7}")
+    for name in tokenizers:
+        try:
+            tokenizer = AutoTokenizer.from_pretrained(name, legacy=False)
+        except OSError as exc:
+            print(f"{name:<28} unavailable: {exc.__class__.__name__}")
+            continue
+
+        start = time.perf_counter()
+        tables = StopTokens(tokenizer, stop_pattern)
+        build = time.perf_counter() - start
+
+        false_stops, caught = 0, 0
+        for sample in stop_samples:
+            ids = tokenizer.encode(f"[18:46 UTC]<AMOGUS>{sample}", add_special_tokens=False)
+            header = len(tokenizer.encode("[18:46 UTC]<AMOGUS>", add_special_tokens=False))
+            for i in range(header, len(ids)):
+                matched = stop_pattern.search(tokenizer.decode(ids[: i + 1])) is not None
+                stopped = bool(tables.mask(torch.tensor([ids[i - 1]]))[0, ids[i]])
+                false_stops += stopped and not matched
+                if matched:
+                    caught += stopped
+                    break
+
+        stop_count = int((tables.anywhere | tables.after_newline).sum())
+        print(f"{name:<28} {build:>9.2f} {stop_count:>12} {false_stops:>12} {caught:>3}/{len(stop_samples)}")
+
+    metrics.enabled = True
+    model = Transformer(name="AMOGUS", preamble=preamble, settings=settings._replace(max_outlen=outlen))
+    model.warmup()
+    processor = model.stop_tokens
+
+    print(f"{'stops':<8} {'tokens/reply':>13} {'wasted/reply':>13} {'ms/reply':>9}")
+    for mode in ("pattern", "tokens"):
+        model.stop_tokens = processor if mode == "tokens" else None
+        generated, kept, elapsed = 0, 0, 0.0
+        for run in range(replies):
+            convo = Conversation(f"bench{run}")
+            for turn in range(3):
+                convo.add_message(ChatbotMessage(f"crewmate{turn}", f"{sample_reply} Who is the impostor in round {run}?"))
+
+            torch.manual_seed(run)
+            before = metrics.counters.get("tokens_generated", 0)
+            start = time.perf_counter()
+            response = model.generate_response(convo, lambda response: None)
+            elapsed += time.perf_counter() - start
+            generated += metrics.counters["tokens_generated"] - before
+            kept += len(model.tokenizer.encode(response, add_special_tokens=False))
+
+        print(f"{mode:<8} {generated / replies:>13.1f} {max(0, generated - kept) / replies:>13.2f} {elapsed / replies * 1e3:>9.1f}")
+    model.stop_tokens = processor
+
+
+class _FixedCostChatbot(Chatbot):
+    """Takes `seconds` per reply, standing in for a model to load the scheduler with."""
+
+    def _init_model(self, seconds: float = 0.1):
+        self.seconds = seconds
+
+    def _generate(self, convo, update, cancel=None, budget=None):
+        time.sleep(self.seconds)
+        update("sus")
+
+
+def bench_priority(requests: int = 400, rate: float = 30.0, direct: float = 0.3, seconds: float = 0.1, concurrency: int = 2, max_wait: float = 2.0):
+    """Per-class latency and drops when requests arrive faster than they can be served (`rate` against a
+    capacity of `concurrency / seconds` per second), `direct` of them DMs or mentions and the rest
+    opportunistic: first come first served versus priority scheduling with opportunistic requests dropped
+    after `max_wait` seconds."""
+
+    async def run(service: InferenceService, prioritized: bool) -> Dict[Priority, List[Optional[float]]]:
+        model = _FixedCostChatbot(name="AMOGUS", seconds=seconds)
+        rng = random.Random(0)
+        latencies: Dict[Priority, List[Optional[float]]] = {Priority.DIRECT: [], Priority.OPPORTUNISTIC: []}
+
+        async def request(i: int, priority: Priority):
+            convo = Conversation(f"bench{i}")
+            convo.add_message(ChatbotMessage("user", sample_reply))
+            start = time.perf_counter()
+            try:
+                await service.generate(convo.id, convo, lambda response: None, model, priority=priority if prioritized else Priority.DIRECT)
+                latencies[priority].append(time.perf_counter() - start)
+            except (Dropped, QueueFull):
+                latencies[priority].append(None)
+
+        tasks = []
+        for i in range(requests):
+            priority = Priority.DIRECT if rng.random() < direct else Priority.OPPORTUNISTIC
+            tasks.append(asyncio.create_task(request(i, priority)))
+            await asyncio.sleep(rng.expovariate(rate))
+        await asyncio.gather(*tasks)
+        return latencies
+
+    print(f"capacity {concurrency / seconds:.0f} replies/s, {rate:.0f} requests/s")
+    print(f"{'scheduling':<11} {'class':<14} {'replied':>8} {'dropped':>8} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+    for prioritized in (False, True):
+        max_waits = {Priority.OPPORTUNISTIC: max_wait} if prioritized else {}
+        service = InferenceService(None, max_concurrency=concurrency, max_queue=requests, max_wait=max_waits)
+        results = asyncio.run(run(service, prioritized))
+        service.shutdown()
+        for priority, latencies in results.items():
+            replied = sorted(latency for latency in latencies if latency is not None)
+            p50, p95 = (replied[len(replied) // 2], replied[int(len(replied) * 0.95)]) if replied else (float("nan"), float("nan"))
+            scheduling = "priority" if prioritized else "fifo"
+            print(f"{scheduling:<11} {priority.name.lower():<14} {len(replied):>8} {len(latencies) - len(replied):>8} {p50 * 1e3:>9.1f} {p95 * 1e3:>9.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m chatbot.benchmark")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    stop_parser = subparsers.add_parser("stop", help="Stop-sequence detection cost per generated token")
+    stop_parser.add_argument("--tokenizer", default="gpt2")
+    stop_parser.add_argument("--contexts", nargs="+", type=int, default=[256, 1024, 4096])
+    stop_parser.add_argument("--outlen", type=int, default=256)
+
+    kvcache_parser = subparsers.add_parser("kvcache", help="Warm versus cold prefill across conversation turns")
+    kvcache_parser.add_argument("--model", default=gptDistil.model_name)
+    kvcache_parser.add_argument("--turns", type=int, default=8)
+    kvcache_parser.add_argument("--seed", type=int, default=0)
+
+    window_parser = subparsers.add_parser("window", help="Prompt build cost per turn versus total history length")
+    window_parser.add_argument("--tokenizer", default="gpt2")
+    window_parser.add_argument("--histories", nargs="+", type=int, default=[100, 1000, 10000, 100000])
+    window_parser.add_argument("--budget", type=int, default=1024)
+
+    prompt_parser = subparsers.add_parser("prompt", help="Prompt build cost per turn, full re-render versus cached message ids")
+    prompt_parser.add_argument("--tokenizer", default="gpt2")
+    prompt_parser.add_argument("--windows", nargs="+", type=int, default=[10, 100, 1000])
+    prompt_parser.add_argument("--turns", type=int, default=50)
+
+    batching_parser = subparsers.add_parser("batching", help="Sequential versus continuously batched generation throughput")
+    batching_parser.add_argument("--model", default=gptDistil.model_name)
+    batching_parser.add_argument("--conversations", nargs="+", type=int, default=[1, 2, 4, 8])
+    batching_parser.add_argument("--outlen", type=int, default=64)
+
+    filter_parser = subparsers.add_parser("filter", help="Slur filtering cost over a streamed response, regex versus automaton")
+    filter_parser.add_argument("--lengths", nargs="+", type=int, default=[500, 2000, 4000])
+    filter_parser.add_argument("--words", nargs="+", type=int, default=[0, 1000])
+
+    quantization_parser = subparsers.add_parser("quantization", help="CPU load time, memory and speed per quantization mode")
+    quantization_parser.add_argument("--models", nargs="+", default=[gpt2.model_name, gptDistil.model_name, gptNeoSmall.model_name])
+    quantization_parser.add_argument("--modes", nargs="+", default=["fp32", "bf16", "int8"])
+    quantization_parser.add_argument("--outlen", type=int, default=64)
+
+    speculative_parser = subparsers.add_parser("speculative", help="Speculative decoding speedup and draft acceptance rate")
+    speculative_parser.add_argument("--model", default=gpt2XLSpeculative.model_name)
+    speculative_parser.add_argument("--draft", default=gpt2XLSpeculative.draft_model)
+    speculative_parser.add_argument("--runs", type=int, default=5)
+    speculative_parser.add_argument("--outlen", type=int, default=64)
+
+    startup_parser = subparsers.add_parser("startup", help="Time to a warmed up model in a fresh process, per startup phase")
+    startup_parser.add_argument("--model", default=gptDistil.model_name)
+    startup_parser.add_argument("--runs", type=int, default=3)
+    startup_parser.add_argument("--device", choices=["cpu", "gpu"], default="cpu")
+
+    conversations_parser = subparsers.add_parser("conversations", help="Memory of many channels' conversations, unbounded versus ConversationStore")
+    conversations_parser.add_argument("--channels", type=int, default=10000)
+    conversations_parser.add_argument("--messages", type=int, default=200000)
+    conversations_parser.add_argument("--max-resident", type=int, default=1000)
+
+    metrics_parser = subparsers.add_parser("metrics", help="Instrumentation overhead and a per-stage breakdown of reply latency")
+    metrics_parser.add_argument("--model", default=gptDistil.model_name)
+    metrics_parser.add_argument("--runs", type=int, default=10)
+    metrics_parser.add_argument("--outlen", type=int, default=32)
+
+    memory_parser = subparsers.add_parser("memory", help="Latency and memory growth over many requests, collecting always versus under pressure")
+    memory_parser.add_argument("--model", default=gptDistil.model_name)
+    memory_parser.add_argument("--requests", type=int, default=2000)
+    memory_parser.add_argument("--channels", type=int, default=64)
+    memory_parser.add_argument("--outlen", type=int, default=8)
+
+    replicas_parser = subparsers.add_parser("replicas", help="Reply throughput scaling across model server replicas")
+    replicas_parser.add_argument("--model", default=gptDistil.model_name)
+    replicas_parser.add_argument("--replicas", nargs="+", type=int, default=[1, 2, 4])
+    replicas_parser.add_argument("--conversations", type=int, default=8)
+    replicas_parser.add_argument("--turns", type=int, default=4)
+    replicas_parser.add_argument("--threads", type=int, default=1, help="Torch threads per replica")
+    replicas_parser.add_argument("--outlen", type=int, default=32)
+
+    budget_parser = subparsers.add_parser("budget", help="Tail latency under overload, fixed versus queue-adaptive reply budgets")
+    budget_parser.add_argument("--model", default=gptDistil.model_name)
+    budget_parser.add_argument("--requests", type=int, default=32)
+    budget_parser.add_argument("--rate", type=float, default=4.0, help="Requests per second")
+    budget_parser.add_argument("--outlen", type=int, default=64)
+    budget_parser.add_argument("--concurrency", type=int, default=2)
+
+    stoptokens_parser = subparsers.add_parser("stoptokens", help="Token-level stop tables per tokenizer and tokens wasted per reply")
+    stoptokens_parser.add_argument("--tokenizers", nargs="+", default=["gpt2", "EleutherAI/gpt-neo-125M", "meta-llama/Llama-2-7b-hf"])
+    stoptokens_parser.add_argument("--model", default=gptDistil.model_name)
+    stoptokens_parser.add_argument("--replies", type=int, default=50)
+    stoptokens_parser.add_argument("--outlen", type=int, default=64)
+
+    priority_parser = subparsers.add_parser("priority", help="Per-class latency and drops under overload, first come first served versus priority scheduling")
+    priority_parser.add_argument("--requests", type=int, default=400)
+    priority_parser.add_argument("--rate", type=float, default=30.0, help="Requests per second")
+    priority_parser.add_argument("--direct", type=float, default=0.3, help="Fraction of the requests that are DMs or mentions")
+    priority_parser.add_argument("--seconds", type=float, default=0.1, help="Seconds per reply")
+    priority_parser.add_argument("--concurrency", type=int, default=2)
+    priority_parser.add_argument("--max-wait", type=float, default=2.0, help="Seconds opportunistic requests may wait")
+
+    args = parser.parse_args()
+    if args.benchmark == "stop":
+        bench_stop(args.tokenizer, args.contexts, args.outlen)
+    elif args.benchmark == "kvcache":
+        bench_kvcache(gptDistil._replace(model_name=args.model), args.turns, args.seed)
+    elif args.benchmark == "window":
+        bench_window(args.tokenizer, args.histories, args.budget)
+    elif args.benchmark == "prompt":
+        bench_prompt(args.tokenizer, args.windows, args.turns)
+    elif args.benchmark == "batching":
+        bench_batching(gptDistil._replace(model_name=args.model), args.conversations, args.outlen)
+    elif args.benchmark == "filter":
+        bench_filter(args.lengths, args.words)
+    elif args.benchmark == "quantization":
+        presets = {settings.model_name: settings for settings in (gpt2, gptDistil, gptNeoSmall)}
+        bench_quantization([presets.get(name, gptDistil._replace(model_name=name)) for name in args.models], args.modes, args.outlen)
+    elif args.benchmark == "speculative":
+        bench_speculative(gpt2XLSpeculative._replace(model_name=args.model, draft_model=args.draft), args.runs, args.outlen)
+    elif args.benchmark == "startup":
+        bench_startup(gptDistil._replace(model_name=args.model), args.runs, args.device)
+    elif args.benchmark == "conversations":
+        bench_conversations(args.channels, args.messages, args.max_resident)
+    elif args.benchmark == "metrics":
+        bench_metrics(gptDistil._replace(model_name=args.model), args.runs, args.outlen)
+    elif args.benchmark == "memory":
+        bench_memory(gptDistil._replace(model_name=args.model), args.requests, args.channels, args.outlen)
+    elif args.benchmark == "replicas":
+        bench_replicas(args.model, args.replicas, args.conversations, args.turns, args.threads, args.outlen)
+    elif args.benchmark == "budget":
+        bench_budget(gptDistil._replace(model_name=args.model), args.requests, args.rate, args.outlen, args.concurrency)
+    elif args.benchmark == "stoptokens":
+        bench_stoptokens(args.tokenizers, gptDistil._replace(model_name=args.model), args.replies, args.outlen)
+    elif args.benchmark == "priority":
+        bench_priority(args.requests, args.rate, args.direct, args.seconds, args.concurrency, args.max_wait)
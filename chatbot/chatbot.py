@@ -1,9 +1,11 @@
 from .conversation import *
+from .filter import WordMatcher
+from .metrics import metrics
 import os
-import re
 import codecs
 import logging
-from typing import Callable
+import threading
+from typing import Callable, NamedTuple
 
 UpdateFunc = Callable[[str], None]
 
@@ -13,12 +15,39 @@ with open(os.path.join(os.path.dirname(__file__), "slurs-encoded.txt"), "r") as
     slurs = f.read().splitlines()
     slurs = map(lambda x: codecs.decode(x, "rot13"), slurs)
     slurs = list(slurs)
-    slurs = "|".join(slurs)
-    slurs = re.compile(slurs)
+    slurs = WordMatcher(slurs)
 
 
 def has_slur(message: str):
-    return slurs.search(message.lower()) is not None
+    return slurs.search(message)
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancellationToken(object):
+    """Lets another thread ask a running generation to stop early."""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+
+class Budget(NamedTuple):
+    """Limits on one response, on top of the model's own (`TransformerSettings.max_outlen` and `max_seconds`):
+    at most `max_tokens` tokens and `seconds` of generation, then both scaled by `scale`, e.g. to shorten
+    replies while many requests are waiting."""
+
+    max_tokens: Optional[int] = None
+    seconds: Optional[float] = None
+    scale: float = 1.0
 
 
 class Chatbot(object):
@@ -35,30 +64,69 @@ class Chatbot(object):
     def _init_model(self, **kwargs):
         pass
 
-    def generate_response(self, convo: Conversation, update: UpdateFunc) -> str:
+    def warmup(self):
+        """Runs a short throwaway generation, so the first real request doesn't pay for lazy initialization,
+        kernel selection and allocator growth."""
+        pass
+
+    def memory_footprint(self) -> int:
+        """Bytes of (V)RAM this chatbot keeps allocated while loaded."""
+        return 0
+
+    def unload(self):
+        """Frees the chatbot's model, it can't generate afterwards."""
+        pass
+
+    def generate_response(self, convo: Conversation, update: UpdateFunc, cancel: Optional[CancellationToken] = None, budget: Optional[Budget] = None) -> str:
+        """Generates the next message in `convo` and adds it to the conversation, calling `update` with the
+        response so far as it is generated. Raises `Cancelled`, without adding anything, if `cancel` is
+        cancelled before the response is done. A response cut short by its `budget` ends at its last complete
+        sentence."""
         _response = ""
+        # responses passed to update only ever grow, so only the new characters have to be checked
+        checked = 0
+        slur_stream = slurs.stream()
 
         def _update(response: str):
-            nonlocal _response
-            if has_slur(response):
+            nonlocal _response, checked, slur_stream
+            if len(response) < checked:
+                checked, slur_stream = 0, slurs.stream()
+
+            if slur_stream.matched:
+                return
+
+            with metrics.span("slur_filter"):
+                matched = slur_stream.feed(response[checked:])
+            if matched:
+                metrics.inc("slur_filtered")
                 logger.info(f"Generated response containing slur: {response}")
                 return
+            checked = len(response)
 
             if response != "":
                 _response = response
                 update(response)
 
-        self._generate(convo, _update)
+        if cancel is not None and cancel.cancelled:
+            raise Cancelled()
+
+        with metrics.span("generate"):
+            self._generate(convo, _update, cancel, budget)
+        if cancel is not None and cancel.cancelled:
+            metrics.inc("cancelled")
+            raise Cancelled()
+
+        metrics.inc("responses")
         convo.add_message(ChatbotMessage(self.name, _response))
 
         return _response
 
-    def _generate(self, convo: Conversation, update: UpdateFunc):
+    def _generate(self, convo: Conversation, update: UpdateFunc, cancel: Optional[CancellationToken] = None, budget: Optional[Budget] = None):
         pass
 
 
 class BruhChatbot(Chatbot):
-    def _generate(self, convo: Conversation, update: Callable[[str], None]):
+    def _generate(self, convo: Conversation, update: Callable[[str], None], cancel: Optional[CancellationToken] = None, budget: Optional[Budget] = None):
         update("bruh")
 
     def _generate_model_input(self, convo: Conversation) -> str:
@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from typing import IO, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ChatLogWriter(object):
+    """Appends JSON records to chat log files from a background thread.
+
+    Records are written one per line in batches of up to `batch_size`, waiting at most `flush_interval`
+    seconds for a batch to fill. With `fsync` set every batch is also synced to disk before the next one
+    is written. Up to `max_open` log files are kept open between batches.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, batch_size: int = 256, fsync: bool = False, max_open: int = 64):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.max_open = max_open
+
+        self.queue: queue.Queue = queue.Queue()
+        self.files: OrderedDict[str, IO] = OrderedDict()
+
+        self.thread = threading.Thread(target=self._run, name="chatlog-writer", daemon=True)
+        self.thread.start()
+
+    def append(self, path: str, record: dict):
+        self.queue.put((path, json.dumps(record) + "\n"))
+
+    def flush(self):
+        """Blocks until every record appended so far has been written."""
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # the batch is written `flush_interval` after its first record at the latest, however steadily
+            # records keep arriving
+            deadline = time.monotonic() + self.flush_interval
+            try:
+                while len(batch) < self.batch_size and not isinstance(batch[-1], threading.Event):
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+
+            try:
+                self._write(batch)
+            except Exception as exc:
+                logger.exception(exc)
+
+            if isinstance(batch[-1], threading.Event):
+                batch[-1].set()
+
+    def _write(self, batch: list):
+        written = OrderedDict()
+        for item in batch:
+            if isinstance(item, threading.Event):
+                continue
+
+            path, line = item
+            f = self._open(path)
+            f.write(line)
+            written[path] = f
+
+        for f in written.values():
+            # files closed to make room for later ones in the batch were flushed and synced on close
+            if f.closed:
+                continue
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def _open(self, path: str) -> IO:
+        f = self.files.get(path)
+        if f is not None:
+            self.files.move_to_end(path)
+            return f
+
+        f = open(path, "a", encoding="utf-8")
+        self.files[path] = f
+        while len(self.files) > self.max_open:
+            _, old = self.files.popitem(last=False)
+            if self.fsync:
+                old.flush()
+                os.fsync(old.fileno())
+            old.close()
+
+        return f
+
+
+_default_writer: Optional[ChatLogWriter] = None
+_default_writer_lock = threading.Lock()
+
+
+def default_writer() -> ChatLogWriter:
+    global _default_writer
+    with _default_writer_lock:
+        if _default_writer is None:
+            _default_writer = ChatLogWriter()
+            atexit.register(_default_writer.flush)
+
+    return _default_writer
+
+
+def set_default_writer(writer: ChatLogWriter):
+    global _default_writer
+    with _default_writer_lock:
+        _default_writer = writer
+
+
+def convert_json_log(path: str) -> str:
+    """Converts a chat log written by the old `Conversation.dump` (a JSON list of messages) to a JSONL log
+    next to it, returning the new path."""
+    with open(path, "r", encoding="utf-8") as f:
+        messages: List[dict] = json.load(f)
+
+    out_path = os.path.splitext(path)[0] + ".jsonl"
+    with open(out_path, "w", encoding="utf-8") as f:
+        for message in messages:
+            f.write(json.dumps({"event": "message", **message}) + "\n")
+
+    return out_path
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        print(f"{path} -> {convert_json_log(path)}")
@@ -1,27 +1,139 @@
 import datetime
 import os
+import sys
 import time
-from typing import NamedTuple, Optional, Tuple, List
+from typing import Callable, NamedTuple, Optional, Tuple, List
 import json
 
+from .chatlog import ChatLogWriter, default_writer
+from .metrics import metrics
+
 
 class ChatbotMessage:
-    def __init__(self, sender: str, message: str):
+    # a bot in many channels keeps a lot of these around, slots save the per-object __dict__
+    __slots__ = ("sender", "message", "timestamp", "num_tokens", "rendered")
+
+    def __init__(self, sender: str, message: str, timestamp: Optional[float] = None):
         self.sender = sender
         self.message = message
-        self.timestamp = time.time()
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+        # number of tokens this message takes up in a prompt, counted once by Conversation.fit_window
+        self.num_tokens: Optional[int] = None
+        # the message's prompt token ids, cached by PromptRenderer
+        self.rendered: Optional[tuple] = None
+
+    def to_dict(self) -> dict:
+        return {"sender": self.sender, "message": self.message, "timestamp": self.timestamp}
+
+    def nbytes(self) -> int:
+        """Approximate memory taken by the message: the object itself, its strings and its timestamp."""
+        return sys.getsizeof(self) + sys.getsizeof(self.sender) + sys.getsizeof(self.message) + sys.getsizeof(self.timestamp)
 
 
 class Conversation(object):
-    def __init__(self, id: str, logdir: Optional[str] = None):
+    """A conversation's message history.
+
+    If `logdir` is set, every change is appended to `{logdir}/{id}.jsonl` as one JSON record per line:
+    `{"event": "message", ...}` for new messages, `{"event": "amend", "idx": ..., ...}` for replaced ones,
+    `{"event": "dequeue"}` when the oldest message drops out of the context, `{"event": "pin", "idx": ...}`
+    for pinned messages and `{"event": "unpin", "idx": ...}` for pins evicted to make room.
+    `Conversation.load` replays such a log.
+
+    Pinned messages stay in `queue` even after they are dequeued.
+    """
+
+    def __init__(self, id: str, logdir: Optional[str] = None, writer: Optional[ChatLogWriter] = None):
         self.id = id
         self.__queue: list(ChatbotMessage) = []
         self.start_offset = 0
+        self.pinned: List[int] = []
         self.logdir = logdir
+        self.writer = writer
+
+        # messages in `queue` before index `counted` are included in `window_tokens`, None if it needs a recount
+        self.counted: Optional[int] = 0
+        self.window_tokens = 0
+        # the `key` of the tokenization the messages' `num_tokens` were counted with, see fit_window
+        self.counted_by: object = None
+
+        # approximate memory taken by the messages, see ChatbotMessage.nbytes
+        self.nbytes = 0
+
+        if self.logdir is not None:
+            if os.path.isfile(self.logdir):
+                raise ValueError("logdir is a file")
+
+            os.makedirs(self.logdir, exist_ok=True)
+
+            if self.writer is None:
+                self.writer = default_writer()
+
+    @classmethod
+    def load(cls, path: str, writer: Optional[ChatLogWriter] = None) -> "Conversation":
+        """Reconstructs a conversation from its JSONL log, continuing to log to the same file."""
+        logdir, filename = os.path.split(path)
+        convo = cls(os.path.splitext(filename)[0])
+
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    convo._apply(json.loads(line))
+
+        convo.logdir = logdir
+        convo.writer = writer or default_writer()
+        return convo
+
+    def log_path(self) -> Optional[str]:
+        if self.logdir is None:
+            return None
+
+        return os.path.join(self.logdir, f"{self.id}.jsonl")
+
+    def _apply(self, record: dict, message: Optional[ChatbotMessage] = None):
+        event = record["event"]
+        if event in ("message", "amend") and message is None:
+            message = ChatbotMessage(record["sender"], record["message"], record["timestamp"])
+
+        if event == "message":
+            self.__queue.append(message)
+            self.nbytes += message.nbytes()
+        elif event == "amend":
+            self.nbytes += message.nbytes() - self.__queue[record["idx"]].nbytes()
+            self.__queue[record["idx"]] = message
+            self.counted = None
+        elif event == "dequeue":
+            if self.start_offset not in self.pinned:
+                message = self.__queue[self.start_offset]
+                if self.counted is not None and self.start_offset < self.counted:
+                    self.window_tokens -= message.num_tokens
+                # out of the window for good, its rendered ids won't be needed again
+                message.rendered = None
+            self.start_offset += 1
+        elif event == "pin":
+            if record["idx"] not in self.pinned:
+                self.pinned.append(record["idx"])
+                self.pinned.sort()
+                self.counted = None
+        elif event == "unpin":
+            if record["idx"] in self.pinned:
+                self.pinned.remove(record["idx"])
+                # a pin already dequeued leaves the window with it
+                if record["idx"] < self.start_offset:
+                    message = self.__queue[record["idx"]]
+                    if self.counted is not None and message.num_tokens is not None:
+                        self.window_tokens -= message.num_tokens
+                    message.rendered = None
+        else:
+            raise ValueError(f"unknown chat log event: {event}")
+
+    def _record(self, record: dict, message: Optional[ChatbotMessage] = None):
+        self._apply(record, message)
+        if self.logdir is not None:
+            self.writer.append(self.log_path(), record)
 
     def add_message(self, message: ChatbotMessage):
-        self.__queue.append(message)
-        self.dump()
+        self._record({"event": "message", **message.to_dict()}, message)
 
     def get_last_message(self, sender: str = None) -> Tuple[int, ChatbotMessage]:
         if sender is None:
@@ -32,28 +144,93 @@ class Conversation(object):
                 return i, self.__queue[i]
 
     def dequeue(self):
-        self.start_offset += 1
+        self._record({"event": "dequeue"})
+
+    def pin(self, idx: int):
+        self._record({"event": "pin", "idx": idx})
 
-    def get_queue(self) -> List[ChatbotMessage]:
-        return self.__queue[self.start_offset :]
+    def unpin(self, idx: int):
+        self._record({"event": "unpin", "idx": idx})
+
+    def get_queue(self, end: Optional[int] = None) -> List[ChatbotMessage]:
+        """The messages in the window: pins already dequeued, then everything from `start_offset` up to `end`."""
+        if not self.pinned or self.pinned[0] >= self.start_offset:
+            return self.__queue[self.start_offset : end]
+
+        return [self.__queue[i] for i in self.pinned if i < self.start_offset] + self.__queue[self.start_offset : end]
+
+    def __len__(self) -> int:
+        return len(self.__queue)
 
     def amend(self, idx: int, message: ChatbotMessage):
-        self.__queue[idx] = message
+        self._record({"event": "amend", "idx": idx, **message.to_dict()}, message)
 
     queue = property(fget=get_queue)
 
+    def fit_window(
+        self,
+        budget: int,
+        count: Callable[[ChatbotMessage], int],
+        trim_to: float = 1.0,
+        recount: bool = False,
+        max_pinned: float = 0.5,
+        key: object = None,
+    ) -> int:
+        """Dequeues the oldest unpinned messages until the messages in `queue` take up at most `budget` tokens,
+        and returns by how many tokens the window is still over budget.
+
+        Only messages added since the last call are counted, and `count` is called once per message, unless
+        `recount` is set because messages' counts can change between calls. Once over budget the window is
+        trimmed down to `trim_to * budget` tokens, so it doesn't shift (and invalidate cached prompt prefixes)
+        on every following turn. Dequeued pins may take up at most `max_pinned * budget` tokens, the oldest
+        ones are unpinned beyond that. The newest message is always kept, so the window is only left over
+        budget when that message alone doesn't fit, and it is up to the caller to shorten it.
+
+        `key` identifies what `count` counts with (e.g. `PromptRenderer.key`): when a channel switches models,
+        every message is recounted with the new tokenizer rather than mixed with counts from the old one.
+        """
+        if key is not self.counted_by:
+            recount = True
+            self.counted_by = key
+
+        # messages added from now on (e.g. by the event loop while this runs on a worker thread) are counted
+        # next time
+        end = len(self.__queue)
+        if recount or self.counted is None or self.counted < self.start_offset:
+            # amended, newly pinned or replayed messages, add the window up again from the cached counts
+            self.window_tokens = 0
+            messages = self.get_queue(end)
+        else:
+            messages = self.__queue[self.counted : end]
+
+        for message in messages:
+            if recount or message.num_tokens is None:
+                message.num_tokens = count(message)
+            self.window_tokens += message.num_tokens
+        self.counted = end
+
+        if self.window_tokens <= budget:
+            return 0
+
+        dequeued_pins = [i for i in self.pinned if i < self.start_offset]
+        pinned_tokens = sum(self.__queue[i].num_tokens for i in dequeued_pins)
+        while dequeued_pins and pinned_tokens > max_pinned * budget:
+            idx = dequeued_pins.pop(0)
+            pinned_tokens -= self.__queue[idx].num_tokens
+            self.unpin(idx)
+
+        while self.window_tokens > trim_to * budget and self.start_offset < end - 1:
+            self.dequeue()
+
+        return max(0, self.window_tokens - budget)
+
     def dump(self):
+        """Blocks until everything logged so far has been written to disk."""
         if self.logdir is None:
             return
 
-        if os.path.isfile(self.logdir):
-            raise ValueError("logdir is a file")
-
-        if not os.path.isdir(self.logdir):
-            os.mkdir(self.logdir)
-
-        with open(os.path.join(self.logdir, f"{self.id}.json"), "w") as f:
-            f.write(json.dumps([a.__dict__ for a in self.__queue], indent=4))
+        with metrics.span("chatlog_flush"):
+            self.writer.flush()
 
     def summary(self, full=False) -> str:
         out = ""
@@ -0,0 +1,266 @@
+import threading
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+# NFA node kinds
+_CHARS = 0  # consumes one character in `chars`
+_SPLIT = 1  # epsilon transitions to both outs
+_MATCH = 2
+
+
+class _Node(object):
+    __slots__ = ("kind", "chars", "out", "out2")
+
+    def __init__(self, kind: int, chars: Optional[FrozenSet[str]] = None, out: int = -1, out2: int = -1):
+        self.kind = kind
+        self.chars = chars
+        self.out = out
+        self.out2 = out2
+
+
+class _Parser(object):
+    """Compiles the regex subset used by the word lists (literals, classes, groups, `|`, `?`, `*`, `+` and
+    the escapes `\\s`, `\\d`, `\\w`) into Thompson NFA fragments."""
+
+    def __init__(self, nodes: List[_Node], pattern: str):
+        self.nodes = nodes
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self) -> Tuple[int, List[Tuple[int, str]]]:
+        fragment = self._alternation()
+        if self.pos != len(self.pattern):
+            raise ValueError(f"unexpected {self.pattern[self.pos]!r} at {self.pos} in {self.pattern!r}")
+        return fragment
+
+    # a fragment is (start node, dangling outs as (node, "out" or "out2") to patch later)
+    def _patch(self, outs: List[Tuple[int, str]], target: int):
+        for node, attr in outs:
+            setattr(self.nodes[node], attr, target)
+
+    def _add(self, node: _Node) -> int:
+        self.nodes.append(node)
+        return len(self.nodes) - 1
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _alternation(self):
+        start, outs = self._concatenation()
+        while self._peek() == "|":
+            self.pos += 1
+            other_start, other_outs = self._concatenation()
+            start = self._add(_Node(_SPLIT, out=start, out2=other_start))
+            outs = outs + other_outs
+        return start, outs
+
+    def _concatenation(self):
+        fragments = []
+        while self._peek() not in (None, "|", ")"):
+            fragments.append(self._repetition())
+
+        if not fragments:
+            # empty branch, an epsilon node with a dangling out
+            node = self._add(_Node(_SPLIT))
+            return node, [(node, "out")]
+
+        start, outs = fragments[0]
+        for next_start, next_outs in fragments[1:]:
+            self._patch(outs, next_start)
+            outs = next_outs
+        return start, outs
+
+    def _repetition(self):
+        start, outs = self._atom()
+        op = self._peek()
+        if op == "?":
+            self.pos += 1
+            split = self._add(_Node(_SPLIT, out=start))
+            return split, outs + [(split, "out2")]
+        if op == "*":
+            self.pos += 1
+            split = self._add(_Node(_SPLIT, out=start))
+            self._patch(outs, split)
+            return split, [(split, "out2")]
+        if op == "+":
+            self.pos += 1
+            split = self._add(_Node(_SPLIT, out=start))
+            self._patch(outs, split)
+            return start, [(split, "out2")]
+        return start, outs
+
+    def _atom(self):
+        c = self.pattern[self.pos]
+        self.pos += 1
+
+        if c == "(":
+            fragment = self._alternation()
+            if self._peek() != ")":
+                raise ValueError(f"unbalanced parenthesis in {self.pattern!r}")
+            self.pos += 1
+            return fragment
+
+        if c == "[":
+            chars = self._class()
+        elif c == "\\":
+            chars = self._escape()
+        elif c in "?*+)|":
+            raise ValueError(f"unexpected {c!r} at {self.pos - 1} in {self.pattern!r}")
+        else:
+            chars = frozenset(c)
+
+        node = self._add(_Node(_CHARS, chars=chars))
+        return node, [(node, "out")]
+
+    def _escape(self) -> FrozenSet[str]:
+        c = self.pattern[self.pos]
+        self.pos += 1
+        if c == "s":
+            return frozenset(" \t\n\r\f\v")
+        if c == "d":
+            return frozenset("0123456789")
+        if c == "w":
+            return frozenset("abcdefghijklmnopqrstuvwxyz0123456789_")
+        return frozenset(c)
+
+    def _class(self) -> FrozenSet[str]:
+        chars = set()
+        while self._peek() != "]":
+            if self._peek() is None:
+                raise ValueError(f"unterminated character class in {self.pattern!r}")
+
+            c = self.pattern[self.pos]
+            self.pos += 1
+            if c == "\\":
+                chars |= self._escape()
+            elif self._peek() == "-" and self.pos + 1 < len(self.pattern) and self.pattern[self.pos + 1] != "]":
+                end = self.pattern[self.pos + 1]
+                self.pos += 2
+                chars |= {chr(i) for i in range(ord(c), ord(end) + 1)}
+            else:
+                chars.add(c)
+        self.pos += 1
+        return frozenset(chars)
+
+
+def _is_word(c: str) -> bool:
+    return c.isalnum() or c == "_"
+
+
+class WordMatcher(object):
+    """Finds any of a list of (lowercase, case-insensitively matched) regexes in text, compiled into a single
+    automaton that can be fed text incrementally.
+
+    The patterns are compiled to one NFA which is turned into a DFA lazily, one state and transition at a
+    time as input needs them, so matching costs one dictionary lookup per character regardless of how many
+    patterns there are; for plain word lists the DFA is exactly an Aho-Corasick automaton. With
+    `word_boundary` set, matches must start and end at word boundaries.
+    """
+
+    def __init__(self, patterns: List[str], word_boundary: bool = False):
+        self.word_boundary = word_boundary
+
+        self.nodes: List[_Node] = []
+        starts = []
+        for pattern in patterns:
+            start, outs = _Parser(self.nodes, pattern.lower()).parse()
+            match = len(self.nodes)
+            self.nodes.append(_Node(_MATCH))
+            for node, attr in outs:
+                setattr(self.nodes[node], attr, match)
+            starts.append(start)
+
+        self.start_nodes = self._closure(starts)
+
+        self.states: Dict[FrozenSet[int], int] = {}
+        self.accepting: List[bool] = []
+        self.transitions: Dict[Tuple[int, str], int] = {}
+        self.state_nodes: List[FrozenSet[int]] = []
+        self.lock = threading.Lock()
+
+        self.start = self._state(self.start_nodes)
+
+    def _closure(self, nodes) -> FrozenSet[int]:
+        seen = set()
+        stack = list(nodes)
+        while stack:
+            i = stack.pop()
+            if i < 0 or i in seen:
+                continue
+
+            seen.add(i)
+            node = self.nodes[i]
+            if node.kind == _SPLIT:
+                stack.append(node.out)
+                stack.append(node.out2)
+
+        return frozenset(i for i in seen if self.nodes[i].kind != _SPLIT)
+
+    def _state(self, nodes: FrozenSet[int]) -> int:
+        state = self.states.get(nodes)
+        if state is None:
+            state = len(self.state_nodes)
+            self.states[nodes] = state
+            self.state_nodes.append(nodes)
+            self.accepting.append(any(self.nodes[i].kind == _MATCH for i in nodes))
+        return state
+
+    def _transition(self, state: int, c: str) -> int:
+        nodes = [self.nodes[i].out for i in self.state_nodes[state] if self.nodes[i].kind == _CHARS and c in self.nodes[i].chars]
+        if not self.word_boundary or not _is_word(c):
+            nodes.extend(self.start_nodes)
+
+        closure = self._closure(nodes)
+        with self.lock:
+            target = self._state(closure)
+            self.transitions[(state, c)] = target
+        return target
+
+    def stream(self) -> "MatchStream":
+        return MatchStream(self)
+
+    def search(self, text: str) -> bool:
+        stream = self.stream()
+        return stream.feed(text) or stream.finish()
+
+
+class MatchStream(object):
+    """Matching state for one piece of text that arrives in chunks. `feed` only looks at the new chunk."""
+
+    def __init__(self, matcher: WordMatcher):
+        self.matcher = matcher
+        self.state = matcher.start
+        self.matched = False
+
+    def feed(self, text: str) -> bool:
+        """Feeds the next chunk of text, returning whether anything has matched so far."""
+        if self.matched:
+            return True
+
+        matcher = self.matcher
+        transitions = matcher.transitions
+        accepting = matcher.accepting
+        boundary = matcher.word_boundary
+
+        state = self.state
+        for c in text.lower():
+            if boundary and accepting[state] and not _is_word(c):
+                self.matched = True
+                return True
+
+            next_state = transitions.get((state, c))
+            if next_state is None:
+                next_state = matcher._transition(state, c)
+            state = next_state
+
+            if not boundary and accepting[state]:
+                self.matched = True
+                return True
+
+        self.state = state
+        return False
+
+    def finish(self) -> bool:
+        """Ends the text, returning whether anything matched (a match may end right at the end of the text)."""
+        if self.matcher.word_boundary and self.matcher.accepting[self.state]:
+            self.matched = True
+        return self.matched
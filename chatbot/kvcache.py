@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+import torch
+
+# legacy transformers cache format: one (key, value) pair per layer, each shaped (batch, heads, tokens, head_dim)
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def past_length(past: PastKeyValues) -> int:
+    return past[0][0].shape[-2]
+
+
+def past_nbytes(past: PastKeyValues) -> int:
+    return sum(key.nbytes + value.nbytes for key, value in past)
+
+
+def crop_past(past: PastKeyValues, length: int) -> PastKeyValues:
+    if length == past_length(past):
+        return past
+    return tuple((key[..., :length, :], value[..., :length, :]) for key, value in past)
+
+
+def common_prefix(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class KVCacheEntry(NamedTuple):
+    ids: List[int]
+    past: PastKeyValues
+    nbytes: int
+
+
+class KVCacheStore(object):
+    """Keeps the attention keys/values of each conversation's last prompt so the next turn only has to
+    prefill the tokens that changed.
+
+    Entries are keyed by conversation id and hold the token ids the cache was computed for. Least
+    recently used entries are evicted once the cached tensors take more than `max_bytes`. A `root`
+    entry, usually the preamble every prompt starts with, is shared by all conversations, never evicted
+    and not counted against the budget.
+
+    Generation never modifies cached tensors in place (new keys/values are concatenated into new
+    tensors), so an entry's tensors can be handed out without copying and stay shared until a
+    conversation's next generation writes its own.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, KVCacheEntry] = OrderedDict()
+        self.nbytes = 0
+        self.root: Optional[KVCacheEntry] = None
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(self, key: str, ids: List[int]) -> Tuple[int, Optional[PastKeyValues]]:
+        """Returns the number of leading `ids` that are already cached for `key` and their keys/values.
+
+        At least the last token is always left uncached, since generation needs one token to run.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        length, best = 0, None
+        for candidate in (entry, self.root):
+            if candidate is None:
+                continue
+
+            candidate_length = min(common_prefix(candidate.ids, ids), len(ids) - 1)
+            if candidate_length > length:
+                length, best = candidate_length, candidate
+
+        if best is None:
+            self.misses += 1
+            return 0, None
+
+        self.hits += 1
+        self.reused_tokens += length
+        return length, crop_past(best.past, length)
+
+    def store(self, key: str, ids: List[int], past: PastKeyValues):
+        """Caches `past`, the keys/values of `ids`, for `key`, replacing whatever was there."""
+        ids = ids[: past_length(past)]
+        entry = KVCacheEntry(ids, past, past_nbytes(past))
+
+        with self.lock:
+            self._remove(key)
+            if entry.nbytes > self.max_bytes:
+                return
+
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def set_root(self, ids: List[int], past: PastKeyValues):
+        ids = ids[: past_length(past)]
+        self.root = KVCacheEntry(ids, past, past_nbytes(past))
+
+    def evict(self, key: str):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def __len__(self) -> int:
+        return len(self.entries)
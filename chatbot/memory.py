@@ -0,0 +1,135 @@
+import gc
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import List
+
+import torch
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+try:
+    import resource
+
+    _page_size = resource.getpagesize()
+except ImportError:
+    _page_size = 4096
+
+
+def rss_bytes() -> int:
+    """Resident memory of this process, 0 where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _page_size
+    except OSError:
+        return 0
+
+
+metrics.gauge("rss_bytes", rss_bytes)
+if torch.cuda.is_available():
+    metrics.gauge("cuda_allocated_bytes", torch.cuda.memory_allocated)
+    metrics.gauge("cuda_reserved_bytes", torch.cuda.memory_reserved)
+
+
+class MemoryManager(object):
+    """Decides when to run `gc.collect()` and `torch.cuda.empty_cache()`, instead of after every request.
+
+    Both are slow, and emptying the CUDA cache makes the allocator grow it back on the next request. So they
+    only run once memory is under pressure: more than `max_reserved` of the GPU reserved with at least
+    `min_trim` of it cached but unused, or the process grown by `max_rss_growth` since the last collection.
+    After `idle` seconds without requests, they run once more to hand memory back while nothing needs it.
+    """
+
+    def __init__(
+        self,
+        gpu: bool,
+        max_reserved: float = 0.9,
+        min_trim: int = 256 * 1024**2,
+        max_rss_growth: int = 1024**3,
+        idle: float = 30.0,
+    ):
+        self.gpu = gpu
+        self.max_reserved = max_reserved
+        self.min_trim = min_trim
+        self.max_rss_growth = max_rss_growth
+        self.idle = idle
+
+        self.total = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory if gpu else 0
+        self.baseline = rss_bytes()
+        self.active = 0
+        self.last_active = time.monotonic()
+        self.trimmed = True
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+
+        self.collections = {"pressure": 0, "idle": 0}
+
+        if idle > 0:
+            threading.Thread(target=self._watch_idle, name="memory-idle", daemon=True).start()
+
+    @contextmanager
+    def request(self):
+        """Wraps a request, collecting afterwards if it left memory under pressure."""
+        with self.lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.last_active = time.monotonic()
+                self.trimmed = False
+            if self.under_pressure():
+                self.collect("pressure")
+
+    def under_pressure(self) -> bool:
+        if self.gpu:
+            reserved = torch.cuda.memory_reserved()
+            if reserved > self.max_reserved * self.total and reserved - torch.cuda.memory_allocated() >= self.min_trim:
+                return True
+        return rss_bytes() - self.baseline > self.max_rss_growth
+
+    def collect(self, reason: str):
+        with metrics.span("cleanup"):
+            gc.collect()
+            if self.gpu:
+                torch.cuda.empty_cache()
+        # memory still in use now (e.g. a growing KV cache) shouldn't count as pressure next time
+        self.baseline = rss_bytes()
+        self.collections[reason] += 1
+        metrics.inc(f"memory_collections_{reason}")
+        logger.debug(f"Collected memory ({reason}), RSS {self.baseline / 2**20:.0f} MiB")
+
+    def _watch_idle(self):
+        while not self.closed.wait(self.idle / 2):
+            with self.lock:
+                idle = self.active == 0 and not self.trimmed and time.monotonic() - self.last_active > self.idle
+                if idle:
+                    self.trimmed = True
+            if idle:
+                self.collect("idle")
+
+    def close(self):
+        self.closed.set()
+
+
+class InputBuffer(object):
+    """Reuses one preallocated `input_ids` tensor per thread instead of building a new one for every prompt,
+    growing it when a longer prompt comes along."""
+
+    def __init__(self, length: int):
+        self.length = length
+        self.local = threading.local()
+
+    def fill(self, ids: List[int]) -> torch.LongTensor:
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None or buffer.shape[-1] < len(ids):
+            buffer = self.local.buffer = torch.empty((1, max(self.length, len(ids))), dtype=torch.long)
+
+        # assigning through numpy copies the list straight in, without an intermediate tensor
+        buffer.numpy()[0, : len(ids)] = ids
+        return buffer[:, : len(ids)]
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the span histogram buckets, in seconds
+buckets = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0]
+
+_noop = nullcontext()
+
+GaugeKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class _Histogram(object):
+    __slots__ = ("count", "sum", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = [0] * (len(buckets) + 1)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.buckets[bisect.bisect_left(buckets, seconds)] += 1
+
+
+class Metrics(object):
+    """Timing spans, counters and gauges for the generation pipeline, rendered in the Prometheus text format
+    or as a structured log line.
+
+    While disabled, `span` hands out a shared no-op context manager and `inc`/`observe` return right away, so
+    instrumentation left in hot paths costs an attribute check. Gauges are callbacks read when rendering.
+    """
+
+    def __init__(self, enabled: bool = False, prefix: str = "chatbot"):
+        self.enabled = enabled
+        self.prefix = prefix
+
+        self.histograms: Dict[str, _Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[GaugeKey, Callable[[], float]] = {}
+        self.lock = threading.Lock()
+
+    def span(self, name: str):
+        """Times the `with` block into the `name` histogram."""
+        if not self.enabled:
+            return _noop
+        return self._span(name)
+
+    @contextmanager
+    def _span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = _Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name: str, amount: float = 1):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name: str, read: Callable[[], float], **labels: str) -> GaugeKey:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = read
+        return key
+
+    def remove_gauge(self, key: GaugeKey):
+        with self.lock:
+            self.gauges.pop(key, None)
+
+    def _read_gauges(self) -> List[Tuple[GaugeKey, float]]:
+        with self.lock:
+            gauges = list(self.gauges.items())
+
+        values = []
+        for key, read in gauges:
+            try:
+                values.append((key, float(read())))
+            except Exception as exc:
+                logger.debug(f"Failed to read gauge {key[0]}: {exc}")
+        return values
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            histograms = [(name, histogram.count, histogram.sum, list(histogram.buckets)) for name, histogram in sorted(self.histograms.items())]
+            counters = sorted(self.counters.items())
+
+        for name, count, total, counts in histograms:
+            metric = f"{self.prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket in zip(buckets + [float("inf")], counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+            lines.append(f"{metric}_sum {total}")
+            lines.append(f"{metric}_count {count}")
+
+        for name, value in counters:
+            lines.append(f"# TYPE {self.prefix}_{name}_total counter")
+            lines.append(f"{self.prefix}_{name}_total {value}")
+
+        typed = set()
+        for (name, labels), value in sorted(self._read_gauges()):
+            metric = f"{self.prefix}_{name}"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} gauge")
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            lines.append(f"{metric}{{{label_text}}} {value}" if labels else f"{metric} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Span counts and mean milliseconds, counters and gauges, for logging."""
+        with self.lock:
+            spans = {name: {"count": h.count, "mean_ms": round(h.sum / h.count * 1e3, 3)} for name, h in self.histograms.items() if h.count}
+            counters = dict(self.counters)
+
+        gauges = {name + "".join(f"[{value}]" for _, value in labels): value for (name, labels), value in self._read_gauges()}
+        return {"spans": spans, "counters": counters, "gauges": gauges}
+
+    def log_periodically(self, interval: float, log: logging.Logger = logger):
+        """Logs a `snapshot` to `log` every `interval` seconds from a background thread."""
+
+        def run():
+            while True:
+                time.sleep(interval)
+                log.info(f"metrics {json.dumps(self.snapshot())}")
+
+        threading.Thread(target=run, name="metrics-log", daemon=True).start()
+
+
+metrics = Metrics(enabled=os.getenv("CHATBOT_METRICS", "") not in ("", "0"))
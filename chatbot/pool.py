@@ -0,0 +1,291 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Optional
+
+from .chatbot import Budget, CancellationToken, Chatbot, Conversation, UpdateFunc
+from .metrics import metrics
+from .remote import RemoteChatbot
+
+logger = logging.getLogger(__name__)
+
+# so the replicas can import this package however the parent process found it
+package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _process_rss(pid: int) -> Optional[int]:
+    """Resident memory of process `pid` in bytes, None where /proc isn't available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _available_memory() -> Optional[int]:
+    """Memory that can be allocated without swapping in bytes, None where /proc isn't available."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Replica(object):
+    def __init__(self, index: int, path: str):
+        self.index = index
+        self.path = path
+        self.process: Optional[subprocess.Popen] = None
+        self.client: Optional[RemoteChatbot] = None
+        self.ready = False
+        self.started = 0.0
+        self.restarts = 0
+
+        # conversations routed here
+        self.conversations = 0
+
+        self.active = 0
+        self.requests = 0
+        self.busy = 0.0
+        self.busy_since: Optional[float] = None
+
+    def busy_time(self, now: float) -> float:
+        """Seconds spent with at least one request running."""
+        return self.busy + (now - self.busy_since if self.busy_since is not None else 0.0)
+
+
+class ReplicaPool(Chatbot):
+    """Generates responses with `replicas` model server processes, so that channels are served on several
+    cores in parallel instead of taking turns in one interpreter.
+
+    Each replica is a `python -m chatbot.server` on a Unix socket, with `threads` torch threads (an even share
+    of the cores by default). Conversations stick to the replica that first served them, where their KV cache
+    lives, and new conversations go to the replica with the fewest.
+
+    Every replica holds its own copy of the weights in the dtype it computes in, so memory grows with
+    `replicas`. The first replica is started alone and the others only if its resident size times the
+    number of replicas still fits in the available memory, otherwise the pool refuses to start.
+
+    A replica that dies is restarted with a growing delay. Meanwhile its conversations move to the other
+    replicas, and requests that were running on it are retried on another one unless they had already
+    streamed part of their reply.
+    """
+
+    def _init_model(
+        self,
+        settings: str = "gpt2",
+        replicas: int = 2,
+        threads: Optional[int] = None,
+        max_concurrency: int = 1,
+        server_args: List[str] = [],
+        timeout: float = 120.0,
+        start_timeout: float = 600.0,
+    ):
+        self.settings = settings
+        self.threads = threads or max(1, (os.cpu_count() or 1) // replicas)
+        self.max_concurrency = max_concurrency
+        self.server_args = server_args
+        self.timeout = timeout
+
+        self.dir = tempfile.mkdtemp(prefix="chatbot-replicas-")
+        self.preamble_path = os.path.join(self.dir, "preamble.txt")
+        with open(self.preamble_path, "w", encoding="utf-8") as f:
+            f.write(self.preamble)
+
+        self.replicas = [Replica(i, os.path.join(self.dir, f"replica{i}.sock")) for i in range(replicas)]
+        self.routes: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+
+        self.gauges = []
+        for replica in self.replicas:
+            labels = {"replica": str(replica.index)}
+            self.gauges.append(metrics.gauge("replica_up", lambda replica=replica: replica.ready, **labels))
+            self.gauges.append(metrics.gauge("replica_requests", lambda replica=replica: replica.requests, **labels))
+            self.gauges.append(metrics.gauge("replica_busy_seconds", lambda replica=replica: replica.busy_time(time.monotonic()), **labels))
+
+        deadline = time.monotonic() + start_timeout
+        first = self.replicas[0]
+        self._spawn(first)
+        self._wait_ready([first], deadline)
+        if not first.ready:
+            self.unload()
+            raise RuntimeError(f"no model replica was ready within {start_timeout:.0f}s")
+        self._check_memory(first, replicas)
+
+        for replica in self.replicas[1:]:
+            self._spawn(replica)
+        self._wait_ready(self.replicas, deadline)
+
+        self.started = time.monotonic()
+        logger.info(f"{sum(replica.ready for replica in self.replicas)}/{replicas} replicas ready with {self.threads} threads each")
+        threading.Thread(target=self._monitor, name="replica-monitor", daemon=True).start()
+
+    def _spawn(self, replica: Replica):
+        command = [sys.executable, "-m", "chatbot.server", "--settings", self.settings, "--name", self.name]
+        command += ["--preamble-file", self.preamble_path, "--socket", replica.path]
+        command += ["--threads", str(self.threads), "--max-concurrency", str(self.max_concurrency), *self.server_args]
+
+        env = dict(os.environ, OMP_NUM_THREADS=str(self.threads))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [package_root, env.get("PYTHONPATH")]))
+
+        replica.process = subprocess.Popen(command, env=env)
+        replica.client = RemoteChatbot(name=self.name, preamble=self.preamble, url=f"unix:{replica.path}", timeout=self.timeout)
+        replica.started = time.monotonic()
+        logger.info(f"Started replica {replica.index} (pid {replica.process.pid})")
+
+    def _wait_ready(self, replicas: List[Replica], deadline: float):
+        while time.monotonic() < deadline and not all(replica.ready for replica in replicas):
+            self._check()
+            time.sleep(0.5)
+
+    def _check_memory(self, first: Replica, replicas: int):
+        """Refuses to start more replicas than fit in memory, judging by the size of the first one."""
+        size = _process_rss(first.process.pid)
+        available = _available_memory()
+        if size is None or available is None or size * (replicas - 1) <= available:
+            return
+
+        fits = 1 + available // size
+        self.unload()
+        raise ValueError(
+            f"{replicas} replicas need about {size * replicas / 2**30:.1f} GiB, {size / 2**30:.1f} GiB each, "
+            f"but only {(available + size) / 2**30:.1f} GiB is available, use at most {fits}"
+        )
+
+    def _check(self):
+        for replica in self.replicas:
+            if replica.process is None:
+                continue
+            code = replica.process.poll()
+            if code is not None:
+                if replica.ready:
+                    logger.warning(f"Replica {replica.index} exited with code {code}, moving its conversations")
+                    replica.ready = False
+                # restarts back off, so a replica that can't load doesn't spin
+                if time.monotonic() - replica.started > min(60, 2**replica.restarts) and not self.closed.is_set():
+                    replica.restarts += 1
+                    self._spawn(replica)
+            elif not replica.ready and replica.client.ready():
+                replica.ready = True
+                logger.info(f"Replica {replica.index} ready")
+
+    def _monitor(self):
+        while not self.closed.wait(1.0):
+            self._check()
+
+    def _route(self, convo_id: str) -> Replica:
+        with self.lock:
+            index = self.routes.get(convo_id)
+            if index is not None and self.replicas[index].ready:
+                return self.replicas[index]
+
+            live = [replica for replica in self.replicas if replica.ready]
+            if not live:
+                raise RuntimeError("no model replica is running")
+
+            replica = min(live, key=lambda replica: replica.conversations)
+            if index is not None:
+                self.replicas[index].conversations -= 1
+            self.routes[convo_id] = replica.index
+            replica.conversations += 1
+            return replica
+
+    def _begin(self, replica: Replica):
+        with self.lock:
+            replica.active += 1
+            if replica.active == 1:
+                replica.busy_since = time.monotonic()
+
+    def _end(self, replica: Replica):
+        with self.lock:
+            replica.active -= 1
+            replica.requests += 1
+            if replica.active == 0:
+                replica.busy += time.monotonic() - replica.busy_since
+                replica.busy_since = None
+
+    def _died(self, replica: Replica) -> bool:
+        try:
+            replica.process.wait(timeout=1.0)
+        except subprocess.TimeoutExpired:
+            return False
+
+        replica.ready = False
+        return True
+
+    def _generate(self, convo: Conversation, update: UpdateFunc, cancel: Optional[CancellationToken] = None, budget: Optional[Budget] = None):
+        streamed = False
+
+        def _update(response: str):
+            nonlocal streamed
+            streamed = True
+            update(response)
+
+        for attempt in range(len(self.replicas)):
+            replica = self._route(convo.id)
+            self._begin(replica)
+            try:
+                replica.client._generate(convo, _update, cancel, budget)
+                return
+            except OSError:
+                # a request that failed without its replica dying would fail on any other replica too, and one
+                # that already streamed part of a reply can't be started over
+                if streamed or not self._died(replica):
+                    raise
+                logger.warning(f"Replica {replica.index} died serving {convo.id}, retrying on another replica")
+            finally:
+                self._end(replica)
+
+        raise RuntimeError("every model replica died")
+
+    def model_max_length(self) -> str:
+        for replica in self.replicas:
+            if replica.ready:
+                return replica.client.model_max_length()
+        return "?"
+
+    def stats(self) -> List[dict]:
+        """Per replica: whether it's up, conversations routed to it, requests served, the fraction of the time
+        since the pool was ready it spent generating, and restarts."""
+        now = time.monotonic()
+        with self.lock:
+            return [
+                {
+                    "replica": replica.index,
+                    "up": replica.ready,
+                    "conversations": replica.conversations,
+                    "requests": replica.requests,
+                    "utilization": replica.busy_time(now) / (now - self.started),
+                    "restarts": replica.restarts,
+                }
+                for replica in self.replicas
+            ]
+
+    def unload(self):
+        self.closed.set()
+        for key in self.gauges:
+            metrics.remove_gauge(key)
+        for replica in self.replicas:
+            replica.ready = False
+            if replica.process is not None and replica.process.poll() is None:
+                replica.process.terminate()
+        for replica in self.replicas:
+            if replica.process is None:
+                continue
+            try:
+                replica.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                replica.process.kill()
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -0,0 +1,84 @@
+import os
+from typing import Dict, NamedTuple, Optional
+
+
+class TransformerSettings(NamedTuple):
+    model_name: str
+    temperature: float
+    top_p: float
+    top_k: int
+    repetition_penalty: float
+    # replies stop after `max_outlen` tokens or `max_seconds` of generation, whichever comes first, and the
+    # context window keeps room for `max_outlen` tokens
+    max_outlen: int = 12
+    max_seconds: Optional[float] = 60.0
+    # "fp32", "fp16", "bf16" or "int8", None for fp16 on GPU and fp32 on CPU
+    quantization: Optional[str] = None
+    # smaller model sharing the tokenizer that drafts `num_draft_tokens` tokens at a time for speculative decoding
+    draft_model: Optional[str] = None
+    num_draft_tokens: int = 5
+
+
+gpt2 = TransformerSettings(model_name="gpt2", temperature=0.8, top_p=1.0, top_k=None, repetition_penalty=1.2, max_outlen=96)
+
+gpt2Medium = TransformerSettings(model_name="gpt2-medium", temperature=1.0, top_p=0.90, top_k=None, repetition_penalty=1.33, max_outlen=96)
+
+gpt2Large = TransformerSettings(model_name="gpt2-large", temperature=1.0, top_p=0.9, top_k=None, repetition_penalty=1.33, max_outlen=96)
+
+gpt2XL = TransformerSettings(
+    model_name="gpt2-xl",
+    temperature=1.0,
+    top_p=0.9,
+    top_k=None,
+    repetition_penalty=1.33,
+    max_outlen=96,
+)
+
+gptDistil = TransformerSettings(model_name="distilgpt2", temperature=0.8, top_p=0.9, top_k=None, repetition_penalty=1.2, max_outlen=96)
+
+gptNeoSmall = TransformerSettings(
+    model_name="EleutherAI/gpt-neo-125M",
+    temperature=1.1,
+    top_p=0.9,
+    top_k=None,
+    repetition_penalty=1.2,
+    max_outlen=128,
+)
+
+gptNeo = TransformerSettings(
+    model_name="EleutherAI/gpt-neo-1.3B",
+    temperature=1.1,
+    top_p=0.9,
+    top_k=None,
+    repetition_penalty=3.0,
+    max_outlen=128,
+)
+
+# the big models with their small siblings drafting for them
+gpt2XLSpeculative = gpt2XL._replace(draft_model=gptDistil.model_name)
+gptNeoSpeculative = gptNeo._replace(draft_model=gptNeoSmall.model_name)
+
+gptJ = TransformerSettings(
+    model_name="EleutherAI/gpt-j-6B",
+    temperature=0.7,
+    top_p=None,
+    top_k=None,
+    repetition_penalty=1.0,
+    max_outlen=128,
+)
+
+llama7b = TransformerSettings(model_name=f"{os.path.expanduser('~')}/scratch/llama_hf-7b", temperature=0.7, top_p=None, top_k=None, repetition_penalty=1.1, max_outlen=64)
+llama13b = TransformerSettings(model_name=f"{os.path.expanduser('~')}/scratch/llama_hf-13b", temperature=0.7, top_p=None, top_k=None, repetition_penalty=1.1, max_outlen=512)
+llama27b = TransformerSettings(model_name="meta-llama/Llama-2-7b-hf", temperature=0.7, top_p=None, top_k=None, repetition_penalty=1.1, max_outlen=512)
+
+alpaca7b = TransformerSettings(model_name=f"chavinlo/alpaca-native", temperature=0.7, top_p=None, top_k=None, repetition_penalty=1.1, max_outlen=512)
+
+
+def batch_size(settings: TransformerSettings, max_batch_size: int) -> int:
+    """The batch size to load `settings` with when up to `max_batch_size` is wanted: presets with a draft model
+    decode one sequence at a time, their requests take turns instead."""
+    return 1 if settings.draft_model is not None else max_batch_size
+
+
+def named_presets() -> Dict[str, TransformerSettings]:
+    return {name: value for name, value in globals().items() if isinstance(value, TransformerSettings)}
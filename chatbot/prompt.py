@@ -0,0 +1,94 @@
+from array import array
+from typing import Callable, Dict, List, Optional
+
+import arrow
+
+from .conversation import ChatbotMessage, Conversation
+from .metrics import metrics
+
+# how message times are shown in prompts, see PromptRenderer
+time_formats: Dict[str, Callable[[float], str]] = {
+    "clock": lambda timestamp: arrow.get(timestamp).format("HH:mm UTC"),
+    "date": lambda timestamp: arrow.get(timestamp).format("YYYY-MM-DD HH:mm UTC"),
+    "humanize": lambda timestamp: arrow.get(timestamp).humanize(),
+}
+
+# formats that show a message the same way however long ago it was sent
+stable_time_formats = {"clock", "date"}
+
+
+class PromptRenderer(object):
+    """Turns conversations into prompt token ids: the preamble, a line per message, then the reply header.
+
+    Each message is tokenized once and its ids are kept on the message (`ChatbotMessage.rendered`) as a
+    compact array, so building a prompt only concatenates arrays. With a stable `time_format` a message's
+    ids never change, which also keeps prompts' prefixes (and their KV cache entries) valid from turn to
+    turn. `humanize` shows times relative to now: its messages are re-rendered whenever their relative
+    time changes, and the window has to be recounted every turn (see `stable`).
+    """
+
+    def __init__(self, encode: Callable[[str], List[int]], preamble: str, preamble_ids: List[int], name: str, time_format: str = "clock"):
+        if time_format not in time_formats:
+            raise ValueError(f"unknown time format {time_format!r}, expected one of {', '.join(time_formats)}")
+
+        self.encode = encode
+        self.preamble = preamble
+        self.preamble_ids = preamble_ids
+        self.name = name
+        self.format_time = time_formats[time_format]
+        self.stable = time_format in stable_time_formats
+
+        # marks the ids this renderer cached, messages can be rendered by several models' renderers over time
+        self.key = object()
+        self.header: Optional[tuple] = None
+
+    def format_message(self, message: ChatbotMessage, time: Optional[str] = None) -> str:
+        time = self.format_time(message.timestamp) if time is None else time
+        # whitespace before the line's newline would tokenize differently on its own than followed by the next
+        # line, so it is dropped to keep the cached ids equal to tokenizing the whole prompt
+        return f"[{time}]<{message.sender}>{message.message.rstrip()}\n"
+
+    def message_ids(self, message: ChatbotMessage) -> array:
+        cached = message.rendered
+        time = None
+        if not self.stable:
+            time = self.format_time(message.timestamp)
+        if cached is not None and cached[0] is self.key and cached[1] == time:
+            return cached[2]
+
+        with metrics.span("tokenize"):
+            ids = array("l", self.encode(self.format_message(message, time)))
+        message.rendered = (self.key, time, ids)
+        return ids
+
+    def count(self, message: ChatbotMessage) -> int:
+        return len(self.message_ids(message))
+
+    def header_ids(self, now: Optional[float] = None) -> List[int]:
+        """Ids of the header the reply follows, `[time]<name>`."""
+        time = self.format_time(arrow.utcnow().timestamp() if now is None else now)
+        if self.header is None or self.header[0] != time:
+            with metrics.span("tokenize"):
+                self.header = (time, self.encode(f"[{time}]<{self.name}>"))
+        return self.header[1]
+
+    def render(self, convo: Conversation, overflow: int = 0, end: Optional[int] = None) -> List[int]:
+        """The prompt for the messages in `convo`'s window up to `end`, with the newest one shortened by
+        `overflow` tokens when it doesn't fit the window on its own (see `Conversation.fit_window`)."""
+        messages = convo.get_queue(end)
+        ids = list(self.preamble_ids)
+        for message in messages[:-1]:
+            ids.extend(self.message_ids(message))
+        if messages:
+            newest = self.message_ids(messages[-1])
+            if overflow > 0:
+                # keep its header and its closing newline
+                newest = newest[: max(1, len(newest) - overflow - 1)] + newest[-1:]
+            ids.extend(newest)
+        ids.extend(self.header_ids())
+        return ids
+
+    def text(self, convo: Conversation) -> str:
+        """The prompt `render` encodes, as text."""
+        messages = "".join(self.format_message(message) for message in convo.queue)
+        return f"{self.preamble}\n{messages}[{self.format_time(arrow.utcnow().timestamp())}]<{self.name}>"
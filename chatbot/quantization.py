@@ -0,0 +1,38 @@
+import torch
+from transformers.pytorch_utils import Conv1D
+
+# TransformerSettings.quantization values and the dtype the weights are loaded in for each
+dtypes = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+    "int8": torch.float32,
+}
+
+
+def default_quantization(gpu: bool) -> str:
+    # fp16 halves memory on GPUs, but on CPUs most ops have no fast fp16 kernels
+    return "fp16" if gpu else "fp32"
+
+
+def conv1d_to_linear(module: torch.nn.Module) -> torch.nn.Module:
+    """Replaces the GPT-2 style `Conv1D` layers in `module` with equivalent `nn.Linear` layers, which
+    dynamic quantization knows how to handle."""
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features, dtype=child.weight.dtype)
+            linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous())
+            linear.bias = torch.nn.Parameter(child.bias.detach())
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+
+    return module
+
+
+def quantize_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """Dynamically quantizes the linear layers of a CPU model to int8: weights are stored as int8 and
+    activations are quantized on the fly, everything else stays fp32."""
+    conv1d_to_linear(model)
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
@@ -0,0 +1,122 @@
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from .chatbot import Chatbot
+
+logger = logging.getLogger(__name__)
+
+
+class _Resident(object):
+    def __init__(self, model: Chatbot, nbytes: int):
+        self.model = model
+        self.nbytes = nbytes
+        self.users = 0
+
+
+class ModelRegistry(object):
+    """Loads (and warms up) models by name on first use and keeps the most recently used ones resident.
+
+    Models take `Chatbot.memory_footprint` bytes each, and once the resident models take more than `max_bytes`
+    the least recently used ones are unloaded. A model is never unloaded while in use (between `acquire` and
+    `release`), so the budget can be exceeded if every resident model is busy. Once a model has been loaded,
+    its footprint is remembered and room is made for it before it's loaded again.
+    """
+
+    def __init__(self, load: Callable[[str], Chatbot], names: List[str], max_bytes: int):
+        self.load = load
+        self.names = names
+        self.max_bytes = max_bytes
+
+        self.resident: OrderedDict[str, _Resident] = OrderedDict()
+        self.footprints: Dict[str, int] = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        # held while a model loads, so concurrent first uses of a model only load it once
+        self.loading: Dict[str, threading.Lock] = {}
+
+        self.loads = 0
+        self.evictions = 0
+
+    def acquire(self, name: str) -> Chatbot:
+        """Returns the model called `name`, loading it if needed, which can take a while. Call `release`
+        once done with it."""
+        if name not in self.names:
+            raise KeyError(f"unknown model: {name}")
+
+        with self.lock:
+            loading = self.loading.setdefault(name, threading.Lock())
+
+        with loading:
+            with self.lock:
+                resident = self.resident.get(name)
+                if resident is not None:
+                    resident.users += 1
+                    self.resident.move_to_end(name)
+                    return resident.model
+
+                self._evict(self.footprints.get(name, 0))
+
+            logger.info(f"Loading model {name}")
+            model = self.load(name)
+            model.warmup()
+            nbytes = model.memory_footprint()
+            logger.info(f"Loaded model {name} ({nbytes / 2**30:.2f} GiB)")
+
+            with self.lock:
+                self.loads += 1
+                self.footprints[name] = nbytes
+                resident = _Resident(model, nbytes)
+                resident.users = 1
+                self.resident[name] = resident
+                self.nbytes += nbytes
+                self._evict(0)
+
+            return model
+
+    def release(self, name: str):
+        with self.lock:
+            resident = self.resident.get(name)
+            if resident is not None:
+                resident.users -= 1
+
+    @contextmanager
+    def use(self, name: str):
+        model = self.acquire(name)
+        try:
+            yield model
+        finally:
+            self.release(name)
+
+    def get_loaded(self, name: str) -> Optional[Chatbot]:
+        """The model called `name` if it's resident, without loading it or counting it as used."""
+        with self.lock:
+            resident = self.resident.get(name)
+            return resident.model if resident is not None else None
+
+    def _evict(self, needed: int):
+        for name in list(self.resident):
+            if self.nbytes + needed <= self.max_bytes:
+                return
+
+            resident = self.resident[name]
+            if resident.users > 0:
+                continue
+
+            logger.info(f"Unloading model {name} to free {resident.nbytes / 2**30:.2f} GiB")
+            del self.resident[name]
+            self.nbytes -= resident.nbytes
+            self.evictions += 1
+            resident.model.unload()
+
+        if self.nbytes + needed > self.max_bytes:
+            logger.warning(f"Models in use take {self.nbytes / 2**30:.2f} GiB, over the {self.max_bytes / 2**30:.2f} GiB budget")
+
+    def close(self):
+        with self.lock:
+            for resident in self.resident.values():
+                resident.model.unload()
+            self.resident.clear()
+            self.nbytes = 0
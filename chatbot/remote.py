@@ -0,0 +1,144 @@
+import json
+import socket
+import logging
+import threading
+import http.client
+from typing import Optional
+from urllib.parse import urlsplit
+
+from .chatbot import Budget, Cancelled, CancellationToken, Chatbot, Conversation, UpdateFunc
+from .service import QueueFull
+
+logger = logging.getLogger(__name__)
+
+
+def window_to_dict(convo: Conversation) -> dict:
+    """The window of `convo` as `chatbot.server.conversation_from_dict` takes it."""
+    queue = convo.queue
+    # pinned messages that already left the window are sent first, ahead of the window itself
+    old_pinned = len(queue) - (len(convo) - convo.start_offset)
+    pinned = list(range(old_pinned)) + [old_pinned + idx - convo.start_offset for idx in convo.pinned if idx >= convo.start_offset]
+    return {"id": convo.id, "messages": [message.to_dict() for message in queue], "pinned": pinned, "dequeued_pins": old_pinned}
+
+
+def _close_on_cancel(conn: http.client.HTTPConnection, cancel: CancellationToken, done: threading.Event):
+    """Shuts down `conn`'s socket once `cancel` is cancelled, unless `done` is set first. That wakes up the
+    blocked read, and the server sees the connection close and cancels the generation."""
+    while not done.is_set():
+        if cancel.event.wait(0.05):
+            if not done.is_set() and conn.sock is not None:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            return
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class RemoteChatbot(Chatbot):
+    """A `Chatbot` whose responses are generated by a `chatbot.server` process.
+
+    `url` is either `http://host:port` or `unix:/path/to/socket`. Only the conversation's current window is
+    sent with each request, and messages the server drops to fit its context are dequeued here too.
+    """
+
+    def _init_model(self, url: str = "http://127.0.0.1:8765", timeout: float = 120.0):
+        self.url = url
+        self.timeout = timeout
+        self.max_length: Optional[str] = None
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.url.startswith("unix:"):
+            return UnixHTTPConnection(self.url[len("unix:") :], timeout=self.timeout)
+
+        parts = urlsplit(self.url)
+        return http.client.HTTPConnection(parts.hostname, parts.port, timeout=self.timeout)
+
+    def ready(self) -> bool:
+        """Whether the server is up and has loaded its model."""
+        conn = self._connect()
+        try:
+            conn.request("GET", "/ready")
+            response = conn.getresponse()
+            info = json.loads(response.read())
+        except (OSError, ValueError):
+            return False
+        finally:
+            conn.close()
+
+        if response.status != 200:
+            return False
+
+        self.max_length = info["max_length"]
+        if info["name"] != self.name:
+            logger.warning(f"Model server is serving {info['name']}, not {self.name}")
+        return True
+
+    def model_max_length(self) -> str:
+        if self.max_length is None and not self.ready():
+            return "?"
+        return self.max_length
+
+    def _generate(self, convo: Conversation, update: UpdateFunc, cancel: Optional[CancellationToken] = None, budget: Optional[Budget] = None):
+        body = window_to_dict(convo)
+        if budget is not None:
+            body["budget"] = budget._asdict()
+        body = json.dumps(body)
+
+        conn = self._connect()
+        done = threading.Event()
+        try:
+            conn.request("POST", "/generate", body=body, headers={"Content-Type": "application/json"})
+            if cancel is not None:
+                # reads block until the server sends something, which it doesn't while the request is queued
+                threading.Thread(target=_close_on_cancel, args=(conn, cancel, done), name="remote-cancel", daemon=True).start()
+            try:
+                self._read_events(conn, convo, update)
+            except (OSError, http.client.HTTPException):
+                if cancel is not None and cancel.cancelled:
+                    return
+                raise
+        finally:
+            done.set()
+            conn.close()
+
+    def _read_events(self, conn: http.client.HTTPConnection, convo: Conversation, update: UpdateFunc):
+        response = conn.getresponse()
+        if response.status != 200:
+            raise ConnectionError(f"model server returned {response.status}: {response.read().decode('utf-8', 'replace')}")
+
+        shown = ""
+        for line in response:
+            event = json.loads(line)
+            if event["event"] == "update":
+                shown = event["response"]
+                update(shown)
+            elif event["event"] == "done":
+                if event["response"] != shown:
+                    update(event["response"])
+                # the server drops the oldest dequeued pins first, then dequeues
+                old_pins = [idx for idx in convo.pinned if idx < convo.start_offset]
+                for idx in old_pins[: event["unpinned"]]:
+                    convo.unpin(idx)
+                for _ in range(event["dequeued"]):
+                    convo.dequeue()
+                return
+            elif event["error"] == "busy":
+                raise QueueFull(event["depth"])
+            elif event["error"] == "cancelled":
+                raise Cancelled()
+            else:
+                raise RuntimeError(f"model server failed: {event.get('message')}")
+
+        raise ConnectionError("model server closed the connection mid-response")
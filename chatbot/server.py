@@ -0,0 +1,317 @@
+import json
+import asyncio
+import logging
+import argparse
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+from .chatbot import Budget, BruhChatbot, Cancelled, Chatbot, ChatbotMessage, Conversation
+from .service import InferenceService, QueueFull
+from .startup import startup
+from .metrics import metrics
+from .prompt import time_formats
+
+logger = logging.getLogger(__name__)
+
+
+def conversation_from_dict(data: dict) -> Conversation:
+    """Rebuilds the window of a conversation sent by `RemoteChatbot`, without logging it anywhere.
+
+    `data` holds the window's `messages`, the positions of the `pinned` ones and how many of those come first
+    because they were already dequeued (`dequeued_pins`)."""
+    convo = Conversation(data["id"])
+    for message in data["messages"]:
+        convo.add_message(ChatbotMessage(message["sender"], message["message"], message["timestamp"]))
+    for idx in data.get("pinned", []):
+        convo.pin(idx)
+    for _ in range(data.get("dequeued_pins", 0)):
+        convo.dequeue()
+
+    return convo
+
+
+def window_indices(convo: Conversation) -> List[int]:
+    """The index in `convo` of each message in its window."""
+    return [idx for idx in convo.pinned if idx < convo.start_offset] + list(range(convo.start_offset, len(convo)))
+
+
+def sync_conversation(convo: Conversation, data: dict) -> bool:
+    """Brings `convo`, built for an earlier request, up to date with the window in `data`: messages that
+    changed are amended and new ones added, so the others keep their token counts and rendered ids.
+
+    Returns False, without touching `convo`, if the window doesn't continue `convo`'s, e.g. because the client
+    started the window over or `convo` was last used by another client.
+    """
+    window = convo.queue
+    messages = data["messages"]
+    indices = window_indices(convo)
+    pinned = set(data.get("pinned", []))
+    if len(window) > len(messages) or (window and window[0].to_dict() != messages[0]):
+        return False
+    if len(indices) - (len(convo) - convo.start_offset) != data.get("dequeued_pins", 0):
+        return False
+    if any(idx in convo.pinned and position not in pinned for position, idx in enumerate(indices)):
+        return False
+
+    for position, message in enumerate(messages):
+        if position < len(window):
+            if window[position].to_dict() != message:
+                convo.amend(indices[position], ChatbotMessage(message["sender"], message["message"], message["timestamp"]))
+        else:
+            convo.add_message(ChatbotMessage(message["sender"], message["message"], message["timestamp"]))
+            indices.append(len(convo) - 1)
+    for position in pinned:
+        if indices[position] not in convo.pinned:
+            convo.pin(indices[position])
+
+    return True
+
+
+class ModelServer(object):
+    """Serves a `Chatbot` over HTTP so frontends can share one loaded model and restart without reloading it.
+
+    `POST /generate` takes a conversation window (see `conversation_from_dict`), optionally with a `budget`
+    object holding `Budget`'s fields, and streams newline-delimited
+    JSON events back: `{"event": "update", "response": ...}` with the response so far as it is generated,
+    then one of `{"event": "done", "response": ..., "dequeued": ..., "unpinned": ...}`, where `dequeued` counts
+    the messages dropped from the front of the window to fit the context and `unpinned` the oldest dequeued
+    pins dropped with them, or `{"event": "error", "error": ...}` with `busy`, `cancelled` or `internal`.
+    Closing the connection cancels the generation.
+
+    The conversations of the last `max_conversations` requests are kept, and a request continuing one of them
+    only adds its new or amended messages (see `sync_conversation`) instead of rebuilding the whole window.
+
+    The model is loaded and warmed up on a worker thread once the server is listening: `GET /health` answers as
+    soon as the process is up and `GET /ready` only once the model is ready. `GET /metrics` exports `metrics` in
+    the Prometheus text format.
+    """
+
+    def __init__(
+        self,
+        load_model: Callable[[], Chatbot],
+        max_concurrency: int = 1,
+        max_queue: int = 16,
+        adaptive_budget: bool = False,
+        max_conversations: int = 1024,
+    ):
+        self.load_model = load_model
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.adaptive_budget = adaptive_budget
+
+        self.max_conversations = max_conversations
+        self.conversations: OrderedDict[str, Conversation] = OrderedDict()
+        # conversations with a generation running, which mustn't change under it
+        self.busy: Dict[str, int] = {}
+
+        self.model: Optional[Chatbot] = None
+        self.inference: Optional[InferenceService] = None
+        self.load_error: Optional[BaseException] = None
+        self.loading: Optional[asyncio.Task] = None
+
+        self.app = web.Application()
+        self.app.add_routes(
+            [
+                web.get("/health", self.health),
+                web.get("/ready", self.ready),
+                web.post("/generate", self.generate),
+                web.get("/metrics", self.metrics),
+            ]
+        )
+        self.app.on_startup.append(self._start_loading)
+        self.app.on_cleanup.append(self._shutdown)
+
+    async def _start_loading(self, app: web.Application):
+        self.loading = asyncio.create_task(self._load())
+
+    async def _load(self):
+        logger.info("Loading model")
+        loop = asyncio.get_running_loop()
+        try:
+            model = await loop.run_in_executor(None, self.load_model)
+            await loop.run_in_executor(None, model.warmup)
+        except Exception as exc:
+            logger.exception(exc)
+            self.load_error = exc
+            return
+
+        self.model = model
+        self.inference = InferenceService(self.model, max_concurrency=self.max_concurrency, max_queue=self.max_queue, adaptive_budget=self.adaptive_budget)
+        logger.info(f"Model loaded, {startup.summary()}")
+
+    async def _shutdown(self, app: web.Application):
+        if self.inference is not None:
+            self.inference.shutdown()
+
+    async def health(self, request: web.Request) -> web.Response:
+        status = "error" if self.load_error is not None else "ok"
+        depth = self.inference.depth if self.inference is not None else 0
+        return web.json_response({"status": status, "ready": self.inference is not None, "queue": depth})
+
+    async def ready(self, request: web.Request) -> web.Response:
+        if self.inference is None:
+            return web.json_response({"ready": False}, status=503)
+
+        return web.json_response({"ready": True, "name": self.model.name, "max_length": self.model.model_max_length()})
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), headers={"Content-Type": "text/plain; version=0.0.4"})
+
+    async def generate(self, request: web.Request) -> web.StreamResponse:
+        if self.inference is None:
+            raise web.HTTPServiceUnavailable(text="model is not loaded yet")
+
+        data = await request.json()
+        convo = self._conversation(data)
+        start, pinned = convo.start_offset, set(convo.pinned)
+        budget = Budget(**data["budget"]) if data.get("budget") is not None else None
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+
+        # the latest response so far, written out by this handler so a slow client never blocks the model
+        latest: Optional[str] = None
+        changed = asyncio.Event()
+
+        def update(text: str):
+            nonlocal latest
+            latest = text
+            changed.set()
+
+        task = asyncio.create_task(self.inference.generate(data.get("channel", convo.id), convo, update, budget=budget))
+        task.add_done_callback(lambda _: changed.set())
+        self.busy[convo.id] = self.busy.get(convo.id, 0) + 1
+        task.add_done_callback(lambda _: self._release(convo.id))
+        try:
+            while not task.done():
+                await changed.wait()
+                changed.clear()
+                if latest is not None:
+                    text, latest = latest, None
+                    await self._send(response, {"event": "update", "response": text})
+
+            try:
+                final_response = task.result()
+            except QueueFull as exc:
+                await self._send(response, {"event": "error", "error": "busy", "depth": exc.depth})
+            except Cancelled:
+                await self._send(response, {"event": "error", "error": "cancelled"})
+            except Exception as exc:
+                logger.exception(exc)
+                await self._send(response, {"event": "error", "error": "internal", "message": str(exc)})
+            else:
+                dequeued, unpinned = convo.start_offset - start, len(pinned - set(convo.pinned))
+                await self._send(response, {"event": "done", "response": final_response, "dequeued": dequeued, "unpinned": unpinned})
+            await response.write_eof()
+        except ConnectionResetError:
+            pass
+        finally:
+            if not task.done():
+                logger.info(f"Client for {convo.id} went away, cancelling its generation")
+                task.cancel()
+
+        return response
+
+    def _conversation(self, data: dict) -> Conversation:
+        convo = self.conversations.pop(data["id"], None)
+        if convo is None or data["id"] in self.busy or not sync_conversation(convo, data):
+            convo = conversation_from_dict(data)
+
+        self.conversations[data["id"]] = convo
+        while len(self.conversations) > self.max_conversations:
+            self.conversations.popitem(last=False)
+        return convo
+
+    def _release(self, convo_id: str):
+        self.busy[convo_id] -= 1
+        if self.busy[convo_id] == 0:
+            del self.busy[convo_id]
+
+    async def _send(self, response: web.StreamResponse, event: dict):
+        await response.write((json.dumps(event) + "\n").encode("utf-8"))
+
+
+def run(
+    load_model: Callable[[], Chatbot],
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    path: Optional[str] = None,
+    max_concurrency: int = 1,
+    max_queue: int = 16,
+    adaptive_budget: bool = False,
+):
+    """Runs a `ModelServer` until interrupted, on a Unix socket at `path` if set and on `host:port` otherwise."""
+    server = ModelServer(load_model, max_concurrency=max_concurrency, max_queue=max_queue, adaptive_budget=adaptive_budget)
+    if path is not None:
+        web.run_app(server.app, path=path)
+    else:
+        web.run_app(server.app, host=host, port=port)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s][%(levelname)s] %(name)s: %(message)s")
+
+    parser = argparse.ArgumentParser(description="Serve a chatbot model over HTTP")
+    parser.add_argument("--settings", default="gpt2", help="Transformer settings preset, e.g. gpt2 or llama27b")
+    parser.add_argument("--model", help="Serve this Hugging Face model (name or path) with the preset's settings")
+    parser.add_argument("--max-new-tokens", type=int, help="Cap replies at this many tokens instead of the preset's max_outlen")
+    parser.add_argument("--max-seconds", type=float, help="Cap replies at this many seconds of generation instead of the preset's max_seconds")
+    parser.add_argument("--adaptive-budget", action="store_true", help="Shorten replies while requests are queueing")
+    parser.add_argument("--threads", type=int, help="Torch CPU threads, e.g. to split cores between several servers")
+    parser.add_argument("--bruh", action="store_true", help="Serve BruhChatbot instead of a transformer, no model needed")
+    parser.add_argument("--name", default="Bot")
+    parser.add_argument("--preamble-file", help="File holding the preamble prompt")
+    parser.add_argument("--time-format", default="clock", choices=sorted(time_formats), help="How message times are shown in prompts")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of host:port")
+    parser.add_argument("--max-concurrency", type=int, default=1)
+    parser.add_argument("--max-queue", type=int, default=16)
+    parser.add_argument("--metrics", action="store_true", help="Record metrics for GET /metrics (or set CHATBOT_METRICS=1)")
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enabled = True
+
+    preamble = ""
+    if args.preamble_file is not None:
+        with open(args.preamble_file, "r", encoding="utf-8") as f:
+            preamble = f.read()
+
+    def load_model() -> Chatbot:
+        if args.bruh:
+            return BruhChatbot(name=args.name, preamble=preamble)
+
+        from . import presets
+
+        settings = presets.named_presets().get(args.settings)
+        if settings is None:
+            raise ValueError(f"unknown settings preset: {args.settings}")
+        if args.model is not None:
+            settings = settings._replace(model_name=args.model)
+        if args.max_new_tokens is not None:
+            settings = settings._replace(max_outlen=args.max_new_tokens)
+        if args.max_seconds is not None:
+            settings = settings._replace(max_seconds=args.max_seconds)
+
+        with startup.phase("imports"):
+            import torch
+            from .transformer import Transformer
+
+        if args.threads is not None:
+            torch.set_num_threads(args.threads)
+
+        max_batch_size = presets.batch_size(settings, args.max_concurrency)
+        return Transformer(name=args.name, preamble=preamble, settings=settings, max_batch_size=max_batch_size, time_format=args.time_format)
+
+    run(
+        load_model,
+        host=args.host,
+        port=args.port,
+        path=args.socket,
+        max_concurrency=args.max_concurrency,
+        max_queue=args.max_queue,
+        adaptive_budget=args.adaptive_budget,
+    )
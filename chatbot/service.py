@@ -0,0 +1,273 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from enum import IntEnum
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from .chatbot import Budget, Cancelled, CancellationToken, Chatbot, Conversation, UpdateFunc
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    def __init__(self, depth: int):
+        super().__init__(f"inference queue is full ({depth} requests pending)")
+        self.depth = depth
+
+
+class Priority(IntEnum):
+    """Why a reply is being generated, more urgent (lower) priorities are served first."""
+
+    # DMs and messages that mention the bot
+    DIRECT = 0
+    # answers to the bot's last message
+    FOLLOW_UP = 1
+    # chiming in without being asked
+    OPPORTUNISTIC = 2
+
+
+class Dropped(Exception):
+    """A request shed to keep more urgent ones moving: it waited longer than its priority's `max_wait`, or
+    was pushed out of a full queue by a more urgent request."""
+
+    def __init__(self, priority: Priority, reason: str):
+        super().__init__(f"{priority.name.lower()} request dropped: {reason}")
+        self.priority = priority
+
+
+class _Slots(object):
+    """Like an `asyncio.Semaphore`, but a freed slot goes to the most urgent waiter, the oldest one among
+    equally urgent waiters."""
+
+    def __init__(self, slots: int):
+        self.free = slots
+        self.waiters: List[Tuple[Priority, int, asyncio.Future]] = []
+        self.order = itertools.count()
+
+    async def acquire(self, priority: Priority):
+        # slots are only freed up while nobody is waiting for one
+        if self.free > 0:
+            self.free -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # handed a slot just as the wait was given up, pass it on
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+    def evict(self, priority: Priority) -> bool:
+        """Drops the newest of the least urgent waiters, if it is less urgent than `priority`."""
+        waiting = [waiter for waiter in self.waiters if waiter[0] > priority and not waiter[2].done()]
+        if not waiting:
+            return False
+
+        victim, _, future = max(waiting, key=lambda waiter: waiter[:2])
+        future.set_exception(Dropped(victim, "queue full"))
+        return True
+
+
+async def _finished(future: asyncio.Future):
+    """Waits for `future` to finish, even if the waiting task is cancelled again meanwhile."""
+    while not future.done():
+        try:
+            await asyncio.wait([future])
+        except asyncio.CancelledError:
+            pass
+    if not future.cancelled():
+        # retrieved so it isn't logged as never retrieved, the caller is cancelled and can't use it
+        future.exception()
+
+
+class InferenceService(object):
+    """Runs `Chatbot.generate_response` on worker threads so the asyncio event loop stays responsive.
+
+    Requests for the same channel run one at a time in arrival order, at most `max_concurrency`
+    generations run at once across all channels, and once `max_queue` requests are waiting or
+    running new ones are rejected with `QueueFull`.
+
+    With `supersede` set, a new request for a channel cancels the channel's older queued or running
+    request, which raises `Cancelled`: the new request's conversation already includes everything the
+    old one would have replied to. Requests also wait `debounce` seconds before queueing, so a burst of
+    messages only generates one reply. Cancelling the task awaiting a request stops its generation as
+    soon as the model notices.
+
+    Every request has a `Priority`. Free generation slots go to the most urgent request waiting, a full
+    queue makes room for a request by dropping a less urgent waiting one, and a request that waits longer
+    than `max_wait[priority]` seconds is dropped. Both raise `Dropped`. A request superseding another keeps
+    the more urgent of their priorities, it is answering the same messages.
+
+    With `adaptive_budget` set, requests started while more are waiting than can run at once get a `Budget`
+    scaled down in proportion (to no less than `min_budget_scale`), so replies get shorter instead of the
+    queue's wait growing without bound.
+    """
+
+    def __init__(
+        self,
+        model: Optional[Chatbot],
+        max_concurrency: int = 1,
+        max_queue: int = 16,
+        supersede: bool = False,
+        debounce: float = 0.0,
+        adaptive_budget: bool = False,
+        min_budget_scale: float = 0.25,
+        max_wait: Dict[Priority, float] = {},
+    ):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.supersede = supersede
+        self.debounce = debounce
+        self.adaptive_budget = adaptive_budget
+        self.min_budget_scale = min_budget_scale
+        self.max_wait = max_wait
+
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="inference")
+        self.slots: _Slots = None
+        self.channels: Dict[Hashable, asyncio.Lock] = {}
+        self.waiting: Dict[Hashable, int] = {}
+        self.latest: Dict[Hashable, Tuple[CancellationToken, Priority]] = {}
+        self.depth = 0
+        self.superseded = 0
+        self.dropped = {priority: 0 for priority in Priority}
+        metrics.gauge("queue_depth", lambda: self.depth)
+
+    async def generate(
+        self,
+        channel_id: Hashable,
+        convo: Conversation,
+        update: UpdateFunc,
+        model: Optional[Chatbot] = None,
+        budget: Optional[Budget] = None,
+        priority: Priority = Priority.DIRECT,
+    ) -> str:
+        """Generates a response to `convo` with `model` (the service's own model by default) within `budget`,
+        calling `update` on the event loop as the response streams in."""
+        start = time.perf_counter()
+        cancel = CancellationToken()
+        if self.supersede:
+            previous = self.latest.get(channel_id)
+            if previous is not None:
+                previous[0].cancel()
+                priority = min(priority, previous[1])
+                self.superseded += 1
+                metrics.inc("superseded")
+            self.latest[channel_id] = (cancel, priority)
+
+        name = priority.name.lower()
+        metrics.inc(f"requests_{name}")
+        try:
+            if self.debounce > 0:
+                await asyncio.sleep(self.debounce)
+            if cancel.cancelled:
+                raise Cancelled()
+
+            response = await self._generate(channel_id, convo, update, cancel, model or self.model, budget, priority)
+            metrics.observe(f"reply_{name}", time.perf_counter() - start)
+            return response
+        except Dropped:
+            self.dropped[priority] += 1
+            metrics.inc(f"dropped_{name}")
+            raise
+        except asyncio.CancelledError:
+            # the worker thread keeps running until the model sees the token
+            cancel.cancel()
+            raise
+        finally:
+            if self.latest.get(channel_id, (None,))[0] is cancel:
+                del self.latest[channel_id]
+
+    async def _generate(
+        self,
+        channel_id: Hashable,
+        convo: Conversation,
+        update: UpdateFunc,
+        cancel: CancellationToken,
+        model: Chatbot,
+        budget: Optional[Budget],
+        priority: Priority,
+    ) -> str:
+        if self.slots is None:
+            self.slots = _Slots(self.max_concurrency)
+
+        if self.depth >= self.max_queue and not self.slots.evict(priority):
+            metrics.inc("queue_full")
+            raise QueueFull(self.depth)
+
+        loop = asyncio.get_running_loop()
+
+        def _update(response: str):
+            loop.call_soon_threadsafe(update, response)
+
+        self.depth += 1
+        self.waiting[channel_id] = self.waiting.get(channel_id, 0) + 1
+        lock = self.channels.setdefault(channel_id, asyncio.Lock())
+        queued = time.perf_counter()
+        try:
+            async with lock:
+                await self._acquire(priority, queued)
+                try:
+                    waited = time.perf_counter() - queued
+                    metrics.observe("queue_wait", waited)
+                    metrics.observe(f"queue_wait_{priority.name.lower()}", waited)
+                    if cancel.cancelled:
+                        raise Cancelled()
+                    budget = self._scale_budget(budget)
+                    future = loop.run_in_executor(self.executor, model.generate_response, convo, _update, cancel, budget)
+                    try:
+                        return await asyncio.shield(future)
+                    except asyncio.CancelledError:
+                        # the worker thread keeps running until the model sees the token, and keeps its slot and
+                        # the channel (whose conversation it is still writing to) until then
+                        cancel.cancel()
+                        await _finished(future)
+                        raise
+                finally:
+                    self.slots.release()
+        finally:
+            self.depth -= 1
+            self.waiting[channel_id] -= 1
+            if self.waiting[channel_id] == 0:
+                del self.waiting[channel_id]
+                del self.channels[channel_id]
+
+    async def _acquire(self, priority: Priority, queued: float):
+        max_wait = self.max_wait.get(priority)
+        if max_wait is None:
+            await self.slots.acquire(priority)
+            return
+
+        # the wait for the channel's previous request counts too
+        try:
+            await asyncio.wait_for(self.slots.acquire(priority), max(0.0, max_wait - (time.perf_counter() - queued)))
+        except asyncio.TimeoutError:
+            raise Dropped(priority, f"waited more than {max_wait:.1f}s") from None
+
+    def _scale_budget(self, budget: Optional[Budget]) -> Optional[Budget]:
+        # depth counts this request and everything running or waiting
+        if not self.adaptive_budget or self.depth <= self.max_concurrency:
+            return budget
+
+        budget = budget or Budget()
+        scale = max(self.min_budget_scale, self.max_concurrency / self.depth)
+        metrics.inc("budget_scaled")
+        return budget._replace(scale=budget.scale * scale)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,45 @@
+import threading
+
+import torch
+
+
+class SpeculativeStats(object):
+    """Counts forward passes of a target model and its draft model to measure speculative decoding.
+
+    Every target forward pass verifies the tokens drafted since the last one and yields one token of its
+    own, so the draft tokens accepted are the generated tokens minus the target forward passes.
+    """
+
+    def __init__(self, model: torch.nn.Module, draft: torch.nn.Module):
+        self.lock = threading.Lock()
+        self.target_steps = 0
+        self.draft_steps = 0
+        self.generated = 0
+
+        model.register_forward_hook(self._count_target)
+        draft.register_forward_hook(self._count_draft)
+
+    def _count_target(self, module, args, output):
+        self.target_steps += 1
+
+    def _count_draft(self, module, args, output):
+        self.draft_steps += 1
+
+    def add_generated(self, tokens: int):
+        with self.lock:
+            self.generated += tokens
+
+    def acceptance_rate(self) -> float:
+        """Fraction of drafted tokens the target model accepted."""
+        if self.draft_steps == 0:
+            return 0.0
+        return max(self.generated - self.target_steps, 0) / self.draft_steps
+
+    def tokens_per_step(self) -> float:
+        """Tokens generated per target forward pass, 1.0 without speculation."""
+        if self.target_steps == 0:
+            return 0.0
+        return self.generated / self.target_steps
+
+    def __str__(self) -> str:
+        return f"{self.generated} tokens, {self.tokens_per_step():.2f} tokens per target step, {self.acceptance_rate():.0%} of drafts accepted"
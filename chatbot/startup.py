@@ -0,0 +1,36 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer(object):
+    """Records how long each phase of startup takes, from process start (this module's import) to ready."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append((name, time.perf_counter() - start))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def summary(self) -> str:
+        with self.lock:
+            phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases)
+        return f"{self.elapsed():.2f}s to ready ({phases})"
+
+
+startup = StartupTimer()
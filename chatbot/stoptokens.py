@@ -0,0 +1,92 @@
+import re
+import copy
+import threading
+from typing import Dict, Optional, Tuple
+
+import torch
+from transformers import LogitsProcessor, PreTrainedTokenizer
+
+from .startup import startup
+
+
+class StopTokens(object):
+    """Which tokens of a vocabulary start a match of a stop pattern, so generation can end at the token
+    boundary instead of sampling the start of a stop sequence and cutting it off afterwards.
+
+    Every token is decoded once, after a newline so sentencepiece keeps its leading space. A token stops
+    generation if the pattern matches inside it (`anywhere`) or, when the text so far ends with a newline
+    (`ends_line` of the previous token), if it matches the newline plus the token (`after_newline`). Stop
+    sequences spread over several tokens past the newline are still left to `StopSequenceCriteria`.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, pattern: re.Pattern):
+        newline = tokenizer.encode("\n", add_special_tokens=False)[-1:]
+        size = len(tokenizer)
+        texts = tokenizer.batch_decode([newline + [token] for token in range(size)], skip_special_tokens=True)
+        prefix = len(tokenizer.decode(newline, skip_special_tokens=True))
+
+        token_texts = [text[prefix:] for text in texts]
+        self.anywhere = torch.tensor([pattern.search(text) is not None for text in token_texts])
+        self.after_newline = torch.tensor([pattern.search("\n" + text) is not None for text in token_texts])
+        self.ends_line = torch.tensor([text.endswith("\n") for text in token_texts])
+
+        # the special tokens decode to nothing, and the end of sequence token is where stops go
+        if tokenizer.eos_token_id is not None:
+            self.anywhere[tokenizer.eos_token_id] = self.after_newline[tokenizer.eos_token_id] = False
+
+    def to(self, device: torch.device, size: int) -> "StopTokens":
+        """The tables on `device`, padded to `size` for models whose embeddings outnumber the tokenizer's
+        vocabulary."""
+        tables = copy.copy(self)
+        for name in ("anywhere", "after_newline", "ends_line"):
+            table = getattr(self, name)
+            setattr(tables, name, torch.cat([table, table.new_zeros(size - len(table))]).to(device))
+        return tables
+
+    def mask(self, previous: torch.LongTensor) -> torch.BoolTensor:
+        """For each row, the tokens that would start a stop sequence after the `previous` token."""
+        return torch.where(self.ends_line[previous].unsqueeze(-1), self.after_newline, self.anywhere)
+
+
+_tables: Dict[Tuple[str, str], StopTokens] = {}
+_tables_lock = threading.Lock()
+
+
+def stop_tokens(tokenizer: PreTrainedTokenizer, pattern: re.Pattern) -> StopTokens:
+    """`StopTokens` for `tokenizer` and `pattern`, built once per tokenizer and shared between the models
+    that use it."""
+    key = (tokenizer.name_or_path, pattern.pattern)
+    with _tables_lock:
+        tables = _tables.get(key)
+        if tables is None:
+            with startup.phase("stop tokens"):
+                tables = _tables[key] = StopTokens(tokenizer, pattern)
+        return tables
+
+
+class StopTokenProcessor(LogitsProcessor):
+    """Moves the probability of every token that would start a stop sequence onto the end of sequence
+    token, so the reply ends where the model would have begun a new speaker's line, without generating it.
+    Only the last column of `input_ids` is read, so the batch scheduler can pass just the previous tokens.
+    """
+
+    def __init__(self, tables: StopTokens, eos_token_id: int):
+        self.tables = tables
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.tables.anywhere.device != scores.device or len(self.tables.anywhere) != scores.shape[-1]:
+            self.tables = self.tables.to(scores.device, scores.shape[-1])
+        mask = self.tables.mask(input_ids[:, -1])
+        stop = torch.logsumexp(scores.masked_fill(~mask, -float("inf")), dim=-1)
+
+        scores = scores.masked_fill(mask, -float("inf"))
+        scores[:, self.eos_token_id] = torch.logaddexp(scores[:, self.eos_token_id], stop)
+        return scores
+
+
+def stop_token_processor(tokenizer: PreTrainedTokenizer, pattern: re.Pattern) -> Optional[StopTokenProcessor]:
+    """A `StopTokenProcessor` for `tokenizer`, None if it has no end of sequence token to stop with."""
+    if tokenizer.eos_token_id is None:
+        return None
+    return StopTokenProcessor(stop_tokens(tokenizer, pattern), tokenizer.eos_token_id)
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Hashable, Optional
+
+from .chatlog import ChatLogWriter, default_writer
+from .conversation import Conversation
+
+logger = logging.getLogger(__name__)
+
+
+class _Resident(object):
+    __slots__ = ("convo", "nbytes", "last_used")
+
+    def __init__(self, convo: Conversation):
+        self.convo = convo
+        self.nbytes = convo.nbytes
+        self.last_used = time.monotonic()
+
+
+class ConversationStore(object):
+    """Maps channels to their logged conversations, keeping only recently used ones in memory.
+
+    At most `max_conversations` conversations taking about `max_bytes` stay resident, and with `max_idle` set,
+    conversations unused for that many seconds are dropped too. Dropped conversations are already on disk
+    in their chat logs, and are loaded back from them on next access. Which conversation each channel is on
+    is logged to `{logdir}/channels.jsonl`, so a restarted bot picks the conversations back up.
+
+    Conversations must not be dropped while something holds on to them across awaits (e.g. while generating a
+    reply), or a second copy would be loaded and logged to alongside the first: use `hold` for that.
+    """
+
+    def __init__(
+        self,
+        logdir: str,
+        max_conversations: int = 1000,
+        max_bytes: int = 256 * 1024**2,
+        max_idle: Optional[float] = None,
+        writer: Optional[ChatLogWriter] = None,
+    ):
+        self.logdir = logdir
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.max_idle = max_idle
+        self.writer = writer or default_writer()
+
+        self.resident: OrderedDict[Hashable, _Resident] = OrderedDict()
+        self.nbytes = 0
+        self.busy: Dict[Hashable, int] = {}
+
+        self.loads = 0
+        self.evictions = 0
+
+        os.makedirs(self.logdir, exist_ok=True)
+        self.index_path = os.path.join(self.logdir, "channels.jsonl")
+        self.ids: Dict[Hashable, str] = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        if record["id"] is None:
+                            self.ids.pop(record["channel"], None)
+                        else:
+                            self.ids[record["channel"]] = record["id"]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, key: Hashable) -> Conversation:
+        resident = self.resident.get(key)
+        if resident is None:
+            resident = _Resident(self._load(self.ids[key]))
+            self.resident[key] = resident
+            self.nbytes += resident.nbytes
+            self.loads += 1
+        else:
+            self.resident.move_to_end(key)
+            # the conversation may have grown since it was last handed out
+            self.nbytes += resident.convo.nbytes - resident.nbytes
+            resident.nbytes = resident.convo.nbytes
+            resident.last_used = time.monotonic()
+
+        self._evict()
+        return resident.convo
+
+    def __setitem__(self, key: Hashable, convo: Conversation):
+        if convo.logdir != self.logdir:
+            raise ValueError(f"conversation {convo.id} isn't logged to {self.logdir}")
+
+        self._drop(key)
+        self.ids[key] = convo.id
+        self.writer.append(self.index_path, {"channel": key, "id": convo.id})
+
+        resident = _Resident(convo)
+        self.resident[key] = resident
+        self.nbytes += resident.nbytes
+        self._evict()
+
+    def __delitem__(self, key: Hashable):
+        """Starts the channel over, its old conversation stays in its log."""
+        self._drop(key)
+        del self.ids[key]
+        self.writer.append(self.index_path, {"channel": key, "id": None})
+
+    @contextmanager
+    def hold(self, key: Hashable):
+        """Keeps the channel's conversation resident for the duration."""
+        self.busy[key] = self.busy.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            self.busy[key] -= 1
+            if self.busy[key] == 0:
+                del self.busy[key]
+
+    def _load(self, convo_id: str) -> Conversation:
+        path = os.path.join(self.logdir, f"{convo_id}.jsonl")
+        # the conversation's last records may still be queued
+        self.writer.flush()
+        if not os.path.isfile(path):
+            return Conversation(convo_id, logdir=self.logdir, writer=self.writer)
+
+        return Conversation.load(path, writer=self.writer)
+
+    def _drop(self, key: Hashable):
+        resident = self.resident.pop(key, None)
+        if resident is not None:
+            self.nbytes -= resident.nbytes
+
+    def _evict(self):
+        now = time.monotonic()
+        # each resident conversation is looked at once at most, busy ones are moved to the back
+        for _ in range(len(self.resident)):
+            key, resident = next(iter(self.resident.items()))
+            over = len(self.resident) > self.max_conversations or self.nbytes > self.max_bytes
+            idle = self.max_idle is not None and now - resident.last_used > self.max_idle
+            if not over and not idle:
+                return
+
+            if key in self.busy:
+                self.resident.move_to_end(key)
+                continue
+
+            self._drop(key)
+            self.evictions += 1
+
+    def values(self):
+        return [resident.convo for resident in self.resident.values()]
+
+    def dump(self):
+        """Blocks until everything logged so far has been written to disk."""
+        self.writer.flush()
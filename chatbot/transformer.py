@@ -1,179 +1,472 @@
 import re
 import gc
+import time
 import torch
-from typing import List
-import numpy as np
+from typing import List, Optional, Tuple
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers import StoppingCriteria, StoppingCriteriaList, MaxLengthCriteria
 from transformers import PreTrainedTokenizer
-from transformers import SinkCache
 from .chatbot import *
-import arrow
+from .kvcache import KVCacheStore
+from .batching import BatchRequest, BatchScheduler
+from .quantization import default_quantization, dtypes, quantize_int8
+from .speculative import SpeculativeStats
+from .startup import startup
+from .metrics import metrics
+from .memory import InputBuffer, MemoryManager
+from .prompt import PromptRenderer
+from .stoptokens import stop_token_processor
+from .presets import *
 import os
+import hashlib
 from dotenv import load_dotenv
 
-load_dotenv()
 
-HF_TOKEN = os.getenv("HF_TOKEN")
+def hf_token() -> Optional[str]:
+    # read when a model is loaded rather than at import, picking up .env files the entry point didn't load
+    load_dotenv()
+    return os.getenv("HF_TOKEN")
 
 
-class TransformerSettings(NamedTuple):
-    model_name: str
-    temperature: float
-    top_p: float
-    top_k: int
-    repetition_penalty: float
-    max_outlen: int = 12
+class IncrementalDetokenizer(object):
+    """Decodes a growing sequence of token ids, returning only the text added by each new batch of ids.
+
+    Only a small window of ids is decoded per step: a few tokens before the ones already returned are
+    decoded alongside the new ones so sentencepiece leading spaces come out right, and text ending in
+    an incomplete multi-byte character is held back until the rest of its bytes arrive.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, prompt_ids: List[int], context: int = 5):
+        self.tokenizer = tokenizer
+        self.ids = list(prompt_ids[-context:])
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+        self.prefix_text = self._decode(self.ids)
+
+    def _decode(self, ids: List[int]) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=True)
+
+    def feed(self, new_ids: List[int]) -> str:
+        self.ids.extend(new_ids)
+        text = self._decode(self.ids[self.prefix_offset :])
+
+        if len(text) <= len(self.prefix_text) or text.endswith("\ufffd"):
+            return ""
+
+        new_text = text[len(self.prefix_text) :]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.ids)
+        self.prefix_text = self._decode(self.ids[self.prefix_offset : self.read_offset])
+
+        return new_text
 
 
 class StopSequenceCriteria(StoppingCriteria):
-    def __init__(self, pattern: re.Pattern, offset: int, tokenizer, update: UpdateFunc):
+    """Stops generation once the generated text matches `pattern`, passing each new piece of text before
+    the match to `update`.
+
+    Every match of `pattern` must start with a newline and not span further newlines, so only the current
+    line has to be kept around and searched. That line is held back from `update` until it is finished,
+    because a later token can still turn it into a stop sequence; call `flush` once generation is over.
+    """
+
+    def __init__(self, pattern: re.Pattern, prompt_length: int, tokenizer: PreTrainedTokenizer, update: UpdateFunc):
         self.pattern = pattern
-        self.offset = offset
+        self.prompt_length = prompt_length
         self.tokenizer = tokenizer
         self.update = update
 
+        self.detokenizer: IncrementalDetokenizer = None
+        self.seen = prompt_length
+        self.tail = ""
+        self.stopped = False
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        new_text = self.tokenizer.decode(input_ids[0][1:])
-        # new_text = new_text[self.offset + 1: ]
-        new_text = new_text[self.offset: ]
-        invalid = re.search(self.pattern, new_text) is not None
+        ids = input_ids[0]
+        if self.detokenizer is None:
+            self.start(ids[: self.prompt_length].tolist())
+
+        new_ids = ids[self.seen :].tolist()
+        self.seen = len(ids)
+
+        return self.feed_ids(new_ids)
+
+    def start(self, prompt_ids: List[int]):
+        self.detokenizer = IncrementalDetokenizer(self.tokenizer, prompt_ids)
+
+    def feed_ids(self, new_ids: List[int]) -> bool:
+        with metrics.span("stop_check"):
+            return self.feed(self.detokenizer.feed(new_ids))
+
+    def feed(self, new_text: str) -> bool:
+        if self.stopped:
+            return True
+
+        text = self.tail + new_text
+        match = self.pattern.search(text)
+        if match is not None:
+            self.tail = ""
+            self.stopped = True
+            self._emit(text[: match.start()])
+            return True
+
+        newline = text.rfind("\n")
+        if newline == -1:
+            self.tail = ""
+            self._emit(text)
+        else:
+            self.tail = text[newline:]
+            self._emit(text[:newline])
+
+        return False
+
+    def flush(self):
+        # a reply ended by the end of sequence token in place of a stop sequence leaves the newline before it
+        if not self.stopped:
+            self._emit(self.tail.rstrip("\n"))
+        self.tail = ""
 
-        # not checking for invalid here because doing so leaves it with a single trailing endline
-        # which cannot be removed because only double endline is considered an invalid sequence
-        # if we don't check for invalid, it'll still terminate generation after an invalid is
-        # reached but it can be properly filtered out in the _generate function beacuse the
-        # double endline can be easily detected
-        self.update(new_text)
+    def _emit(self, text: str):
+        if text != "":
+            self.update(text)
 
-        return invalid
 
+# where a sentence ends: its closing punctuation and any quotes or brackets after it, followed by a space or the end
+sentence_end = re.compile(r"[.!?…][\"')\]]*(?=\s|$)")
 
-gpt2 = TransformerSettings(model_name="gpt2", temperature=0.8, top_p=1.0, top_k=None, repetition_penalty=1.2)
 
-gpt2Medium = TransformerSettings(model_name="gpt2-medium", temperature=1.0, top_p=0.90, top_k=None, repetition_penalty=1.33)
+def truncate_to_sentence(text: str) -> str:
+    """`text` up to the end of its last complete sentence, all of it if it has none."""
+    end = None
+    for end in sentence_end.finditer(text):
+        pass
+    return text if end is None else text[: end.end()]
 
-gpt2Large = TransformerSettings(model_name="gpt2-large", temperature=1.0, top_p=0.9, top_k=None, repetition_penalty=1.33)
 
-gpt2XL = TransformerSettings(
-    model_name="gpt2-xl",
-    temperature=1.0,
-    top_p=0.9,
-    top_k=None,
-    repetition_penalty=1.33,
-)
+class BudgetCriteria(StoppingCriteria):
+    """Stops generation after `max_new_tokens` tokens or once `deadline` (a `time.monotonic()` time) has passed,
+    and remembers whether it did."""
 
-gptDistil = TransformerSettings(model_name="distilgpt2", temperature=0.8, top_p=0.9, top_k=None, repetition_penalty=1.2)
+    def __init__(self, prompt_length: int, max_new_tokens: int, deadline: Optional[float]):
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.deadline = deadline
+        self.exhausted = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        self.exhausted = input_ids.shape[-1] - self.prompt_length >= self.max_new_tokens or (self.deadline is not None and time.monotonic() >= self.deadline)
+        return self.exhausted
 
-gptNeoSmall = TransformerSettings(
-    model_name="EleutherAI/gpt-neo-125M",
-    temperature=1.1,
-    top_p=0.9,
-    top_k=None,
-    repetition_penalty=1.2,
-)
 
-gptNeo = TransformerSettings(
-    model_name="EleutherAI/gpt-neo-1.3B",
-    temperature=1.1,
-    top_p=0.9,
-    top_k=None,
-    repetition_penalty=3.0,
-)
+class CancelledCriteria(StoppingCriteria):
+    def __init__(self, cancel: CancellationToken):
+        self.cancel = cancel
 
-gptJ = TransformerSettings(
-    model_name="EleutherAI/gpt-j-6B",
-    temperature=0.7,
-    top_p=None,
-    top_k=None,
-    repetition_penalty=1.0,
-)
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        return self.cancel.cancelled
 
-llama7b = TransformerSettings(model_name=f"{os.path.expanduser('~')}/scratch/llama_hf-7b", temperature=0.7, top_p=None, top_k=None, repetition_penalty=1.1, max_outlen=64)
-llama13b = TransformerSettings(model_name=f"{os.path.expanduser('~')}/scratch/llama_hf-13b", temperature=0.7, top_p=None, top_k=None, repetition_penalty=1.1, max_outlen=512)
-llama27b = TransformerSettings(model_name="meta-llama/Llama-2-7b-hf", temperature=0.7, top_p=None, top_k=None, repetition_penalty=1.1, max_outlen=512)
 
-alpaca7b = TransformerSettings(model_name=f"chavinlo/alpaca-native", temperature=0.7, top_p=None, top_k=None, repetition_penalty=1.1, max_outlen=512)
+class StepTimer(StoppingCriteria):
+    """Times `generate`'s prefill (up to the first new token) and each decode step after it, never stops it."""
+
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.prefilled = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        now = time.perf_counter()
+        metrics.observe("decode_step" if self.prefilled else "prefill", now - self.last)
+        self.last = now
+        self.prefilled = True
+        return False
 
 
 class Transformer(Chatbot):
-    def _init_model(self, settings: TransformerSettings):
+    def _init_model(
+        self,
+        settings: TransformerSettings,
+        kv_cache_bytes: int = 2 * 1024**3,
+        preamble_cache_dir: Optional[str] = None,
+        max_batch_size: int = 1,
+        time_format: str = "clock",
+    ):
         self.settings = settings
+        # checked before anything is loaded, see presets.batch_size
+        if max_batch_size > 1 and settings.draft_model is not None:
+            raise ValueError("speculative decoding generates one sequence at a time, it can't be batched")
 
-        self.tokenizer = AutoTokenizer.from_pretrained(settings.model_name, legacy=False, token=HF_TOKEN)
+        with startup.phase("tokenizer"):
+            self.tokenizer = AutoTokenizer.from_pretrained(settings.model_name, legacy=False, token=hf_token())
         self.stop_pattern = re.compile(r"\n\[|\n.*\[.+\]<.*>|\n-+|\n\\[A-Za-z]+{|\n<|\n.*\\")
+        # ends replies at the token that would start a stop sequence instead of generating it, the pattern
+        # still catches stop sequences spread over several tokens
+        self.stop_tokens = stop_token_processor(self.tokenizer, self.stop_pattern)
 
-        self.model: AutoModelForCausalLM = None
-        if torch.cuda.is_available():
-            self.gpu = True
-            self.model = AutoModelForCausalLM.from_pretrained(
-                settings.model_name,
-                device_map="auto",
-                # revision="float16",
-                torch_dtype=torch.float16,
-                # low_cpu_mem_usage=True,
-                # load_in_8bit=True,
-                token=HF_TOKEN,
-            )
-            print(self.model.hf_device_map)
-        else:
-            self.gpu = False
-            self.model = AutoModelForCausalLM.from_pretrained(settings.model_name, torch_dtype=torch.float16, token=HF_TOKEN)
+        self.gpu = torch.cuda.is_available() and not self.force_cpu
+        self.quantization = settings.quantization or default_quantization(self.gpu)
+        if self.quantization not in dtypes:
+            raise ValueError(f"unknown quantization {self.quantization!r}, expected one of {', '.join(dtypes)}")
+
+        with startup.phase("weights"):
+            self.model: AutoModelForCausalLM = self._load_model(settings.model_name)
 
-        self.cache = SinkCache(window_length=self.model.model_max_length, num_sink_tokens=4)
+        self.kv_cache = KVCacheStore(kv_cache_bytes)
         self.model.eval()
 
-    def format_time(self, timestamp: int) -> str:
-        # return arrow.get(timestamp).format("HH:mm UTC")
-        return arrow.get(timestamp).humanize()
+        with startup.phase("preamble"):
+            self._init_preamble_cache(preamble_cache_dir)
+        self.renderer = PromptRenderer(self._encode_continuation, self.preamble, self.preamble_ids, self.name, time_format)
+
+        self.memory = MemoryManager(self.gpu)
+        self.input_buffer = InputBuffer(min(self.context_length(), 8192))
+
+        labels = {"model": settings.model_name}
+        self.gauges = [
+            metrics.gauge("kv_cache_hits", lambda: self.kv_cache.hits, **labels),
+            metrics.gauge("kv_cache_misses", lambda: self.kv_cache.misses, **labels),
+            metrics.gauge("kv_cache_reused_tokens", lambda: self.kv_cache.reused_tokens, **labels),
+            metrics.gauge("kv_cache_bytes", lambda: self.kv_cache.nbytes, **labels),
+        ]
+
+        # with batching, _generate can be called from several threads at once and every call joins one decode loop
+        self.batcher: Optional[BatchScheduler] = None
+        if max_batch_size > 1:
+            self.batcher = BatchScheduler(self.model, self.tokenizer.eos_token_id, max_batch_size, self.stop_tokens)
+            self.gauges.append(metrics.gauge("batch_rows", lambda: len(self.batcher.rows), **labels))
+
+        self.draft: Optional[AutoModelForCausalLM] = None
+        self.speculative_stats: Optional[SpeculativeStats] = None
+        if settings.draft_model is not None:
+            with startup.phase("draft weights"):
+                self.draft = self._load_model(settings.draft_model)
+            self.draft.eval()
+            self.draft.generation_config.num_assistant_tokens = settings.num_draft_tokens
+            self.draft.generation_config.num_assistant_tokens_schedule = "constant"
+            self.speculative_stats = SpeculativeStats(self.model, self.draft)
+
+    def warmup(self, tokens: int = 8):
+        with startup.phase("warmup"):
+            convo = Conversation("warmup")
+            convo.add_message(ChatbotMessage("warmup", "Hello!"))
+            self.generate_response(convo, lambda response: None, budget=Budget(max_tokens=tokens))
+            self.kv_cache.evict(convo.id)
+
+    def memory_footprint(self) -> int:
+        # the KV cache is counted at its budget, it grows up to that with use
+        models = [self.model] if self.draft is None else [self.model, self.draft]
+        return sum(model.get_memory_footprint() for model in models) + self.kv_cache.max_bytes
+
+    def unload(self):
+        for key in self.gauges:
+            metrics.remove_gauge(key)
+        if self.batcher is not None:
+            self.batcher.close()
+        self.memory.close()
+        self.kv_cache = KVCacheStore(self.kv_cache.max_bytes)
+        self.model = self.draft = self.batcher = None
+        gc.collect()
+        torch.cuda.empty_cache()
 
-    def _generate_model_input(self, convo: Conversation) -> str:
-        out = self.preamble + "\n"
-        message: ChatbotMessage = None
-        for message in convo.queue:
-            out += f"[{self.format_time(message.timestamp)}]<{message.sender}>{message.message}\n"
+    def _load_model(self, model_name: str) -> AutoModelForCausalLM:
+        # safetensors checkpoints are memory-mapped, and low_cpu_mem_usage builds the model straight from them
+        # instead of randomly initializing every weight first and then copying the checkpoint over it
+        if self.gpu:
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                device_map="auto",
+                # revision="float16",
+                torch_dtype=torch.float16 if self.quantization == "int8" else dtypes[self.quantization],
+                low_cpu_mem_usage=True,
+                load_in_8bit=self.quantization == "int8",
+                token=hf_token(),
+            )
+            print(model.hf_device_map)
+            return model
+
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtypes[self.quantization], low_cpu_mem_usage=True, token=hf_token())
+        if self.quantization == "int8":
+            model = quantize_int8(model)
+        return model
+
+    def _init_preamble_cache(self, cache_dir: Optional[str]):
+        """Prefills the preamble once so every conversation can start from its keys/values.
+
+        If `cache_dir` is given (e.g. the directory next to the model weights) the keys/values are saved
+        there and loaded on the next start instead of being recomputed.
+        """
+        self.preamble_ids: List[int] = self.tokenizer.encode(self.preamble + "\n")
+        device = next(self.model.parameters()).device
+
+        path = None
+        if cache_dir is not None:
+            key = hashlib.sha1(f"{self.settings.model_name}\0{self.quantization}\0{self.preamble}".encode()).hexdigest()[:16]
+            path = os.path.join(cache_dir, f"preamble-{key}.pt")
+
+        if path is not None and os.path.isfile(path):
+            saved = torch.load(path)
+            if saved["ids"] == self.preamble_ids:
+                past = tuple((key.to(device), value.to(device)) for key, value in saved["past"])
+                self.kv_cache.set_root(self.preamble_ids, past)
+                logger.info(f"Loaded preamble cache from {path}")
+                return
+
+        with torch.no_grad():
+            outputs = self.model(torch.tensor([self.preamble_ids], device=device), use_cache=True)
+        past = tuple((key, value) for key, value in outputs.past_key_values)
+        self.kv_cache.set_root(self.preamble_ids, past)
+
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            torch.save({"ids": self.preamble_ids, "past": [(key.cpu(), value.cpu()) for key, value in past]}, path)
+            logger.info(f"Saved preamble cache to {path}")
+
+    def _encode_continuation(self, text: str) -> List[int]:
+        """Tokenizes `text` as it would be tokenized right after a newline, so the ids can be appended to
+        the ids of text ending in one."""
+        anchor = self.tokenizer.encode("\n", add_special_tokens=False)
+        ids = self.tokenizer.encode("\n" + text, add_special_tokens=False)
+        if ids[: len(anchor)] != anchor:
+            return self.tokenizer.encode(text, add_special_tokens=False)
+
+        return ids[len(anchor) :]
+
+    def _encode_model_input(self, convo: Conversation, overflow: int = 0) -> List[int]:
+        with metrics.span("prompt_build"):
+            # only the messages fit_window counted, later ones wait for the next turn
+            return self.renderer.render(convo, overflow, convo.counted)
 
-        out += f"[{self.format_time(arrow.utcnow())}]<{self.name}>"
-        return out
+    def _generate_model_input(self, convo: Conversation) -> str:
+        return self.renderer.text(convo)
 
     def model_max_length(self) -> str:
-        return str(self.tokenizer.model_max_length)
-
-    def _generate(self, convo: Conversation, update: UpdateFunc) -> str:
-        input_text = self._generate_model_input(convo)
-
-        # while len(self.tokenizer.encode(input_text)) >= self.tokenizer.model_max_length - self.settings.max_outlen:
-        #     convo.dequeue()
-        #     input_text = self._generate_model_input(convo)
-
-        input_ids = self.tokenizer.encode(input_text, return_tensors="pt")
+        return str(self.context_length())
+
+    def context_length(self) -> int:
+        # tokenizers without a configured limit report a huge model_max_length, the model config knows better
+        config = self.model.config
+        positions = getattr(config, "max_position_embeddings", None) or getattr(config, "n_positions", None)
+        return min(self.tokenizer.model_max_length, positions or self.tokenizer.model_max_length)
+
+    def _fit_context(self, convo: Conversation) -> int:
+        # the preamble, reply header and reply all have to fit alongside the history
+        header = len(self.renderer.header_ids())
+        budget = self.context_length() - self.settings.max_outlen - len(self.preamble_ids) - header
+        return convo.fit_window(
+            budget, self.renderer.count, trim_to=0.75, recount=not self.renderer.stable, key=self.renderer.key
+        )
 
-        def _update(output: str):
-            output = re.split(self.stop_pattern, output)[0]
-            update(output)
+    def sampling(self) -> dict:
+        """The preset's sampling settings, with the ones it leaves unset (None) taken from the model's
+        generation config, so `generate` and the batch scheduler sample the same way."""
+        config = self.model.generation_config
+        settings = {}
+        for name in ("temperature", "top_p", "top_k", "repetition_penalty"):
+            value = getattr(self.settings, name)
+            settings[name] = value if value is not None else getattr(config, name, None)
+        return settings
+
+    def limits(self, budget: Optional[Budget] = None) -> Tuple[int, Optional[float]]:
+        """The most tokens a response may take and when (a `time.monotonic()` time) it has to be done by, from
+        the settings' limits narrowed by `budget`."""
+        budget = budget or Budget()
+        max_tokens = self.settings.max_outlen if budget.max_tokens is None else min(budget.max_tokens, self.settings.max_outlen)
+        seconds = self.settings.max_seconds
+        if budget.seconds is not None:
+            seconds = budget.seconds if seconds is None else min(budget.seconds, seconds)
+
+        max_tokens = max(1, int(max_tokens * budget.scale))
+        deadline = time.monotonic() + seconds * budget.scale if seconds is not None else None
+        return max_tokens, deadline
+
+    def _generate(self, convo: Conversation, update: UpdateFunc, cancel: Optional[CancellationToken] = None, budget: Optional[Budget] = None) -> str:
+        with self.memory.request():
+            self._generate_reply(convo, update, cancel, budget)
+
+    def _generate_reply(self, convo: Conversation, update: UpdateFunc, cancel: Optional[CancellationToken], budget: Optional[Budget]):
+        max_tokens, deadline = self.limits(budget)
+        with metrics.span("fit_window"):
+            overflow = self._fit_context(convo)
+        prompt_ids = self._encode_model_input(convo, overflow)
+        if self.draft is None:
+            cached, past_key_values = self.kv_cache.lookup(convo.id, prompt_ids)
+            logger.debug(f"Reusing {cached}/{len(prompt_ids)} cached prompt tokens for {convo.id}")
+        else:
+            # assisted generation copies the caller's keys/values into the draft model's inputs too, where they
+            # don't fit, so speculative decoding always prefills the whole prompt
+            cached, past_key_values = 0, None
+
+        generate_kwargs = {}
+        if past_key_values is not None:
+            generate_kwargs["past_key_values"] = past_key_values
+        if self.draft is not None:
+            generate_kwargs["assistant_model"] = self.draft
+
+        response = ""
+
+        def _update(new_text: str):
+            nonlocal response
+            response += new_text
+            update(response)
+
+        stopping_criteria = StopSequenceCriteria(self.stop_pattern, len(prompt_ids), self.tokenizer, _update)
+        if self.batcher is not None:
+            exhausted = self._generate_batched(convo, prompt_ids, cached, past_key_values, stopping_criteria, cancel, max_tokens, deadline)
+        else:
+            exhausted = self._generate_single(convo, prompt_ids, generate_kwargs, stopping_criteria, cancel, max_tokens, deadline)
+
+        if exhausted and not stopping_criteria.stopped:
+            # cut off mid-thought, end on the last full sentence instead
+            metrics.inc("budget_exhausted")
+            truncated = truncate_to_sentence(response)
+            if truncated != response:
+                response = truncated
+                update(response)
+
+    def _generate_single(
+        self,
+        convo: Conversation,
+        prompt_ids: List[int],
+        generate_kwargs: dict,
+        stopping_criteria: StopSequenceCriteria,
+        cancel: Optional[CancellationToken],
+        max_tokens: int,
+        deadline: Optional[float],
+    ) -> bool:
+        # the batch scheduler builds its own inputs, only generate needs the prompt as a tensor
+        input_ids = self.input_buffer.fill(prompt_ids)
+        budget_criteria = BudgetCriteria(input_ids.shape[-1], max_tokens, deadline)
+        criteria = [stopping_criteria, budget_criteria]
+        if cancel is not None:
+            criteria.append(CancelledCriteria(cancel))
+        if metrics.enabled:
+            criteria.append(StepTimer())
 
-        stopping_criteria = StopSequenceCriteria(self.stop_pattern, len(input_text), self.tokenizer, _update)
         outputs = self.model.generate(
             input_ids.cuda() if self.gpu else input_ids,
-            # max_length=min(len(input_ids[0]) + self.settings.max_outlen, self.tokenizer.model_max_length),
-            # max_new_tokens=self.settings.max_outlen,
+            max_new_tokens=max_tokens,
             # penalty_alpha=0.6,
             # top_k=10,
             do_sample=True,
-            temperature=self.settings.temperature,
-            top_p=self.settings.top_p,
-            repetition_penalty=self.settings.repetition_penalty,
-            stopping_criteria=[stopping_criteria],
+            **self.sampling(),
+            stopping_criteria=criteria,
+            logits_processor=[self.stop_tokens] if self.stop_tokens is not None else None,
             # eos_token_id=self.endline_token,
             # pad_token_id=self.model.config.pad_token_id,
             # exponential_decay_length_penalty=(10, 0.75),
             use_cache=True,
-            past_key_values=self.cache
+            return_dict_in_generate=True,
+            **generate_kwargs,
         )
+        stopping_criteria.flush()
 
-        del input_ids
-        gc.collect()
-        torch.cuda.empty_cache()
+        if self.speculative_stats is not None:
+            self.speculative_stats.add_generated(outputs.sequences.shape[-1] - len(prompt_ids))
+            logger.debug(f"Speculative decoding: {self.speculative_stats}")
+
+        metrics.inc("tokens_generated", outputs.sequences.shape[-1] - len(prompt_ids))
+        if self.draft is None:
+            self.kv_cache.store(convo.id, outputs.sequences[0].tolist(), outputs.past_key_values)
+        return budget_criteria.exhausted
 
         # output = self.tokenizer.decode(outputs[0])
         # output = output[len(input_text) + 1 :]
@@ -184,6 +477,35 @@ class Transformer(Chatbot):
         # if firstBracket != -1 and firstClosing != -1:
         #    output = output[:firstBracket]
 
+    def _generate_batched(
+        self,
+        convo: Conversation,
+        prompt_ids: List[int],
+        cached: int,
+        past_key_values,
+        stopping_criteria: StopSequenceCriteria,
+        cancel: Optional[CancellationToken],
+        max_tokens: int,
+        deadline: Optional[float],
+    ) -> bool:
+        stopping_criteria.start(prompt_ids)
+        request = BatchRequest(
+            prompt_ids,
+            stopping_criteria.feed_ids,
+            **self.sampling(),
+            max_new_tokens=min(max_tokens, self.context_length() - len(prompt_ids)),
+            cached=cached,
+            past=past_key_values,
+            cancel=cancel,
+            deadline=deadline,
+        )
+        self.batcher.submit(request)
+        stopping_criteria.flush()
+        metrics.inc("tokens_generated", len(request.generated))
+
+        self.kv_cache.store(convo.id, prompt_ids + request.generated, request.past)
+        return request.exhausted
+
 
 preamble = """Following is a conversation between a superintelligent AI, taking the form of AMOGUS.
 
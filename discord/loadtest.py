@@ -0,0 +1,360 @@
+import os
+import glob
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import contextvars
+from typing import Dict, List, Optional, Tuple
+
+import discord
+import discord.main as bot
+from chatbot.chatbot import BruhChatbot, Cancelled, Chatbot
+from chatbot.memory import rss_bytes
+from chatbot.service import Dropped, Priority
+
+# Replays recorded or synthetic traffic through NLPChatbot.on_message with stand-ins for the Discord objects
+# it touches, and reports latency percentiles: python -m discord.loadtest --help
+
+logger = logging.getLogger(__name__)
+
+synthetic_messages = [
+    "who is the impostor",
+    "I saw red vent in electrical",
+    "that's pretty sus ngl",
+    "where were you when the lights went out",
+    "skip vote, we don't have enough info",
+    "I was doing wires in admin the whole time",
+]
+
+
+class Request(object):
+    """What happened to one message sent to the bot, filled in by the fake Discord objects."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.replying = False
+        self.first_text: Optional[float] = None
+        self.text = ""
+        self.deleted = False
+        self.dropped = False
+        self.superseded = False
+        self.embed: Optional[str] = None
+        self.priority: Optional[Priority] = None
+
+    def shown(self, content: Optional[str]):
+        if not content:
+            return
+
+        if self.first_text is None:
+            self.first_text = time.perf_counter()
+        self.text = content
+
+
+# the request being handled, the bot's tasks (like StreamingReply's) inherit it from the message's task
+current_request: contextvars.ContextVar[Request] = contextvars.ContextVar("current_request")
+
+
+class FakeAvatar(object):
+    url = ""
+
+
+class FakeUser(object):
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.discriminator = "0"
+        self.avatar = FakeAvatar()
+
+    def mentioned_in(self, message: "FakeMessage") -> bool:
+        return self in message.mentions
+
+
+class FakeGuild(object):
+    def __init__(self, id: int):
+        self.id = id
+
+
+class FakeTyping(object):
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeMessage(object):
+    def __init__(self, channel: "FakeChannel", author: FakeUser, content: str, mentions: List[FakeUser] = []):
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.mentions = mentions
+        self.request = current_request.get(None)
+
+    async def edit(self, content: str = None, **kwargs):
+        self.content = content
+        self.request.shown(content)
+
+    async def delete(self):
+        self.request.deleted = True
+
+
+class FakeChannel(object):
+    def __init__(self, id: int, name: str, guild: FakeGuild, bot_user: FakeUser):
+        self.id = id
+        self.name = name
+        self.guild = guild
+        self.bot_user = bot_user
+
+    async def send(self, content: str = None, embed: discord.Embed = None) -> FakeMessage:
+        request = current_request.get()
+        if embed is not None:
+            request.embed = embed.title.lower()
+        request.shown(content)
+        return FakeMessage(self, self.bot_user, content)
+
+    def typing(self) -> FakeTyping:
+        return FakeTyping()
+
+
+class LoadTestBot(bot.NLPChatbot):
+    def __init__(self, *args, **kwargs):
+        self.fake_user = FakeUser(0, bot.name)
+        super().__init__(*args, **kwargs)
+
+    @property
+    def user(self) -> FakeUser:
+        return self.fake_user
+
+    async def handle_chat(self, message: FakeMessage, priority: Priority = Priority.DIRECT):
+        request = current_request.get()
+        request.replying = True
+        request.priority = priority
+        await super().handle_chat(message, priority)
+
+
+def load_traffic(paths: List[str]) -> List[Tuple[str, str, str]]:
+    """(channel, sender, message) for every user message in the given chat logs, old `.json` or `.jsonl`, in
+    timestamp order across channels."""
+    messages = []
+    for path in paths:
+        channel = os.path.splitext(os.path.basename(path))[0]
+        with open(path, "r", encoding="utf-8") as f:
+            if path.endswith(".jsonl"):
+                records = [json.loads(line) for line in f if line.strip()]
+                records = [record for record in records if record["event"] == "message"]
+            else:
+                records = json.load(f)
+
+        for record in records:
+            if record["sender"] != bot.name:
+                messages.append((record["timestamp"], channel, record["sender"], record["message"]))
+
+    messages.sort(key=lambda message: message[0])
+    return [message[1:] for message in messages]
+
+
+def synthetic_traffic(channels: int, messages: int, seed: int = 0) -> List[Tuple[str, str, str]]:
+    rng = random.Random(seed)
+    return [(f"channel{rng.randrange(channels)}", f"user{rng.randrange(20)}", rng.choice(synthetic_messages)) for _ in range(messages)]
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+
+    values = sorted(values)
+    return {f"p{p}": values[min(len(values) - 1, int(len(values) * p / 100))] for p in (50, 95, 99)}
+
+
+async def run(model: Chatbot, traffic: List[Tuple[str, str, str]], rate: float, mention: float, seed: int = 0) -> dict:
+    """Sends `traffic` to the bot as Poisson arrivals at `rate` messages per second, a `mention` fraction of
+    them addressed to the bot."""
+    rng = random.Random(seed)
+    client = LoadTestBot(intents=discord.Intents.default(), model=model)
+
+    # when each generation started, to split latency into queueing and generating
+    generation_starts: Dict[str, List[float]] = {}
+    generate_response = model.generate_response
+
+    def timed_generate_response(convo, update, cancel=None, budget=None):
+        generation_starts.setdefault(convo.id, []).append(time.perf_counter())
+        return generate_response(convo, update, cancel, budget)
+
+    model.generate_response = timed_generate_response
+
+    generate = client.inference.generate
+
+    async def tracked_generate(*args, **kwargs):
+        try:
+            return await generate(*args, **kwargs)
+        except Dropped:
+            current_request.get().dropped = True
+            raise
+        except Cancelled:
+            # nothing may have been posted yet, so it can't be told from a deleted message
+            current_request.get().superseded = True
+            raise
+
+    client.inference.generate = tracked_generate
+
+    guild = FakeGuild(1)
+    channels: Dict[str, FakeChannel] = {}
+    users: Dict[str, FakeUser] = {}
+    results = []
+
+    async def send(channel: FakeChannel, author: FakeUser, content: str, mentioned: bool):
+        message = FakeMessage(channel, author, f"{bot.name} {content}" if mentioned else content)
+        request = Request()
+        current_request.set(request)
+        await client.on_message(message)
+        if not request.replying:
+            return
+
+        if request.embed is not None:
+            outcome = request.embed
+        elif request.dropped:
+            outcome = "dropped"
+            if request.first_text is not None:
+                logger.warning(f"Dropped reply in {channel.name} was posted: {request.text!r}")
+        elif request.superseded or request.deleted:
+            outcome = "superseded"
+        else:
+            outcome = "replied"
+
+        starts = [t for t in generation_starts.get(client.convos[channel.id].id, []) if t >= request.start]
+        results.append(
+            {
+                "latency": time.perf_counter() - request.start,
+                "ttft": request.first_text - request.start if request.first_text is not None else None,
+                "queue_wait": starts[0] - request.start if starts else None,
+                "tokens": count_tokens(model, request.text) if outcome == "replied" else 0,
+                "outcome": outcome,
+                "priority": request.priority.name.lower(),
+            }
+        )
+
+    rss = rss_bytes()
+    start = time.perf_counter()
+    tasks = []
+    for channel_name, sender, content in traffic:
+        if channel_name not in channels:
+            channels[channel_name] = FakeChannel(len(channels) + 1, channel_name, guild, client.fake_user)
+        if sender not in users:
+            users[sender] = FakeUser(len(users) + 1, sender)
+
+        tasks.append(asyncio.create_task(send(channels[channel_name], users[sender], content, rng.random() < mention)))
+        await asyncio.sleep(rng.expovariate(rate))
+
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    client.convos.dump()
+    client.inference.shutdown()
+
+    replied = [result for result in results if result["outcome"] == "replied"]
+    outcomes = {}
+    for result in results:
+        outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+
+    priorities = {}
+    for priority in Priority:
+        requested = [result for result in results if result["priority"] == priority.name.lower()]
+        if requested:
+            priorities[priority.name.lower()] = {
+                "requests": len(requested),
+                "dropped": sum(result["outcome"] == "dropped" for result in requested),
+                "latency": percentiles([result["latency"] for result in requested if result["outcome"] == "replied"]),
+            }
+
+    return {
+        "messages": len(traffic),
+        "requests": len(results),
+        "outcomes": outcomes,
+        "priorities": priorities,
+        "ttft": percentiles([result["ttft"] for result in replied if result["ttft"] is not None]),
+        "latency": percentiles([result["latency"] for result in replied]),
+        "queue_wait": percentiles([result["queue_wait"] for result in results if result["queue_wait"] is not None]),
+        "tokens_per_second": sum(result["tokens"] for result in replied) / elapsed,
+        "elapsed": elapsed,
+        "rss_growth": rss_bytes() - rss,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def count_tokens(model: Chatbot, text: str) -> int:
+    tokenizer = getattr(model, "tokenizer", None)
+    if tokenizer is None:
+        return len(text.split())
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def load_model(name: str, max_new_tokens: int) -> Chatbot:
+    if name == "bruh":
+        return BruhChatbot(name=bot.name, preamble=bot.preamble)
+
+    from chatbot import presets
+    from chatbot.transformer import Transformer
+
+    settings = presets.named_presets().get(name) or presets.gptDistil._replace(model_name=name)
+    settings = settings._replace(max_outlen=max_new_tokens)
+    model = Transformer(name=bot.name, preamble=bot.preamble, settings=settings, max_batch_size=presets.batch_size(settings, bot.batch_size))
+    model.warmup()
+    return model
+
+
+def print_report(report: dict):
+    print(f"{report['messages']} messages, {report['requests']} replies requested in {report['elapsed']:.1f}s: {report['outcomes']}")
+    print(f"{'':<12} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for metric in ("ttft", "latency", "queue_wait"):
+        values = [report[metric][p] for p in ("p50", "p95", "p99")]
+        print(f"{metric:<12} " + " ".join(f"{value * 1e3:>9.1f}" if value is not None else f"{'-':>9}" for value in values))
+    print(f"{'priority':<14} {'requests':>8} {'dropped':>8} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+    for priority, stats in report["priorities"].items():
+        values = [stats["latency"][p] for p in ("p50", "p95")]
+        print(f"{priority:<14} {stats['requests']:>8} {stats['dropped']:>8} " + " ".join(f"{value * 1e3:>9.1f}" if value is not None else f"{'-':>9}" for value in values))
+    print(f"{report['tokens_per_second']:.1f} tokens/s, RSS grew {report['rss_growth'] / 2**20:.1f} MiB, peak {report['peak_rss'] / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m discord.loadtest", description="Replay traffic through the Discord bot without Discord")
+    parser.add_argument("--logs", nargs="*", help="Chat logs to replay (.json or .jsonl), e.g. chatlogs/*.jsonl")
+    parser.add_argument("--channels", type=int, default=8, help="Synthetic traffic: number of channels")
+    parser.add_argument("--messages", type=int, default=200, help="Synthetic traffic: number of messages")
+    parser.add_argument("--limit", type=int, help="Replay at most this many messages")
+    parser.add_argument("--rate", type=float, default=4.0, help="Messages per second")
+    parser.add_argument("--mention", type=float, default=1.0, help="Fraction of the messages addressed to the bot")
+    parser.add_argument("--no-mention", dest="mention", action="store_const", const=0.0, help="Don't address any message to the bot")
+    parser.add_argument("--model", default="bruh", help="bruh, a preset name or a Hugging Face model")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=bot.batch_size)
+    parser.add_argument("--debounce", type=float, default=bot.reply_debounce)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    bot.logger.setLevel(logging.WARNING)
+    bot.batch_size = args.batch_size
+    bot.reply_debounce = args.debounce
+    bot.chat_logdir = tempfile.mkdtemp(prefix="loadtest-")
+
+    if args.logs:
+        traffic = load_traffic([path for pattern in args.logs for path in glob.glob(pattern)])
+    else:
+        traffic = synthetic_traffic(args.channels, args.messages, args.seed)
+    if args.limit is not None:
+        traffic = traffic[: args.limit]
+
+    report = asyncio.run(run(load_model(args.model, args.max_new_tokens), traffic, args.rate, args.mention, args.seed))
+    report["model"] = args.model
+    print_report(report)
+
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
@@ -1,11 +1,20 @@
 import time
+import asyncio
+import contextlib
 import discord
 import argparse
 import shlex
-from chatbot.chatbot import ChatbotMessage, Conversation, Chatbot, BruhChatbot
-from chatbot import transformer
+from chatbot.chatbot import ChatbotMessage, Conversation, Chatbot, BruhChatbot, Cancelled
+from chatbot.service import Dropped, InferenceService, Priority, QueueFull
+from chatbot.remote import RemoteChatbot
+from chatbot.pool import ReplicaPool
+from chatbot.registry import ModelRegistry
+from chatbot.store import ConversationStore
+from chatbot.startup import startup
+from chatbot.metrics import metrics
+from chatbot import presets
 from random import random
-import numpy as np
+from typing import Optional
 import logging
 
 import sys
@@ -37,6 +46,11 @@ discord_logger.addHandler(log_handler_console)
 
 chat_logdir = "chatlogs/"
 
+# conversations kept in memory, idle channels are reloaded from their chat logs when they come back
+max_resident_conversations = 1000
+max_conversation_bytes = 256 * 1024**2
+max_conversation_idle = 6 * 60 * 60
+
 
 name = "AMOGUS"
 preamble = """
@@ -49,6 +63,50 @@ The following excerpt is a conversation between a superintelligent AI secretly t
 description = """I like finding who is sus"""
 cmd_text = f"{name.lower()}-cmd"
 
+# number of channels whose replies are generated together in one batch
+batch_size = 4
+
+# show replies as they are generated, by posting the first text and editing it as more comes in
+stream_replies = True
+
+# shorten replies while more channels are waiting on one than can be generated at once, so the wait stays bounded
+adaptive_budgets = True
+
+# seconds replies the bot wasn't directly asked for may wait for the model before they're dropped, so under load
+# the model goes to DMs and mentions first
+max_reply_wait = {Priority.FOLLOW_UP: 10.0, Priority.OPPORTUNISTIC: 2.0}
+
+# seconds to wait for more messages before replying, newer messages in a channel cancel older replies
+reply_debounce = 0.5
+
+# model server to generate replies with (http://host:port or unix:/path), started with `python -m discord.main --serve`
+# unset to load the model inside the bot process
+model_server = os.getenv("MODEL_SERVER")
+
+# model server processes to spread channels over, each on its share of the CPU cores, 0 to load models in the bot
+model_replicas = int(os.getenv("MODEL_REPLICAS", "0"))
+
+# preset channels talk to until they pick another with --model, and the memory loaded models may take up together
+default_model = "llama27b"
+model_memory = int(os.getenv("MODEL_MEMORY_GB", "24")) * 1024**3
+
+# how message times are shown to the model: "clock" (18:47 UTC), "date" (2024-05-01 18:47 UTC) or "humanize"
+# (5 minutes ago), which changes as messages age and so keeps re-rendering prompts and invalidating their cache
+time_format = "clock"
+
+# seconds between metrics log lines while metrics are enabled with CHATBOT_METRICS=1
+metrics_interval = 60
+
+
+def load_model(preset: str = default_model) -> Chatbot:
+    # torch and transformers take seconds to import, so only pay for them once a local model is needed
+    with startup.phase("imports"):
+        from chatbot.transformer import Transformer
+
+    settings = presets.named_presets()[preset]
+    return Transformer(name=name, preamble=preamble, settings=settings, max_batch_size=presets.batch_size(settings, batch_size), time_format=time_format)
+    # return BruhChatbot(name=name, preamble=preamble)
+
 
 class EarlyExit(Exception):
     def __init__(self, message: str):
@@ -67,20 +125,128 @@ parser = ArgumentParser(prog=cmd_text, description=description)
 parser.add_argument("-r", "--reset", help="Reset conversation history for this channel", action="store_true")
 parser.add_argument("-g", "--gaslight", help="Change the last response from this bot", nargs="+", type=str)
 parser.add_argument("-t", "--history", help="Show conversation history", action="store_true")
+parser.add_argument("-p", "--pin", help="Never forget the last message in this channel", action="store_true")
+parser.add_argument("-m", "--model", help="Switch the model replying in this channel", choices=sorted(presets.named_presets()))
+
+
+class StreamingReply(object):
+    """Posts a reply to a channel and edits it as the reply streams in.
+
+    Nothing is posted until the first text arrives, so replies that are dropped or superseded while they
+    wait for the model never show up in the channel. Updates are coalesced so the message is edited at most
+    once every `min_interval` seconds, and only once `min_chars` new characters have arrived unless
+    `max_interval` seconds have passed. A single task does all the editing, so there is never more than one
+    edit in flight, and `finish` always shows the final text.
+    """
+
+    max_length = 2000
+
+    def __init__(self, channel: discord.abc.Messageable, min_interval: float = 1.0, max_interval: float = 3.0, min_chars: int = 24):
+        self.channel = channel
+        self.message: Optional[discord.Message] = None
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_chars = min_chars
+
+        self.text = ""
+        self.shown = ""
+        self.last_edit = -float("inf")
+        self.closed = False
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    def push(self, text: str):
+        self.text = text
+        self.changed.set()
+
+    async def finish(self, text: str):
+        self.text = text
+        self.closed = True
+        self.changed.set()
+        await self.task
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            timeout = None
+            if self.text != self.shown:
+                elapsed = loop.time() - self.last_edit
+                if self.closed or elapsed >= self.max_interval or (elapsed >= self.min_interval and len(self.text) - len(self.shown) >= self.min_chars):
+                    if elapsed < self.min_interval:
+                        await asyncio.sleep(self.min_interval - elapsed)
+                    await self._edit(self.text)
+                    continue
+
+                timeout = self.min_interval - elapsed if elapsed < self.min_interval else self.max_interval - elapsed
+            elif self.closed:
+                return
+
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _edit(self, text: str):
+        self.shown = text
+        self.last_edit = asyncio.get_running_loop().time()
+        try:
+            if self.message is None:
+                self.message = await self.channel.send(text[: self.max_length])
+            else:
+                await self.message.edit(content=text[: self.max_length])
+        except discord.HTTPException as exc:
+            logger.warning(f"Failed to edit streaming reply: {exc}")
+
+    async def discard(self):
+        """Stops streaming and deletes whatever was posted."""
+        await self.finish(self.shown)
+        if self.message is not None:
+            await self.message.delete()
 
 
 class NLPChatbot(discord.Client):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, model: Chatbot = None, **kwargs):
+        """Replies with `model` if given, otherwise with the model server or the registry's models."""
         super().__init__(*args, **kwargs)
-        self.convos: dict[int, Conversation] = {}
-        logger.info("Loading Model")
-        self.model: Chatbot = transformer.Transformer(name=name, preamble=preamble, settings=transformer.llama27b)
-        # self.model: Chatbot = BruhChatbot(name=name, preamble=preamble)
+        self.convos = ConversationStore(chat_logdir, max_resident_conversations, max_conversation_bytes, max_conversation_idle)
+        self.started = False
+        self.channel_models: dict[int, str] = {}
+        self.model: Chatbot = None
+        self.models: ModelRegistry = None
+        if model is not None:
+            self.model = model
+        elif model_server is not None:
+            logger.info(f"Using model server at {model_server}")
+            self.model = RemoteChatbot(name=name, preamble=preamble, url=model_server)
+        elif model_replicas > 0:
+            logger.info(f"Starting {model_replicas} model replicas")
+            server_args = ["--time-format", time_format]
+            self.model = ReplicaPool(name=name, preamble=preamble, settings=default_model, replicas=model_replicas, max_concurrency=batch_size, server_args=server_args)
+        else:
+            logger.info("Loading Model")
+            self.models = ModelRegistry(load_model, list(presets.named_presets()), max_bytes=model_memory)
+            with self.models.use(default_model):
+                pass
+        # every replica batches its own share of the channels
+        replicas = model_replicas if isinstance(self.model, ReplicaPool) else 1
+        self.inference = InferenceService(
+            self.model,
+            max_concurrency=batch_size * replicas,
+            max_queue=16 * replicas,
+            supersede=True,
+            debounce=reply_debounce,
+            adaptive_budget=adaptive_budgets,
+            max_wait=max_reply_wait,
+        )
 
         logger.info("Model Loaded")
 
     async def on_ready(self):
         logger.info(f"Logged in as {self.user}")
+        if not self.started:
+            self.started = True
+            logger.info(f"Startup took {startup.summary()}")
 
     async def on_message(self, message: discord.Message):
         if message.author == self.user:
@@ -106,42 +272,96 @@ class NLPChatbot(discord.Client):
         convo = self.convos[message.channel.id]
         convo.add_message(ChatbotMessage(sender=message.author.display_name, message=content))
 
-        respond = name.lower() in content.lower()
-        respond = respond or self.user.mentioned_in(message)
+        priority = self.reply_priority(message, convo, dm)
+        if priority is not None:
+            await self.handle_chat(message, priority)
+            return
+
+    def reply_priority(self, message: discord.Message, convo: Conversation, dm: bool) -> Optional[Priority]:
+        """Whether to reply to `message` and how urgently, None to stay quiet."""
+        content = message.clean_content.lower()
+        if dm or name.lower() in content or self.user.mentioned_in(message):
+            return Priority.DIRECT
+
         # respond = respond or (len(message.mentions) == 0 and random() < 0.05)
-        respond = respond or (len(convo.queue) >= 2 and convo.queue[-2].sender == name and ("you" in content.lower() or "we" in content.lower() or (True and random() < 0.33)))
-        respond = respond or dm
+        if len(convo.queue) >= 2 and convo.queue[-2].sender == name:
+            if "you" in content or "we" in content:
+                return Priority.FOLLOW_UP
+            if random() < 0.33:
+                return Priority.OPPORTUNISTIC
 
-        if respond:
-            await self.handle_chat(message)
-            return
+        return None
 
     # async def generate_response(self, convo: Conversation) -> str:
     #     return self.model.generate_response(convo)
 
-    async def handle_chat(self, message: discord.Message):
+    @contextlib.asynccontextmanager
+    async def chat_model(self, channel_id: int):
+        """The model replying in a channel, loaded on a worker thread if it isn't resident."""
+        if self.models is None:
+            yield self.model
+            return
+
+        preset = self.channel_models.get(channel_id, default_model)
+        model = await asyncio.get_running_loop().run_in_executor(None, self.models.acquire, preset)
+        try:
+            yield model
+        finally:
+            self.models.release(preset)
+
+    def model_max_length(self, channel_id: int) -> str:
+        if self.models is None:
+            return self.model.model_max_length()
+
+        model = self.models.get_loaded(self.channel_models.get(channel_id, default_model))
+        return model.model_max_length() if model is not None else "?"
+
+    async def handle_chat(self, message: discord.Message, priority: Priority = Priority.DIRECT):
+        # the conversation has to stay in memory while the reply is added to it
+        with self.convos.hold(message.channel.id):
+            await self._handle_chat(message, priority)
+
+    async def _handle_chat(self, message: discord.Message, priority: Priority):
         convo = self.convos[message.channel.id]
         channel: discord.TextChannel = message.channel
 
-        # message: discord.Message = await channel.send("Thinking...")
+        reply: StreamingReply = None
+        if stream_replies:
+            reply = StreamingReply(channel)
 
         def update(response: str):
-            pass
-            # self.loop.create_task(message.edit(content=response))
+            if reply is not None:
+                reply.push(response)
 
         err = False
+        busy = False
         final_response = ""
         async with channel.typing():
             try:
-                # final_response = await self.generate_response(convo)
-                final_response = self.model.generate_response(convo, update)
+                async with self.chat_model(channel.id) as model:
+                    final_response = await self.inference.generate(channel.id, convo, update, model, priority=priority)
+            except Cancelled:
+                logger.info(f"Reply in {channel.id} superseded by a newer message")
+            except Dropped as exc:
+                # nobody asked, so nobody needs to hear that it's busy
+                logger.info(f"Not replying in {channel.id}: {exc}")
+            except QueueFull as exc:
+                logger.warning(f"Dropping message in {channel.id}: {exc}")
+                busy = True
             except Exception as exc:
                 logger.exception(exc)
                 err = True
 
-        # await message.delete()
+        if reply is not None:
+            if final_response and not busy and not err:
+                await reply.finish(final_response)
+                return
 
-        if err:
+            await reply.discard()
+
+        if busy:
+            await channel.send(embed=self.create_embed(self.user, title="Busy", description="Too many people are talking to me right now, try again in a bit"))
+        elif err:
             await channel.send(embed=self.create_embed(self.user, title="Error", description="Internal error, better luck next message"))
         elif final_response:
             await channel.send(final_response)
@@ -193,13 +413,23 @@ class NLPChatbot(discord.Client):
                 new_msg = ChatbotMessage(old_msg.sender, " ".join(args.gaslight))
                 convo.amend(idx, new_msg)
 
-        if args.gaslight or args.history:
+        if args.pin and len(convo) > 0:
+            convo.pin(len(convo) - 1)
+
+        if args.model:
+            if self.models is None:
+                await message.channel.send(embed=self.create_embed(message.author, title="Model", description="The model server (or replicas) only serve one model"))
+            else:
+                self.channel_models[message.channel.id] = args.model
+                await message.channel.send(embed=self.create_embed(message.author, title="Model", description=f"Now talking with {args.model}"))
+
+        if args.gaslight or args.history or args.pin:
             await message.channel.send(
                 embed=self.create_embed(
                     message.author,
-                    title=f"{'Gaslit ' if args.gaslight else ''}History",
+                    title=f"{'Gaslit ' if args.gaslight else ''}{'Pinned ' if args.pin else ''}History",
                     description=convo.summary(),
-                    footer=f"The model can only remember approximately the last {self.model.model_max_length()} words.",
+                    footer=f"The model can only remember approximately the last {self.model_max_length(message.channel.id)} words.",
                 )
             )
 
@@ -213,13 +443,33 @@ class NLPChatbot(discord.Client):
         return embed
 
     async def close(self):
-        for convo in self.convos.values():
-            convo.dump()
+        self.convos.dump()
 
+        self.inference.shutdown()
+        if self.models is not None:
+            self.models.close()
+        elif self.model is not None:
+            self.model.unload()
         await super().close()
 
 
 if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="Discord frontend for the chatbot")
+    cli.add_argument("--serve", help="Run the model server for bots started with MODEL_SERVER set instead of the bot", action="store_true")
+    cli.add_argument("--host", default="127.0.0.1")
+    cli.add_argument("--port", type=int, default=8765)
+    cli.add_argument("--socket", help="Serve on this Unix socket instead of host:port")
+    cli_args = cli.parse_args()
+
+    if metrics.enabled:
+        metrics.log_periodically(metrics_interval, logger)
+
+    if cli_args.serve:
+        from chatbot import server
+
+        server.run(load_model, host=cli_args.host, port=cli_args.port, path=cli_args.socket, max_concurrency=batch_size, max_queue=16, adaptive_budget=adaptive_budgets)
+        sys.exit()
+
     try:
         intents = discord.Intents.default()
         intents.messages = True
@@ -0,0 +1,57 @@
+import pytest
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+corpus = [
+    "[18:47 UTC]<crewmate>I saw red vent in electrical.\n",
+    "[18:48 UTC]<AMOGUS>That's pretty sus, where were you?\n",
+    "<impostor> skip vote, we don't have enough info\n",
+    "-----\n\\begin{document} C:\\amogus\n",
+    "Following is a conversation between a superintelligent AI, taking the form of AMOGUS.\n",
+    # trailing whitespace, so the vocabulary has tokens like " \n" and "\n\n" that merge across lines
+    "[18:49 UTC]<crewmate>wait  \n\n",
+]
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tmp_path_factory) -> str:
+    """A randomly initialized two-layer GPT-2 with a small byte-level BPE tokenizer, saved to a directory
+    `Transformer` and `AutoTokenizer` can load without a network."""
+    path = str(tmp_path_factory.mktemp("tiny"))
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=400, special_tokens=["<|endoftext|>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(corpus * 20, trainer)
+    fast = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>", bos_token="<|endoftext|>", model_max_length=512)
+    fast.save_pretrained(path)
+
+    save_model(path, fast, n_layer=2, n_head=2)
+    return path
+
+
+@pytest.fixture(scope="session")
+def tiny_target(tiny_model, tmp_path_factory) -> str:
+    """A larger model than `tiny_model` (four layers and heads) with the same tokenizer, so `tiny_model` can
+    draft for it."""
+    path = str(tmp_path_factory.mktemp("tiny-target"))
+    tokenizer = PreTrainedTokenizerFast.from_pretrained(tiny_model)
+    tokenizer.save_pretrained(path)
+    save_model(path, tokenizer, n_layer=4, n_head=4)
+    return path
+
+
+def save_model(path: str, tokenizer: PreTrainedTokenizerFast, n_layer: int, n_head: int):
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=512,
+        n_embd=32,
+        n_layer=n_layer,
+        n_head=n_head,
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    GPT2LMHeadModel(config).save_pretrained(path)
@@ -0,0 +1,52 @@
+import pytest
+import torch
+from transformers import LogitsProcessorList, RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+from chatbot.batching import BatchRequest
+from chatbot import presets
+from chatbot.presets import gptDistil
+from chatbot.transformer import Transformer
+
+
+def test_batched_sampling_matches_generate(tiny_model):
+    # a preset leaving top_k and top_p to the model, like the llama ones
+    model = Transformer(name="AMOGUS", preamble="x", settings=gptDistil._replace(model_name=tiny_model, top_k=None, top_p=None), max_batch_size=2)
+    model.model.generation_config.top_k = 50
+    model.model.generation_config.top_p = 0.9
+    sampling = model.sampling()
+    assert sampling["top_k"] == 50 and sampling["top_p"] == 0.9
+
+    torch.manual_seed(0)
+    vocab = model.model.config.vocab_size
+    prompt = torch.randint(0, vocab, (1, 20))
+    logits = torch.randn(1, vocab) * 3
+
+    # what generate applies: its own processors, the custom ones, then temperature, top-k and top-p warpers
+    expected = LogitsProcessorList(
+        [
+            RepetitionPenaltyLogitsProcessor(sampling["repetition_penalty"]),
+            model.stop_tokens,
+            TemperatureLogitsWarper(sampling["temperature"]),
+            TopKLogitsWarper(sampling["top_k"]),
+            TopPLogitsWarper(sampling["top_p"]),
+        ]
+    )(prompt, logits.clone())
+
+    request = BatchRequest(prompt[0].tolist(), lambda ids: False, **sampling)
+    seen = torch.zeros(1, vocab, dtype=torch.bool)
+    seen[0, prompt[0]] = True
+    processed = model.batcher._process(logits.clone(), [request], seen)
+    model.unload()
+
+    assert torch.equal(torch.isinf(processed), torch.isinf(expected))
+    assert torch.allclose(torch.softmax(processed, dim=-1), torch.softmax(expected, dim=-1), atol=1e-6)
+
+
+def test_draft_presets_load_unbatched():
+    assert presets.batch_size(presets.gptNeoSpeculative, 4) == 1
+    assert presets.batch_size(presets.gptNeo, 4) == 4
+
+    # refused before the (here missing) weights are looked for
+    settings = gptDistil._replace(model_name="/nonexistent", draft_model="/nonexistent")
+    with pytest.raises(ValueError, match="can't be batched"):
+        Transformer(name="AMOGUS", preamble="x", settings=settings, max_batch_size=2)
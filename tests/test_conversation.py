@@ -0,0 +1,80 @@
+from chatbot.conversation import ChatbotMessage, Conversation
+from chatbot.prompt import PromptRenderer
+
+
+def count(message: ChatbotMessage) -> int:
+    return len(message.message.split())
+
+
+def test_message_added_while_counting_is_counted_next_time():
+    convo = Conversation("test")
+    convo.add_message(ChatbotMessage("a", "one two"))
+
+    def count_and_add(message):
+        # the event loop appending a message while fit_window runs on a worker thread
+        if len(convo) == 1:
+            convo.add_message(ChatbotMessage("b", "three four five"))
+        return count(message)
+
+    assert convo.fit_window(100, count_and_add) == 0
+    assert convo.counted == 1 and convo.window_tokens == 2
+
+    convo.fit_window(100, count)
+    assert convo.counted == 2 and convo.window_tokens == 5
+
+
+def test_oldest_pins_are_evicted_past_max_pinned():
+    convo = Conversation("test")
+    for i in range(3):
+        convo.add_message(ChatbotMessage("a", "word " * 10))
+        convo.pin(i)
+    for i in range(5):
+        convo.add_message(ChatbotMessage("b", "word"))
+
+    # the pins are dequeued from the window but stay in it, taking up 30 of 35 tokens
+    convo.fit_window(100, count)
+    for _ in range(3):
+        convo.dequeue()
+    assert convo.window_tokens == 35
+
+    assert convo.fit_window(30, count, max_pinned=0.5) == 0
+    assert convo.pinned == [2]
+    assert convo.window_tokens <= 30
+    assert sum(count(m) for m in convo.queue) == convo.window_tokens
+
+
+def test_oversized_newest_message_returns_overflow():
+    convo = Conversation("test")
+    convo.add_message(ChatbotMessage("a", "word " * 5))
+    convo.add_message(ChatbotMessage("b", "word " * 50))
+
+    assert convo.fit_window(20, count) == 30
+    assert len(convo.queue) == 1 and convo.window_tokens == 50
+
+
+def test_render_shortens_newest_message_by_overflow():
+    renderer = PromptRenderer(lambda text: [ord(c) for c in text], "", [], "bot")
+    convo = Conversation("test")
+    convo.add_message(ChatbotMessage("a", "x" * 40))
+
+    full = renderer.render(convo)
+    short = renderer.render(convo, overflow=10)
+    header = renderer.header_ids()
+    assert len(short) == len(full) - 10
+    # the message keeps its closing newline, before the reply header
+    assert short[-len(header) - 1] == ord("\n")
+
+
+def test_switching_tokenization_recounts_window():
+    convo = Conversation("test")
+    for i in range(4):
+        convo.add_message(ChatbotMessage("a", "one two three"))
+    words, chars = object(), object()
+
+    convo.fit_window(1000, count, key=words)
+    assert convo.window_tokens == 12
+
+    # the channel moves to a model counting characters
+    convo.fit_window(1000, lambda message: len(message.message), key=chars)
+    assert convo.window_tokens == 4 * len("one two three")
+    assert all(message.num_tokens == len("one two three") for message in convo.queue)
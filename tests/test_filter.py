@@ -0,0 +1,55 @@
+import random
+import re
+
+import pytest
+
+from chatbot.filter import WordMatcher
+
+patterns = ["sus", "amog(us)+", "red ?vent", "imp[o0]st[o0]r", "c\\d+", "vote|skip", "x*y", "e\\s+m"]
+alphabet = "susamogredventimpo0c1 xykEMRS_.\n"
+
+
+def reference(word_boundary: bool) -> re.Pattern:
+    pattern = "|".join(f"(?:{pattern})" for pattern in patterns)
+    if word_boundary:
+        pattern = rf"(?<!\w)(?:{pattern})(?!\w)"
+    return re.compile(pattern)
+
+
+def chunks(text: str, rng: random.Random) -> list:
+    cuts = sorted(rng.sample(range(len(text) + 1), rng.randint(0, min(5, len(text) + 1))))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def matches(matcher: WordMatcher, pieces: list) -> bool:
+    stream = matcher.stream()
+    for piece in pieces:
+        if stream.feed(piece):
+            return True
+    return stream.finish()
+
+
+@pytest.mark.parametrize("word_boundary", [False, True])
+def test_matches_like_re_on_random_chunked_text(word_boundary):
+    matcher = WordMatcher(patterns, word_boundary=word_boundary)
+    expected = reference(word_boundary)
+    rng = random.Random(0)
+
+    found = 0
+    for _ in range(3000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 16)))
+        want = expected.search(text.lower()) is not None
+        found += want
+        assert matcher.search(text) == want, text
+        assert matches(matcher, chunks(text, rng)) == want, text
+    # both outcomes were exercised
+    assert 0 < found < 3000
+
+
+@pytest.mark.parametrize("word_boundary", [False, True])
+@pytest.mark.parametrize("text", ["that's SUS", "amogusus!", "red vent", "the redvents", "impost0r.", "c123x", "xxxy", "e \n m", "suspicious", "a sus_"])
+def test_matches_like_re_across_every_chunk_boundary(text, word_boundary):
+    matcher = WordMatcher(patterns, word_boundary=word_boundary)
+    want = reference(word_boundary).search(text.lower()) is not None
+    for cut in range(len(text) + 1):
+        assert matches(matcher, [text[:cut], text[cut:]]) == want, (text[:cut], text[cut:])
@@ -0,0 +1,66 @@
+import pytest
+import torch
+
+from chatbot.conversation import ChatbotMessage, Conversation
+from chatbot.presets import gptDistil
+from chatbot.prompt import PromptRenderer
+from chatbot.transformer import Transformer
+
+messages = [
+    ("crewmate", "I saw red vent in electrical."),
+    ("impostor", "skip vote, we don't have enough info"),
+    ("crewmate", "where were you when the lights went out?"),
+]
+
+
+def conversation(id: str, turns: int) -> Conversation:
+    convo = Conversation(id)
+    for i, (sender, message) in enumerate(messages[:turns]):
+        convo.add_message(ChatbotMessage(sender, message, timestamp=60.0 * i))
+    return convo
+
+
+def generated_ids(model: Transformer, convo: Conversation, seed: int) -> list:
+    torch.manual_seed(seed)
+    model.generate_response(convo, lambda response: None)
+    return model.kv_cache.entries[convo.id].ids
+
+
+@pytest.mark.parametrize("max_batch_size", [1, 2])
+def test_reused_prefix_generates_same_tokens(tiny_model, monkeypatch, max_batch_size):
+    settings = gptDistil._replace(model_name=tiny_model, max_outlen=16, max_seconds=None)
+    model = Transformer(name="AMOGUS", preamble="x", settings=settings, max_batch_size=max_batch_size)
+    # the reply header shows the current time, keep it the same for both prompts
+    monkeypatch.setattr(model.renderer, "header_ids", lambda now=None: PromptRenderer.header_ids(model.renderer, 0.0))
+
+    # the first turn caches the conversation's keys/values, the second reuses them
+    warm = conversation("warm", 2)
+    model.generate_response(warm, lambda response: None)
+    warm.add_message(ChatbotMessage(*messages[2], timestamp=120.0))
+    reused = model.kv_cache.reused_tokens
+    warm_ids = generated_ids(model, warm, seed=1)
+    assert model.kv_cache.reused_tokens - reused > len(model.preamble_ids)
+
+    # the same prompt from scratch, without even the preamble's keys/values
+    cold = conversation("cold", 2)
+    cold.add_message(warm.queue[2])
+    cold.add_message(ChatbotMessage(*messages[2], timestamp=120.0))
+    model.kv_cache.root = None
+    cold_ids = generated_ids(model, cold, seed=1)
+
+    assert cold_ids == warm_ids
+    # and the reply wasn't empty, the prompt is the conversation before it plus the reply header
+    assert len(warm_ids) > len(model.renderer.render(cold, end=len(cold) - 1))
+
+
+def test_speculative_decoding_replies_with_preamble_cache(tiny_target, tiny_model):
+    # the draft model has fewer layers and heads than the target, their keys/values can't be swapped
+    settings = gptDistil._replace(model_name=tiny_target, draft_model=tiny_model, max_outlen=16, max_seconds=None)
+    model = Transformer(name="AMOGUS", preamble="x", settings=settings)
+    assert model.kv_cache.root is not None
+
+    convo = conversation("speculative", 3)
+    for _ in range(2):
+        model.generate_response(convo, lambda response: None)
+        convo.add_message(ChatbotMessage(*messages[0], timestamp=convo.queue[-1].timestamp + 60))
+    assert model.speculative_stats.generated > 0
@@ -0,0 +1,19 @@
+import pytest
+
+from chatbot.conversation import ChatbotMessage, Conversation
+from chatbot.presets import gptDistil
+from chatbot.transformer import Transformer
+
+
+@pytest.mark.parametrize("time_format", ["clock", "humanize"])
+def test_rendered_ids_match_tokenizing_the_prompt(tiny_model, time_format):
+    model = Transformer(name="AMOGUS", preamble="x", settings=gptDistil._replace(model_name=tiny_model), time_format=time_format)
+    convo = Conversation("test")
+    for text in ["wait  ", "sus\n\n", "trailing tab\t", "\n", "  leading and inner  spaces", "", "done\n"]:
+        convo.add_message(ChatbotMessage("crewmate", text))
+
+    # the reply header shows the current time, render both while it can't change
+    renderer = model.renderer
+    now = renderer.header_ids()
+    assert renderer.render(convo) == model.tokenizer.encode(renderer.text(convo))
+    assert renderer.header_ids() == now
@@ -0,0 +1,42 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from chatbot.chatbot import Cancelled, CancellationToken
+from chatbot.conversation import ChatbotMessage, Conversation
+from chatbot.remote import RemoteChatbot
+
+
+def test_cancel_closes_a_request_the_server_hasnt_answered(tmp_path):
+    # a server that takes the request and then sends nothing, like one with the request still queued
+    path = os.path.join(tmp_path, "server.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    closed = threading.Event()
+
+    def serve():
+        conn, _ = listener.accept()
+        while conn.recv(4096):
+            pass
+        closed.set()
+        conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    bot = RemoteChatbot(name="Bot", url=f"unix:{path}", timeout=60.0)
+    convo = Conversation("test")
+    convo.add_message(ChatbotMessage("crewmate", "where?"))
+    cancel = CancellationToken()
+    threading.Timer(0.2, cancel.cancel).start()
+
+    start = time.monotonic()
+    with pytest.raises(Cancelled):
+        bot.generate_response(convo, lambda response: None, cancel)
+    assert time.monotonic() - start < 5.0
+    # the server sees the connection go away
+    assert closed.wait(5.0)
+    listener.close()
@@ -0,0 +1,55 @@
+from chatbot.conversation import ChatbotMessage, Conversation
+from chatbot.remote import window_to_dict
+from chatbot.server import conversation_from_dict, sync_conversation
+
+
+def count(message: ChatbotMessage) -> int:
+    return len(message.message.split())
+
+
+def dicts(convo: Conversation) -> list:
+    return [message.to_dict() for message in convo.queue]
+
+
+def test_synced_window_matches_client_and_keeps_unchanged_messages():
+    client = Conversation("test")
+    for i in range(6):
+        client.add_message(ChatbotMessage(f"user{i % 2}", "word " * (i + 1), timestamp=i))
+    client.pin(0)
+    client.dequeue()
+
+    server = conversation_from_dict(window_to_dict(client))
+    assert dicts(server) == dicts(client)
+
+    # the server drops messages to fit, the client follows what it reports
+    start, pinned = server.start_offset, set(server.pinned)
+    server.fit_window(12, count, max_pinned=1.0)
+    dequeued, unpinned = server.start_offset - start, len(pinned - set(server.pinned))
+    assert dequeued > 0
+    for _ in range(dequeued):
+        client.dequeue()
+    assert unpinned == 0
+
+    # both add the reply, with their own timestamps, and the client gets another message
+    server.add_message(ChatbotMessage("Bot", "reply", timestamp=100.0))
+    client.add_message(ChatbotMessage("Bot", "reply", timestamp=100.5))
+    client.add_message(ChatbotMessage("user0", "and again", timestamp=101.0))
+
+    kept = server.queue[:-1]
+    assert sync_conversation(server, window_to_dict(client))
+    assert dicts(server) == dicts(client)
+    assert all(a is b for a, b in zip(server.queue, kept))
+    assert server.queue[0].num_tokens is not None
+
+
+def test_window_that_doesnt_continue_is_refused():
+    client = Conversation("test")
+    for i in range(3):
+        client.add_message(ChatbotMessage("user", f"message {i}", timestamp=i))
+    server = conversation_from_dict(window_to_dict(client))
+
+    # the client started over with a different first message
+    client.dequeue()
+    before = dicts(server)
+    assert not sync_conversation(server, window_to_dict(client))
+    assert dicts(server) == before
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import time
+
+from chatbot.chatbot import Cancelled
+from chatbot.conversation import Conversation
+from chatbot.service import InferenceService
+
+
+class SlowModel(object):
+    """Takes `delay` seconds to notice a cancelled request, like a model in the middle of a decode step."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def generate_response(self, convo, update, cancel, budget):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        try:
+            while not cancel.cancelled:
+                time.sleep(0.01)
+            time.sleep(self.delay)
+            raise Cancelled()
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def test_cancelled_request_holds_its_slot_until_the_worker_finishes():
+    model = SlowModel(delay=0.2)
+    service = InferenceService(model, max_concurrency=1)
+
+    async def run():
+        convo = Conversation("test")
+        first = asyncio.create_task(service.generate("channel", convo, lambda response: None))
+        await asyncio.sleep(0.05)
+        assert model.running == 1
+
+        first.cancel()
+        second = asyncio.create_task(service.generate("channel", convo, lambda response: None))
+        await asyncio.sleep(0.05)
+        # the first worker is still winding down, the second request has to wait for it
+        assert model.running == 1 and not first.done()
+
+        await asyncio.wait([first])
+        assert first.cancelled()
+        await asyncio.sleep(0.05)
+        # then it runs, never alongside the first
+        assert model.running == 1 and model.most_running == 1
+        second.cancel()
+        await asyncio.wait([second])
+
+    asyncio.run(run())
+    service.shutdown()
+    assert model.most_running == 1
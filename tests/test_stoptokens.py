@@ -0,0 +1,79 @@
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from chatbot.presets import gptDistil
+from chatbot.stoptokens import StopTokenProcessor, StopTokens
+from chatbot.transformer import StopSequenceCriteria, Transformer
+
+replies = [
+    "sus\n[18:49 UTC]<crewmate>where?",
+    "I was in admin\n<impostor> skip vote",
+    "red vent\n-----\n",
+    "wires done\n\\begin{document}",
+    "who is C:\\amogus",
+    "no stop here",
+    "ends with a newline\n",
+    "[18:49 UTC] brackets mid line <crewmate> are fine\nbut not\n[here",
+]
+
+
+@pytest.fixture(scope="module")
+def model(tiny_model) -> Transformer:
+    return Transformer(name="AMOGUS", preamble="x", settings=gptDistil._replace(model_name=tiny_model))
+
+
+def test_tokens_starting_a_stop_sequence_are_masked(tiny_model, model):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model)
+    # tokens that start with a newline, which the toy vocabulary has none of
+    tokenizer.add_tokens(["\n[", "\n<", "\n<imp", "ok\n"])
+    tables = StopTokens(tokenizer, model.stop_pattern)
+
+    texts = [tokenizer.decode([token], skip_special_tokens=True) for token in range(len(tokenizer))]
+    starts = [token for token, text in enumerate(texts) if text.startswith(("\n[", "\n<"))]
+    assert len(starts) >= 3
+    assert all(tables.anywhere[token] for token in starts)
+
+    newline = tokenizer.convert_tokens_to_ids("ok\n")
+    after_newline = tables.mask(torch.tensor([newline]))[0]
+    for token, text in enumerate(texts):
+        if text.startswith(("[", "<")):
+            assert after_newline[token]
+
+    processor = StopTokenProcessor(tables, tokenizer.eos_token_id)
+    torch.manual_seed(0)
+    scores = torch.randn(1, len(tokenizer))
+    processed = processor(torch.tensor([[newline]]), scores.clone())
+    assert torch.isinf(processed[0, after_newline]).all()
+    # the stop tokens' probability moved onto the end of sequence token
+    probs, before = torch.softmax(processed, -1)[0], torch.softmax(scores, -1)[0]
+    expected = before[tokenizer.eos_token_id] + before[after_newline].sum()
+    assert torch.allclose(probs[tokenizer.eos_token_id], expected)
+
+
+@pytest.mark.parametrize("reply", replies)
+def test_replies_end_where_the_pattern_cuts(model, reply):
+    prompt_ids = model.tokenizer.encode("[18:48 UTC]<AMOGUS>")
+    ids = model.tokenizer.encode(reply)
+    mask = model.stop_tokens.tables.mask
+
+    response = ""
+
+    def update(text: str):
+        nonlocal response
+        response += text
+
+    criteria = StopSequenceCriteria(model.stop_pattern, len(prompt_ids), model.tokenizer, update)
+    criteria.start(prompt_ids)
+    previous = prompt_ids[-1]
+    for token in ids:
+        # the processor would have turned this token into the end of sequence token
+        if mask(torch.tensor([previous]))[0, token]:
+            break
+        if criteria.feed_ids([token]):
+            break
+        previous = token
+    criteria.flush()
+
+    match = model.stop_pattern.search(reply)
+    assert response == (reply[: match.start()] if match is not None else reply.rstrip("\n"))